@@ -0,0 +1,104 @@
+'''
+High-rate U/I/P sampling with running aggregates in constant memory
+'''
+import math
+try:
+    import utime
+except ImportError:
+    import utime_compat as utime
+
+import utils
+
+STATS = ('min', 'max', 'mean', 'rms')
+
+
+class UIPAggregator:
+    '''
+    Min, max, mean and RMS of U, I, P over a reporting window and the trapezoidal integral of P
+    '''
+    FIELDS = ('U', 'I', 'P')
+    DECIMALS = {'U': 1, 'I': 2, 'P': 0}  # meter resolution, +1 for mean and RMS
+
+    def __init__(self, fields: tuple = FIELDS):
+        self.fields = fields
+        self.energy_kwh = 0.0  # integral since start, compare with deltas of T1 + T2
+        self.last = {}  # latest sample
+        self._last_p = None  # (ticks_ms, P) of the previous sample
+        self.reset()
+
+    def reset(self):
+        '''
+        Start a new window
+        '''
+        self.count = 0
+        self.window_wh = 0.0
+        self._stats = {}  # name: [count, min, max, sum, sum of squares]
+
+    def add(self, sample: dict, now: int | None = None):
+        '''
+        :param sample: {'U': V, 'I': A, 'P': W}
+        :param now: ticks_ms of the sample, current time by default
+        '''
+        if now is None:
+            now = utime.ticks_ms()
+        for name in self.fields:
+            value = sample.get(name)
+            if value is None:
+                continue
+            stats = self._stats.get(name)
+            if stats is None:
+                self._stats[name] = [1, value, value, value, value * value]
+                continue
+            stats[0] += 1
+            if value < stats[1]:
+                stats[1] = value
+            if value > stats[2]:
+                stats[2] = value
+            stats[3] += value
+            stats[4] += value * value
+        p = sample.get('P')
+        if p is not None:
+            if self._last_p is not None:
+                last_ms, last_p = self._last_p
+                self.window_wh += (last_p + p) / 2 * utime.ticks_diff(now, last_ms) / 3600000
+            self._last_p = (now, p)
+        self.last = sample
+        self.count += 1
+
+    def window(self) -> dict:
+        '''
+        Aggregates of the window as sensor values: U_min, ..., P_rms, E_window (Wh), E (kWh).
+        Starts a new window.
+        '''
+        res = {}
+        for name, (count, low, high, total, squares) in self._stats.items():
+            decimals = self.DECIMALS.get(name, 2)
+            res[f'{name}_min'] = low
+            res[f'{name}_max'] = high
+            res[f'{name}_mean'] = round(total / count, decimals + 1)
+            res[f'{name}_rms'] = round(math.sqrt(squares / count), decimals + 1)
+        if self.count:
+            # summed per window: small steps would vanish in the single precision floats of ESP8266
+            self.energy_kwh += self.window_wh / 1000
+            res['E_window'] = round(self.window_wh, 2)
+            res['E'] = round(self.energy_kwh, 4)
+        self.reset()
+        return res
+
+
+def sample_uip(em, aggregator: UIPAggregator, duration_ms: int) -> int:
+    '''
+    Read U/I/P back to back within one bus session, as fast as the port speed allows
+    :return: number of samples
+    '''
+    count = 0
+    end = utime.ticks_add(utime.ticks_ms(), duration_ms)
+    with em._transport:
+        while utime.ticks_diff(end, utime.ticks_ms()) > 0:
+            uip = em.read('uip', 0)  # never from the cache
+            if uip is None:
+                break  # the retry policy has given up, do not spin on a silent meter
+            aggregator.add(uip)
+            count += 1
+            utils.watchdog.feed()
+    return count
@@ -0,0 +1,89 @@
+'''
+Fastest reliable port speed negotiation with the result persisted across reboots
+'''
+from mercury import MercuryEnergyMeter
+import utils
+
+SPEED_FILE = 'speed.cfg'
+
+
+def load_speed(file: str = SPEED_FILE) -> int | None:
+    '''
+    Port speed negotiated on a previous boot
+    '''
+    try:
+        with open(file) as f:
+            speed = int(f.read())
+    except (OSError, ValueError):
+        return None
+    return speed if speed in MercuryEnergyMeter.SUPPORTED_PORT_SPEEDS else None
+
+
+def save_speed(speed: int, file: str = SPEED_FILE):
+    with open(file, 'w') as f:
+        f.write(str(speed))
+
+
+def error_rate(em: MercuryEnergyMeter, probes: int) -> float:
+    '''
+    Share of failed (CRC error, timeout etc.) serial number requests at the current port speed
+    '''
+    errors = 0
+    for _ in range(probes):
+        timeout = em.retry_policy.receive_timeout_ms(em.port_speed)
+        answer = em._request(em.COMMAND.GET_SERIAL_NUMBER, answer_format='>I', timeout_ms=timeout)
+        if isinstance(answer, str):
+            errors += 1
+        else:
+            em.retry_policy.observe(em.port_speed, em.response_time[0])
+        utils.watchdog.feed()
+    return errors / probes
+
+
+def find_speed(em: MercuryEnergyMeter, attempts: int = 3) -> int | None:
+    '''
+    Find the port speed the meter currently uses, starting with the local one
+    '''
+    speeds = (em.port_speed,) + tuple(s for s in em.SUPPORTED_PORT_SPEEDS if s != em.port_speed)
+    for speed in speeds:
+        em.use_port_speed(speed)
+        if error_rate(em, attempts) < 1:
+            return speed
+    return None
+
+
+def negotiate_speed(em: MercuryEnergyMeter, probes: int = 20, max_error_rate: float = 0.05,
+                    file: str | None = SPEED_FILE) -> int | None:
+    '''
+    Step the meter through SUPPORTED_PORT_SPEEDS from the fastest one and settle on the first
+    speed with an error rate not above max_error_rate
+    :param probes: requests to measure the error rate at each speed
+    :param file: where to store the result, None to skip
+    :return: negotiated speed, None if the meter does not answer
+    '''
+    current = find_speed(em)
+    if current is None:
+        return None
+
+    best = None
+    for speed in em.SUPPORTED_PORT_SPEEDS:
+        if speed != current:
+            em.port_speed = speed
+            if error_rate(em, 3) == 1:  # did not switch, e.g. SET_SPEED was lost
+                current = find_speed(em)
+                if current is None:
+                    return None
+                if current != speed:
+                    continue
+            current = speed
+        rate = error_rate(em, probes)
+        print(f'port speed {speed}: {rate * 100:.0f}% errors')
+        if rate <= max_error_rate:
+            best = speed
+            break
+
+    if best is None:  # nothing is good enough, stay at the slowest speed
+        best = current
+    if file is not None:
+        save_speed(best, file)
+    return best
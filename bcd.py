@@ -0,0 +1,75 @@
+'''
+Table-driven packed BCD codec on scaled integers, no floats involved
+'''
+POW10 = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+
+def _make_tables() -> tuple:
+    decode = bytearray(256)  # BCD byte: 0..99, nibbles above 9 are taken as they are, as the meter would show them
+    for byte in range(256):
+        decode[byte] = ((byte >> 4) * 10 + (byte & 0x0F)) & 0xFF
+    encode = bytes((n // 10) << 4 | n % 10 for n in range(100))  # 0..99: BCD byte
+    return bytes(decode), encode
+
+
+_DECODE, _ENCODE = _make_tables()
+
+
+def decode(data, start: int = 0, nbytes: int = -1) -> int:
+    '''
+    Unsigned big-endian BCD number
+    :param data: bytes, bytearray, memoryview or a sequence of byte values
+    :param nbytes: bytes from start, the rest of data by default
+    '''
+    table = _DECODE
+    res = 0
+    for n in range(start, len(data) if nbytes < 0 else start + nbytes):
+        res = res * 100 + table[data[n]]
+    return res
+
+
+def decode_fields(data, layout: tuple) -> tuple:
+    '''
+    Consecutive BCD numbers in one pass
+    :param layout: byte sizes of the fields, e.g. (2, 2, 3) for U/I/P
+    '''
+    table = _DECODE
+    res = []
+    pos = 0
+    for size in layout:
+        value = 0
+        end = pos + size
+        while pos < end:
+            value = value * 100 + table[data[pos]]
+            pos += 1
+        res.append(value)
+    return tuple(res)
+
+
+def encode_into(buf, offset: int, value: int, nbytes: int):
+    '''
+    Write an unsigned integer as big-endian BCD, higher digits than nbytes hold are dropped
+    '''
+    assert value >= 0
+    table = _ENCODE
+    for n in range(offset + nbytes - 1, offset - 1, -1):
+        buf[n] = table[value % 100]
+        value //= 100
+
+
+def encode(value: int, nbytes: int) -> bytes:
+    res = bytearray(nbytes)
+    encode_into(res, 0, value, nbytes)
+    return bytes(res)
+
+
+def to_str(value: int, decimals: int) -> str:
+    '''
+    Fixed point string of a scaled integer, e.g. to_str(456, 2) == '4.56'
+    '''
+    if not decimals:
+        return str(value)
+    sign = '-' if value < 0 else ''
+    whole, fraction = divmod(abs(value), POW10[decimals])
+    fraction = str(fraction)
+    return f'{sign}{whole}.{"0" * (decimals - len(fraction))}{fraction}'
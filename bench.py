@@ -0,0 +1,1415 @@
+'''
+Micro-benchmarks for Mercutel hot paths, runnable on CPython and MicroPython
+'''
+import sys
+import random
+try:
+    import utime
+except ImportError:
+    import utime_compat as utime
+
+
+def _ticks_us() -> int:
+    return utime.ticks_us()
+
+
+def _elapsed_us(start: int) -> int:
+    return utime.ticks_diff(utime.ticks_us(), start)
+
+
+def _random_frame(size: int) -> bytes:
+    return bytes(random.getrandbits(8) for _ in range(size))
+
+
+def crc16_bitwise(data: bytes) -> int:
+    '''
+    Reference bit-by-bit CRC-16 Modbus, the original driver implementation
+    '''
+    crc = 0xFFFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            lsb = crc & 1
+            crc >>= 1
+            if lsb:
+                crc ^= 0xA001
+    return crc
+
+
+def bench_crc(frames: int = 2000):
+    '''
+    Compare bitwise and table-driven CRC over random Mercury-sized frames
+    '''
+    import crc16
+
+    data = [_random_frame(random.randint(5, 21)) for _ in range(frames)]
+    total = sum(len(f) for f in data)
+
+    for frame in data:
+        assert crc16_bitwise(frame) == crc16.crc16(frame), frame
+        split = len(frame) // 2
+        mv = memoryview(frame)
+        assert crc16.update(crc16.update(crc16.INIT, mv[:split]), mv[split:]) == crc16.crc16(frame), frame
+    print(f'crc: {frames} random frames, results identical')
+
+    for name, func in (('bitwise', crc16_bitwise), ('table', crc16.crc16)):
+        start = _ticks_us()
+        for frame in data:
+            func(frame)
+        us = max(_elapsed_us(start), 1)
+        print(f'crc {name}: {total * 1000000 // us} bytes/s')
+
+
+def _simulated_meter(port_speed: int = 9600, acquire_us: int = 0, cache_ttl_ms: dict | None = None, **bus_options):
+    '''
+    Driver connected to an emulated meter over an in-memory line (CPython only)
+    '''
+    from emulator import MercuryEmulator, SimulatedBus
+    from mercury import MercuryEnergyMeter
+    from transport import MemoryTransport
+
+    addr = 123456
+    bus = SimulatedBus([MercuryEmulator(addr, port_speed=port_speed)], **bus_options)
+    transport = MemoryTransport(bus, acquire_us=acquire_us)
+    return MercuryEnergyMeter(addr, port_speed, transport=transport, cache_ttl_ms=cache_ttl_ms), bus
+
+
+def bench_link(cycles: int = 20):
+    '''
+    Requests/s, retry rate and uip+energy poll latency against the emulator
+    '''
+    for speed in (9600, 600):
+        for loss, corruption in ((0.0, 0.0), (0.01, 0.05)):
+            em, bus = _simulated_meter(speed, loss=loss, corruption=corruption, seed=1)
+            latencies = []
+            start = _ticks_us()
+            for _ in range(cycles):
+                t = _ticks_us()
+                em.uip
+                em.energy
+                latencies.append(_elapsed_us(t))
+            us = max(_elapsed_us(start), 1)
+            ok = 2 * cycles
+            latencies.sort()
+            print(f'link {speed} baud, loss {loss}, corruption {corruption}: '
+                  f'{bus.requests * 1000000 / us:.1f} requests/s, retry rate {(bus.requests - ok) / ok:.2f}, '
+                  f'poll latency median {latencies[len(latencies) // 2] // 1000} ms, max {latencies[-1] // 1000} ms')
+
+
+def bench_session(cycles: int = 10, acquire_us: int = 5000):
+    '''
+    Wall-clock time of a uip+energy+date_time poll cycle: bus taken per request vs one session
+    '''
+    names = ('uip', 'energy', 'date_time')
+    for speed in (9600, 600):
+        em, _ = _simulated_meter(speed, acquire_us=acquire_us)
+        results = []
+        for batched in (False, True):
+            start = _ticks_us()
+            for _ in range(cycles):
+                if batched:
+                    em.read_many(names)
+                else:
+                    for name in names:
+                        getattr(em, name)
+            results.append(_elapsed_us(start) // cycles // 1000)
+        print(f'session {speed} baud, {acquire_us} us bus acquire: '
+              f'per request {results[0]} ms/cycle, batched {results[1]} ms/cycle')
+
+
+def _blocking_read_data(em, cmd: int, nbytes_body: int):
+    '''
+    Original reply reader: a single UART read of the whole frame, bounded by the timeout
+    '''
+    import crc16
+
+    start = _ticks_us()
+    answer = em._transport.read(4 + 1 + nbytes_body + 2)
+    em.response_time = [_elapsed_us(start)] * 2  # no first byte time with a single read
+    if not answer or len(answer) < 7 or crc16.crc16(answer):
+        return 'bad answer'
+    return answer[5:-2]
+
+
+def bench_stream(requests: int = 60):
+    '''
+    Request latency of the streaming frame decoder vs the blocking read on a noisy, lossy line
+    '''
+    from retry import CircuitBreaker, RetryPolicy
+
+    for speed in (9600, 600):
+        for streaming in (False, True):
+            em, bus = _simulated_meter(speed, loss=0.002, corruption=0.05, noise=0.1, seed=2)
+            # both readers make every request in full: the circuit never opens and the receive timeout
+            # is not learned, the blocking read would learn the whole frame time as the response time
+            policy = RetryPolicy(breaker=CircuitBreaker(threshold=requests + 1))
+            policy.timeout_min_ms = policy.timeout_ms
+            em.retry_policy = policy
+            if not streaming:
+                em._read_data = lambda cmd, n, timeout_ms=None, em=em: _blocking_read_data(em, cmd, n)
+            latencies = []
+            for _ in range(requests):
+                t = _ticks_us()
+                em.serial_number
+                latencies.append(_elapsed_us(t) // 1000)
+            latencies.sort()
+            print(f'stream {speed} baud, {"streaming" if streaming else "blocking"}: {bus.requests} attempts, '
+                  f'median {latencies[len(latencies) // 2]} ms, p95 {latencies[len(latencies) * 95 // 100]} ms, '
+                  f'max {latencies[-1]} ms')
+
+
+def bench_retry(cycles: int = 5):
+    '''
+    Worst-case uip+energy poll latency with a silent meter and latency on a lossy line
+    '''
+    for speed in (9600, 600):
+        legacy_ms = 2 * 99 * (400 + 10 + 7 * 10000 // speed)
+        em, _ = _simulated_meter(speed)
+        em.addr += 1  # nobody answers
+        latencies = []
+        for _ in range(cycles):
+            t = _ticks_us()
+            em.read_many(('uip', 'energy'))
+            latencies.append(_elapsed_us(t) // 1000)
+        print(f'retry {speed} baud, silent meter: poll latency max {max(latencies)} ms, '
+              f'then {latencies[-1]} ms with open circuit (was ~{legacy_ms} ms with 99 fixed retries)')
+
+        em, bus = _simulated_meter(speed, loss=0.01, corruption=0.05, seed=3)
+        latencies = []
+        failed = 0
+        for _ in range(cycles * 4):
+            t = _ticks_us()
+            failed += None in em.read_many(('uip', 'energy')).values()
+            latencies.append(_elapsed_us(t) // 1000)
+        print(f'retry {speed} baud, lossy line: poll latency max {max(latencies)} ms, '
+              f'{failed} failed polls, learned timeout {em.retry_policy.receive_timeout_ms(speed)} ms')
+
+
+def bench_autospeed(probes: int = 20):
+    '''
+    Negotiate the fastest reliable speed on a line that gets noisy above 2400 baud
+    '''
+    import autospeed
+
+    corruption = {9600: 0.3, 4800: 0.1, 2400: 0.02}
+    em, bus = _simulated_meter(600, corruption=corruption, seed=4)
+    em.use_port_speed(9600)  # local speed is unknown on the first boot
+    t = _ticks_us()
+    speed = autospeed.negotiate_speed(em, probes, file=None)
+    print(f'autospeed: negotiated {speed} baud in {_elapsed_us(t) // 1000} ms, {bus.requests} requests')
+    for speed in (600, speed):
+        em.use_port_speed(speed)
+        for meter in bus.meters.values():
+            meter.port_speed = speed
+        t = _ticks_us()
+        em.read_many(('uip', 'energy'))
+        print(f'autospeed: uip+energy at {speed} baud in {_elapsed_us(t) // 1000} ms')
+
+
+def bench_bus(meters: int = 40, duration_ms: int = 10000):
+    '''
+    Multi-meter polling throughput, uip+energy of every meter as fast as the line allows
+    '''
+    from bus import BusManager
+    from emulator import MercuryEmulator, SimulatedBus
+    from transport import MemoryTransport
+
+    for speed in (9600, 2400):
+        addrs = [100000 + n for n in range(meters)]
+        bus = SimulatedBus([MercuryEmulator(a, port_speed=speed) for a in addrs], loss=0.001, seed=5)
+        done = {}
+
+        def on_reading(addr, name, value):
+            done[addr, name] = done.get((addr, name), 0) + 1
+
+        manager = BusManager(MemoryTransport(bus), speed, on_reading)
+        for addr in addrs:
+            manager.add_meter(addr, {'uip': (0, 0), 'energy': (0, 0)})
+        manager.run(duration_ms)
+        polls = min(done.get((a, 'energy'), 0) for a in addrs), sum(done.values()) / 2
+        print(f'bus {meters} meters at {speed} baud: {polls[1] * 60000 / duration_ms:.0f} meters/minute, '
+              f'every meter polled at least {polls[0]} times in {duration_ms} ms, {bus.requests} requests')
+
+
+def bench_scan(size: int = 300):
+    '''
+    Address scan rate with exact reply attribution, resume from a checkpoint, confirmation pass
+    '''
+    import os
+    from emulator import MercuryEmulator, SimulatedBus
+    from mercury import MercuryEnergyMeter
+    from scanner import AddressScanner
+    from transport import MemoryTransport
+
+    start = 123400
+    hidden = {start + 7, start + 8, start + size - 1}
+    bus = SimulatedBus([MercuryEmulator(a) for a in hidden], loss=0.001, seed=6)
+    em = MercuryEnergyMeter(0, 9600, transport=MemoryTransport(bus))
+    checkpoint = 'bench_scan.bin'
+    scanner = AddressScanner(em, ((start, start + size // 2), (start + size // 2 + 1, start + size - 1)), checkpoint)
+    scanner.ranges = scanner.ranges[:1]  # interrupted after the first range
+    t = _ticks_us()
+    scanner.scan(resume=False)
+    scanner = AddressScanner(em, ((start, start + size // 2), (start + size // 2 + 1, start + size - 1)), checkpoint)
+    scanner.scan()
+    ms = _elapsed_us(t) // 1000
+    confirmed = scanner.confirm()
+    print(f'scan: {size} addresses in {ms} ms, {size * 1000 / ms:.1f} addresses/s, slot {scanner.slot_us()} us, '
+          f'found {sorted(scanner.found)}, confirmed {sorted(confirmed)}, expected {sorted(hidden)}')
+
+    # a checkpoint left by a scan of other ranges must not be resumed
+    stale = AddressScanner(em, ((500000, 500010),), checkpoint)
+    stale._next_addr = 500005
+    stale.save()
+    scanner = AddressScanner(em, ((start, start + 20),), checkpoint)
+    resumed = scanner.load()
+    found = scanner.scan()
+    os.remove(checkpoint)
+    print(f'scan after a stale checkpoint: resumed {resumed}, found {sorted(found)}, '
+          f'expected {sorted(a for a in hidden if a <= start + 20)}')
+
+
+class _RecordingMQTTClient:
+    '''
+    umqtt.simple.MQTTClient look-alike counting MQTT packets and bytes, network round trips take rtt_ms,
+    sending takes byte_us per byte
+    '''
+    def __init__(self, rtt_ms: int = 20, client_id: str = 'Electricity Meter', user: str = 'user', password: str = 'password',
+                 byte_us: int = 0):
+        self.rtt_ms = rtt_ms
+        self.byte_us = byte_us
+        self.keepalive = 30
+        self._connect_size = 2 + 10 + 2 + len(client_id) + 2 + len(user) + 2 + len(password)
+        self.connections = 0
+        self.messages = 0
+        self.packets = 0
+        self.bytes = 0
+        self.published = []
+        self.inbox = []  # (topic, msg) delivered by check_msg()
+        self._callback = None
+
+    def _packet(self, size: int, round_trip: bool = False):
+        self.packets += 1
+        self.bytes += size + (size - 2 > 127)  # two bytes of remaining length above 127
+        utime.sleep_us(size * self.byte_us)
+        if round_trip:
+            utime.sleep_ms(self.rtt_ms)
+
+    def connect(self, clean_session: bool = True, timeout: int | None = None):
+        self.connections += 1
+        utime.sleep_ms(self.rtt_ms)  # TCP handshake
+        self._packet(self._connect_size)
+        self._packet(4, True)  # CONNACK
+
+    def disconnect(self):
+        self._packet(2)
+
+    def publish(self, topic: str, msg, retain: bool = False, qos: int = 0):
+        self.messages += 1
+        self.published.append((topic, msg))
+        self._packet(2 + 2 + len(topic) + 2 * (qos > 0) + len(msg))
+        if qos:
+            self._packet(4, True)  # PUBACK
+
+    def ping(self):
+        self._packet(2)
+
+    def set_callback(self, callback):
+        self._callback = callback
+
+    def subscribe(self, topic: str, qos: int = 0):
+        self._packet(2 + 2 + 2 + len(topic) + 1)
+        self._packet(5, True)  # SUBACK
+
+    def check_msg(self):
+        while self.inbox:
+            topic, msg = self.inbox.pop(0)
+            self._callback(topic, msg)
+
+
+def _mqtt_meter(client, **options):
+    from mqtt import MQTTElectricityMeter
+
+    mqttm = MQTTElectricityMeter('localhost', 'user', 'password', client=client, device_id='5ccf7f000001', **options)
+    mqttm._discovery_due = True  # as on the first boot, before what the benchmarks measure
+    mqttm._open()
+    mqttm._close()
+    return mqttm
+
+
+def _babbling_transport(pattern: bytes):
+    '''
+    Line that never falls silent: pattern is repeated at the line speed, e.g. noise or frames of another meter
+    '''
+    from transport import Transport
+
+    class BabblingTransport(Transport):
+        def __init__(self):
+            super().__init__()
+            self._start_us = utime.ticks_us()
+            self._read = 0
+
+        def write(self, data):
+            pass
+
+        def _sent(self) -> int:
+            return utime.ticks_diff(utime.ticks_us(), self._start_us) // self.byte_time_us()
+
+        def any(self) -> int:
+            return self._sent() - self._read
+
+        def read(self, nbytes: int) -> bytes | None:
+            count = min(nbytes, self.any())
+            data = bytes(pattern[(self._read + n) % len(pattern)] for n in range(count))
+            self._read += count
+            return data or None
+
+    return BabblingTransport()
+
+
+def bench_babble(speed: int = 9600):
+    '''
+    Reads on a line that keeps sending: noise or replies of another meter must end within the request deadline
+    '''
+    try:
+        import uasyncio as asyncio
+    except ImportError:
+        import asyncio
+    from emulator import MercuryEmulator, _frame
+    from mercury import MercuryEnergyMeter
+
+    foreign = MercuryEmulator(654321).handle(_frame(654321, MercuryEnergyMeter.COMMAND.GET_SERIAL_NUMBER))
+    for title, pattern in (('noise', b'\x55\xaa\x00'), ('another meter', foreign)):
+        em = MercuryEnergyMeter(123456, speed, transport=_babbling_transport(pattern))
+        start = _ticks_us()
+        serial = em.read('serial_number', 0)
+        sync_ms = _elapsed_us(start) // 1000
+        em = MercuryEnergyMeter(123456, speed, transport=_babbling_transport(pattern))
+        start = _ticks_us()
+        serial_async = asyncio.run(em.read_async('serial_number', 0))
+        async_ms = _elapsed_us(start) // 1000
+        assert serial is None and serial_async is None
+        print(f'babble {speed} baud, {title}: read gave up after {sync_ms} ms, async {async_ms} ms '
+              f'(request deadline {em.retry_policy.deadline_ms} ms)')
+
+
+def bench_mqtt_session(updates: int = 50, rtt_ms: int = 20):
+    '''
+    Update rate with a connection per update vs a persistent connection
+    '''
+    state = {'U': 230.1, 'I': 4.56, 'P': 1049, 'T1': 1234.56, 'T2': 567.89}
+    for persistent in (False, True):
+        client = _RecordingMQTTClient(rtt_ms)
+        mqttm = _mqtt_meter(client, persistent=persistent)
+        t = _ticks_us()
+        for _ in range(updates):
+            mqttm.send_update(state)
+            mqttm.service()
+        ms = max(_elapsed_us(t) // 1000, 1)
+        print(f'mqtt session {"persistent" if persistent else "per update"}, {rtt_ms} ms RTT: '
+              f'{updates * 1000 / ms:.1f} updates/s, {client.connections} connections, {client.bytes} bytes')
+
+
+def bench_mqtt_batch(cycles: int = 10):
+    '''
+    Messages and bytes per update cycle: a message per parameter vs one JSON message
+    '''
+    state = {'U': 230.1, 'I': 4.56, 'P': 1049, 'T1': 1234.56, 'T2': 567.89}
+    for qos in (0, 1):
+        for batched in (False, True):
+            client = _RecordingMQTTClient(0)
+            mqttm = _mqtt_meter(client, persistent=True, batched=batched, qos=qos)
+            messages, size, packets = client.messages, client.bytes, client.packets
+            for _ in range(cycles):
+                mqttm.send_update(state)
+            print(f'mqtt batch {"json" if batched else "per parameter"}, QoS {qos}: '
+                  f'{(client.messages - messages) / cycles:.0f} messages/cycle, '
+                  f'{(client.packets - packets) / cycles:.0f} packets/cycle, {(client.bytes - size) / cycles:.0f} bytes/cycle')
+    print(f'mqtt batch payload: {client.published[-1][1]}')
+
+
+def bench_rbe(hours: int = 24, poll_s: int = 10):
+    '''
+    Messages per hour when polling every poll_s seconds: everything vs report by exception
+    '''
+    rnd = random.Random(7)
+    client = _RecordingMQTTClient(0)
+    mqttm = _mqtt_meter(client)
+    changes = mqttm.changes
+    t1 = 1234.56
+    p = 300
+    sent_all = sent_rbe = 0
+    for n in range(hours * 3600 // poll_s):
+        if not rnd.randrange(60):  # a load switches on or off every ~10 minutes
+            p = max(50, p + rnd.choice((-1, 1)) * rnd.randrange(100, 2000))
+        u = round(230 + rnd.uniform(-0.4, 0.4), 1)
+        i = round(p / u, 2)
+        t1 = round(t1 + p * poll_s / 3600 / 1000, 2)
+        state = {'U': u, 'I': i, 'P': p + rnd.randrange(-3, 4), 'T1': t1, 'T2': 567.89}
+        sent_all += len(state)
+        now = n * poll_s * 1000
+        changed = changes.filter(state, now)
+        changes.commit(changed, now)
+        sent_rbe += len(changed)
+    print(f'rbe polling every {poll_s} s: {sent_all / hours:.0f} messages/hour without deadbands, '
+          f'{sent_rbe / hours:.0f} with deadbands and heartbeat (5-minute polling: {5 * 12})')
+
+
+class _MQTTException(Exception):
+    '''
+    umqtt.simple.MQTTException: CONNACK return code of a refused connection
+    '''
+
+
+class _FlakyMQTTClient(_RecordingMQTTClient):
+    '''
+    Broker that fails connections and drops sockets while offline is set
+    '''
+    def __init__(self, *args, failure: str = 'unreachable', **kwargs):
+        '''
+        :param failure: how a connection fails: 'unreachable' host, 'refused' by the broker (not authorized),
+                        'silent' host that never answers, the attempt ends with the socket timeout
+        '''
+        super().__init__(*args, **kwargs)
+        self.offline = False
+        self.failure = failure
+        self.attempts = 0
+
+    def connect(self, clean_session: bool = True, timeout: int | None = None):
+        if self.offline:
+            self.attempts += 1
+            if self.failure == 'silent':
+                utime.sleep_ms(1000 * timeout if timeout else 60000)  # TCP gives up after a minute or more
+                raise OSError(110)  # ETIMEDOUT
+            utime.sleep_ms(self.rtt_ms)
+            if self.failure == 'refused':
+                super().connect(clean_session)
+                raise _MQTTException(5)  # CONNACK: not authorized
+            raise OSError(113)  # EHOSTUNREACH
+        super().connect(clean_session)
+
+    def publish(self, topic: str, msg, retain: bool = False, qos: int = 0):
+        if self.offline:
+            raise OSError(104)  # ECONNRESET
+        super().publish(topic, msg, retain, qos)
+
+
+def bench_offline(polls: int = 120, outage: tuple = (20, 80), capacity: int = 32):
+    '''
+    Broker outage between polls outage[0] and outage[1]: longest poll step, readings kept and delivered
+    '''
+    import json
+    import os
+    import tempfile
+    from ringbuf import ReadingRing
+
+    for failure in ('unreachable', 'refused', 'silent'):
+        client = _FlakyMQTTClient(5, failure=failure)
+        mqttm = _mqtt_meter(client, persistent=True, batched=True, qos=1)
+        mqttm.CONNECT_TIMEOUT_S = 1
+        path = os.path.join(tempfile.mkdtemp(), 'readings.bin')
+        ring = ReadingRing(path, capacity=capacity)
+        worst_us = 0
+        for n in range(polls):
+            client.offline = outage[0] <= n < outage[1]
+            if n == outage[0]:
+                mqttm._drop()  # the broker went away
+            state = {'U': 230.0 + n % 3, 'P': 100 + n, 'T1': 1000 + n / 100}
+            mqttm.changes._reported.clear()  # every poll is a change
+            t = _ticks_us()
+            mqttm.send_changes(state, ring)
+            worst_us = max(worst_us, _elapsed_us(t))
+        attempts = client.attempts
+        while len(ring):
+            mqttm._retry_ms = utime.ticks_ms()  # skip the reconnection backoff
+            mqttm.send_history(ring)
+        history = [item for topic, msg in client.published if topic == mqttm.history_topic for item in json.loads(msg)]
+        lost = outage[1] - outage[0] - len(history)
+        print(f'offline, broker {failure}: {outage[1] - outage[0]} polls offline, {attempts} connection attempts, '
+              f'longest poll step {worst_us / 1000:.1f} ms (connect timeout {mqttm.CONNECT_TIMEOUT_S} s), '
+              f'{len(history)} readings delivered later with timestamps, {lost} dropped (capacity {capacity}), '
+              f'file {os.path.getsize(path)} bytes')
+        ring.close()
+
+
+def bench_async(duration_ms: int = 8000, poll_ms: int = 500, connect_ms: int = 2000):
+    '''
+    Broker unreachable, every connection attempt hangs connect_ms: sample period jitter and loop lag,
+    sequential loop vs the event loop runtime
+    '''
+    import os
+    import tempfile
+    from ringbuf import ReadingRing
+    from runtime import Runtime
+
+    def offline_meter():
+        client = _FlakyMQTTClient(connect_ms)
+        mqttm = _mqtt_meter(client, persistent=True)
+        client.offline = True
+        mqttm._drop()
+        return mqttm
+
+    def jitter_ms(samples):
+        return max(abs(utime.ticks_diff(b, a) - poll_ms) for a, b in zip(samples, samples[1:]))
+
+    em, _ = _simulated_meter()
+    path = os.path.join(tempfile.mkdtemp(), 'readings.bin')
+
+    mqttm = offline_meter()
+    ring = ReadingRing(path + '.seq')
+    samples = []
+    start = utime.ticks_ms()
+    while utime.ticks_diff(utime.ticks_ms(), start) < duration_ms:
+        t = utime.ticks_ms()
+        samples.append(t)
+        readings = em.read_many(('uip', 'energy'))
+        mqttm.send_changes(dict(readings['uip'], **readings['energy']), ring)
+        utime.sleep_ms(max(poll_ms - utime.ticks_diff(utime.ticks_ms(), t), 0))
+    print(f'async sequential loop: {len(samples)} samples, period jitter {jitter_ms(samples)} ms')
+
+    rt = Runtime(em, offline_meter(), ReadingRing(path), {'uip': (poll_ms, 0), 'energy': (poll_ms, 0)}, None)
+    rt.run(duration_ms)
+    job = rt.scheduler.jobs[0]
+    print(f'async runtime: {job.runs} samples, start late max {job.max_late_ms} ms, '
+          f'loop lag max {rt.lag.max_ms} ms (bound {rt.LAG_BOUND_MS} ms), {len(rt.ring)} readings kept offline')
+
+    # a failed read or publish is logged, the tasks go on
+    client = _RecordingMQTTClient(0)
+    mqttm = _mqtt_meter(client, persistent=True, batched=True)
+    calls = {'read': 0, 'send': 0}
+    read_many_async = em.read_many_async
+    send_changes = mqttm.send_changes
+
+    async def failing_read(names):
+        calls['read'] += 1
+        if calls['read'] % 3 == 0:
+            raise OSError(5)  # EIO
+        return await read_many_async(names)
+
+    def failing_send(state, ring=None):
+        calls['send'] += 1
+        if calls['send'] % 2:
+            raise _MQTTException(5)
+        return send_changes(state, ring)
+
+    em.read_many_async = failing_read
+    mqttm.send_changes = failing_send
+    rt = Runtime(em, mqttm, None, {'uip': (poll_ms, 0)}, None)
+    rt.run(duration_ms // 2)
+    del em.read_many_async
+    published = sum(topic == mqttm.state_topic for topic, _ in client.published)
+    print(f'async runtime with failures: {rt.scheduler.jobs[0].runs} polls, {calls["read"] // 3} failed, '
+          f'{calls["send"]} publishes, {(calls["send"] + 1) // 2} failed, {published} state messages (unchanged values are not sent)')
+
+
+def bench_schedule(duration_ms: int = 10000, uip_ms: int = 200, energy_ms: int = 2000):
+    '''
+    Work then sleep the period vs deadlines: samples taken and drift of the last sample from the grid
+    '''
+    from scheduler import Scheduler
+
+    em, _ = _simulated_meter()
+    expected = duration_ms // uip_ms
+
+    def sample():
+        times.append(utime.ticks_ms())
+        em.uip
+
+    def drift_ms():
+        return utime.ticks_diff(times[-1], times[0]) - (len(times) - 1) * uip_ms
+
+    times = []
+    start = utime.ticks_ms()
+    energy = 0
+    while utime.ticks_diff(utime.ticks_ms(), start) < duration_ms:
+        sample()
+        if not len(times) % (energy_ms // uip_ms):
+            em.energy
+            energy += 1
+        utime.sleep_ms(uip_ms)
+    print(f'schedule sleep after work: {len(times)} U/I/P samples of {expected}, {energy} energy reads, '
+          f'drift {drift_ms()} ms')
+
+    times = []
+    sched = Scheduler()
+    uip_job = sched.add('uip', uip_ms, 0, sample)
+    energy_job = sched.add('energy', energy_ms, uip_ms // 2, lambda: em.energy)
+    sched.run(duration_ms)
+    print(f'schedule deadlines: {len(times)} U/I/P samples of {expected}, {energy_job.runs} energy reads, '
+          f'drift {drift_ms()} ms, start late max {uip_job.max_late_ms} ms, missed {uip_job.missed}')
+
+
+def bench_sampling(duration_ms: int = 10000, base_w: int = 100000, peak_w: int = 900000):
+    '''
+    Load with 300 ms peaks every 2 s: peak seen by one read per window vs high-rate sampling,
+    integrated energy vs the T1 register delta
+    '''
+    import threading
+    from aggregate import UIPAggregator, sample_uip
+
+    for speed in (9600, 600):
+        em, bus = _simulated_meter(speed)
+        meter = bus.meters[em.addr]
+        meter.set_power(base_w)
+        stop = threading.Event()
+
+        def load():
+            while not stop.wait(1.7):
+                with bus.lock:
+                    meter.set_power(peak_w)
+                utime.sleep_ms(300)
+                with bus.lock:
+                    meter.set_power(base_w)
+
+        t1 = em.energy['T1']
+        single = em.uip['P']
+        thread = threading.Thread(target=load)
+        thread.start()
+        agg = UIPAggregator()
+        count = sample_uip(em, agg, duration_ms)
+        stop.set()
+        thread.join()
+        agg.add(em.uip)  # close the integral at the register read
+        delta = em.energy['T1'] - t1
+        window = agg.window()
+        print(f'sampling {speed} baud: {count * 1000 // duration_ms} samples/s, P max {window["P_max"]:.0f} W '
+              f'(one read per window: {single:.0f} W), P mean {window["P_mean"]:.0f} W, '
+              f'integral {window["E"]:.3f} kWh vs T1 delta {delta:.2f} kWh')
+
+
+def bench_metrics(requests: int = 100, calls: int = 10000):
+    '''
+    Diagnostics collected over a lossy link and the instrumentation cost per request
+    '''
+    from metrics import Metrics, registry
+
+    em, _ = _simulated_meter(loss=0.01, corruption=0.05, noise=0.05, seed=3)
+    start = _ticks_us()
+    for _ in range(requests):
+        em.uip
+    request_us = _elapsed_us(start) // requests
+    snapshot = registry.snapshot(('loop_lag',))
+    print('metrics ' + ', '.join(f'{name} {value}' for name, value in sorted(snapshot.items())))
+
+    m = Metrics()
+    start = _ticks_us()
+    for n in range(calls):
+        m.inc('requests_uip')  # a successful request: counter and round trip time
+        m.observe('rtt', n & 63)
+    cost_us = _elapsed_us(start) / calls
+    print(f'metrics cost {cost_us:.1f} us per request, {cost_us * 100 / request_us:.2f} % of a {request_us // 1000} ms request')
+
+
+def bench_cache(readers: int = 5, speed: int = 600, stagger_ms: int = 100):
+    '''
+    Tasks reading uip and energy at once and one after another: bus requests without and with the cache
+    '''
+    import asyncio
+    from mercury import MercuryEnergyMeter
+
+    async def reader(em, delay_ms):
+        await asyncio.sleep(delay_ms / 1000)
+        return await em.read_many_async(('uip', 'energy'))
+
+    async def readers_at(em, stagger_ms):
+        return await asyncio.gather(*(reader(em, n * stagger_ms) for n in range(readers)))
+
+    for ttl in (None, MercuryEnergyMeter.CACHE_TTL_MS):
+        counts = []
+        for stagger in (0, stagger_ms):
+            em, bus = _simulated_meter(speed)
+            em.cache_ttl_ms = ttl or {}
+            results = asyncio.run(readers_at(em, stagger))
+            assert all(r == results[0] for r in results), results
+            counts.append(bus.requests)
+        em, bus = _simulated_meter(speed, cache_ttl_ms=ttl)
+        for _ in range(readers):
+            em.serial_number
+        print(f'cache {"on" if ttl else "off"} {speed} baud, {readers} readers of uip and energy: {counts[0]} requests '
+              f'at once, {counts[1]} {stagger_ms} ms apart; {bus.requests} requests for {readers} serial number reads')
+
+
+def _tric_server(expires_in: int = 3600, delay_ms: int = 0, names: dict | None = None):
+    '''
+    Local stand-in for the TRIC API over plain HTTP, counts connections and requests.
+    Any username is an account with two counters, a token is valid for its own account only.
+    :param delay_ms: added to every response, stands for the round trip to the real server
+    :param names: service name of each counter id, the two tariffs by default
+    :return: (server, stats), base URL is http://127.0.0.1:{server.server_port}
+    '''
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs
+
+    lock = threading.Lock()
+    stats = {'connections': 0, 'requests': []}
+    state = {'issued': 0, 'tokens': {}, 'refresh': {}, 'values': {}}  # tokens: {account: access token}
+    names = names or {'101': 'Электроэнергия (День)', '102': 'Электроэнергия (Ночь)'}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive
+
+        def setup(self):
+            super().setup()
+            with lock:
+                stats['connections'] += 1
+
+        def log_message(self, *args):
+            pass
+
+        def _body(self) -> bytes:
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        def _reply(self, code: int, obj):
+            utime.sleep_ms(delay_ms)
+            body = json.dumps(obj).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _account(self) -> str | None:
+            '''
+            Account of /v2/counter/reading/{account}/ if the bearer token is issued for it
+            '''
+            account = self.path.rstrip('/').rsplit('/', 1)[-1]
+            if self.headers.get('Authorization') == f'Bearer {state["tokens"].get(account)}':
+                return account
+            self._reply(401, {'error': 'invalid_token'})
+            return None
+
+        def do_POST(self):
+            form = parse_qs(self._body().decode())
+            grant = form['grant_type'][0]
+            with lock:
+                stats['requests'].append(f'token {grant}')
+                account = form['username'][0] if grant == 'password' else state['refresh'].pop(form['refresh_token'][0], None)
+                if account is not None:
+                    state['issued'] += 1
+                    token = state['tokens'][account] = f'access{state["issued"]}'
+                    state['refresh'][f'refresh{state["issued"]}'] = account
+                    state['values'].setdefault(account, {'101': '1234.5', '102': '567.8'})
+            if account is None:
+                self._reply(400, {'error': 'invalid_grant'})
+                return
+            self._reply(200, {'access_token': token, 'refresh_token': f'refresh{token[6:]}', 'expires_in': expires_in})
+
+        def do_GET(self):
+            stats['requests'].append('get counters')
+            account = self._account()
+            if account:
+                self._reply(200, {'counters': [
+                    {'serial': '09123456', 'service': {'name': names[oid]}, 'oid': oid, 'current': {'value': value},
+                     'previous': None} for oid, value in state['values'][account].items()]})
+
+        def do_PUT(self):
+            readings = json.loads(self._body())
+            stats['requests'].append('put readings')
+            account = self._account()
+            if account:
+                state['values'][account].update(readings)
+                self._reply(200, {'status': True, 'passed': list(readings), 'skipped': [], 'failed': []})
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, stats
+
+
+def bench_tric(submissions: int = 6):
+    '''
+    Connections and requests per TRIC submission: new client per call vs a long-lived TricClient
+    '''
+    import requests
+    from tric import TricClient
+
+    mapping = {
+        'T1': {'sn': '09123456', 'name': 'Электроэнергия (День)', 'max_increment': 500},
+        'T2': {'sn': '09123456', 'name': 'Электроэнергия (Ночь)', 'max_increment': 500}
+    }
+    for long_lived in (False, True):
+        # tokens live a second beyond the renewal margin, so they are refreshed during the run
+        server, stats = _tric_server(TricClient.EXPIRY_MARGIN_S + 1)
+        url = f'http://127.0.0.1:{server.server_port}'
+        client = TricClient('1234567', 'password', {k: dict(v) for k, v in mapping.items()}, url)
+        per_submission = []
+        for n in range(submissions):
+            if not long_lived:  # what send_counter_readings() did: password grant, GET and PUT on new connections
+                client = TricClient('1234567', 'password', {k: dict(v) for k, v in mapping.items()}, url, requests)
+            if n == submissions // 2:
+                utime.sleep(1.1)  # the access token expires
+            before = len(stats['requests'])
+            assert client.send_counter_readings({'T1': 1235.0 + n, 'T2': 568.0 + n})
+            per_submission.append(', '.join(stats['requests'][before:]))
+        server.shutdown()
+        print(f'tric {"long-lived client" if long_lived else "client per call"}: {stats["connections"]} connections, '
+              f'{len(stats["requests"])} requests for {submissions} submissions')
+        for n, requests_made in enumerate(per_submission):
+            print(f'  #{n + 1}: {requests_made}')
+
+    # two tariffs under one serial and name: each reading goes to the counter it follows,
+    # one out of range reading does not hold back the other
+    shared = {'T1': {'sn': '09123456', 'name': 'Электроэнергия', 'max_increment': 500},
+              'T2': {'sn': '09123456', 'name': 'Электроэнергия', 'max_increment': 500}}
+    server, stats = _tric_server(names={'101': 'Электроэнергия', '102': 'Электроэнергия'})
+    client = TricClient('1234567', 'password', shared, f'http://127.0.0.1:{server.server_port}')
+    sent = client.send_counter_readings({'T1': 1240.0, 'T2': 570.0})
+    values = {c['id']: c['last_reported_value'] for same in client.counters().values() for c in same}
+    sent_one = client.send_counter_readings({'T1': 9999.0, 'T2': 571.0})
+    values_one = {c['id']: c['last_reported_value'] for same in client.counters().values() for c in same}
+    server.shutdown()
+    print(f'tric shared serial and name: sent {sent}, values {values} (expected 101: 1240.0, 102: 570.0); '
+          f'with T1 out of range sent {sent_one}, values {values_one} (expected 102: 571.0 only)')
+
+
+
+def bench_tric_batch(accounts: int = 32, workers: int = 8, rtt_ms: int = 30):
+    '''
+    Multi-account TRIC submission from a JSONL and a CSV file: one account at a time vs a pool of workers
+    '''
+    import contextlib
+    import io
+    import json
+    import os
+    import tempfile
+    import tric
+
+    mapping = {
+        'T1': {'sn': '09123456', 'name': 'Электроэнергия (День)', 'max_increment': 500},
+        'T2': {'sn': '09123456', 'name': 'Электроэнергия (Ночь)', 'max_increment': 500}
+    }
+    entries = [{'account': str(1000000 + n), 'password': 'password', 'mapping': mapping,
+                'readings': {'T1': 1235.0 + n, 'T2': 568.0 + n}} for n in range(accounts)]
+    with tempfile.TemporaryDirectory() as tmp:
+        jsonl = os.path.join(tmp, 'accounts.jsonl')
+        with open(jsonl, 'w', encoding='utf8') as f:
+            f.writelines(json.dumps(entry, ensure_ascii=False) + '\n' for entry in entries)
+        csv = os.path.join(tmp, 'accounts.csv')
+        with open(csv, 'w', encoding='utf8') as f:
+            f.write('account,password,profile,sn,name,max_increment,reading\n')
+            for entry in entries:
+                for profile, reading in entry['readings'].items():
+                    counter = mapping[profile]
+                    f.write(f'{entry["account"]},password,{profile},{counter["sn"]},{counter["name"]},'
+                            f'{counter["max_increment"]},{reading}\n')
+        batch = tric.load_batch(jsonl)
+        assert tric.load_batch(csv) == batch
+
+    for pool in (1, workers):
+        server, stats = _tric_server(delay_ms=rtt_ms)
+        start = utime.time()
+        with contextlib.redirect_stdout(io.StringIO()):  # per-counter reports of every account
+            results = tric.send_batch([json.loads(json.dumps(entry)) for entry in batch], pool,
+                                      f'http://127.0.0.1:{server.server_port}')
+        elapsed = utime.time() - start
+        server.shutdown()
+        print(f'tric batch {pool} worker{"s" if pool > 1 else ""}, {rtt_ms} ms RTT: {tric.batch_report(results, elapsed)}; '
+              f'{stats["connections"]} connections, {len(stats["requests"])} requests')
+
+
+
+def bench_gateway(duration_ms: int = 8000, uip_ms: int = 500):
+    '''
+    Linux gateway over pty-backed lines: two healthy ports and one with dead meters,
+    all ports polled from one thread vs a worker thread per port (needs pyserial)
+    '''
+    import threading
+    from bus import BusManager
+    from emulator import MercuryEmulator, SimulatedBus
+    from gateway import Gateway
+    from transport import SerialTransport
+
+    jobs = {'uip': (uip_ms, 1), 'energy': (4 * uip_ms, 0)}
+    lines = {'fast1': [100001, 100002], 'fast2': [200001, 200002], 'slow': [300001, 300002, 300003]}
+    dead = {300002, 300003}  # configured, but not answering
+
+    def serve() -> dict:
+        return {name: SimulatedBus([MercuryEmulator(a) for a in addrs if a not in dead]).serve_pty()
+                for name, addrs in lines.items()}
+
+    def report(title: str, times: dict):
+        gaps = {addr: max((b - a for a, b in zip(ts, ts[1:])), default=duration_ms) for addr, ts in times.items()}
+        fast = [addr for name in ('fast1', 'fast2') for addr in lines[name]]
+        print(f'gateway {title}: uip reads of healthy meters {sum(len(times[a]) for a in fast)}, '
+              f'worst gap {max(gaps[a] for a in fast)} ms (period {uip_ms} ms); '
+              f'live meter on the slow line {len(times[300001])} reads')
+
+    def recorder(times: dict, lock, on_reading=None):
+        def on_uip(addr, name, value):
+            if name == 'uip':
+                with lock:
+                    times[addr].append(utime.ticks_ms())
+            if on_reading:
+                on_reading(addr, name, value)
+        return on_uip
+
+    # one thread for all lines
+    times = {addr: [] for addrs in lines.values() for addr in addrs}
+    on_uip = recorder(times, threading.Lock())
+    buses = []
+    for name, path in serve().items():
+        bus = BusManager(SerialTransport(path), 9600, on_uip)
+        for addr in lines[name]:
+            bus.add_meter(addr, jobs)
+        buses.append(bus)
+    start = utime.ticks_ms()
+    while utime.ticks_diff(utime.ticks_ms(), start) < duration_ms:
+        for bus in buses:
+            bus.poll()
+        utime.sleep_ms(min(bus.sleep_ms() for bus in buses))
+    for bus in buses:
+        bus.transport.close()
+    report('one thread', times)
+
+    # a worker per line, shared publisher
+    times = {addr: [] for addrs in lines.values() for addr in addrs}
+    paths = serve()
+    client = _RecordingMQTTClient(rtt_ms=20)
+    gateway = Gateway({paths[name]: {'meters': addrs} for name, addrs in lines.items()}, client, '5ccf7f000001', jobs)
+    lock = threading.Lock()
+    for worker in gateway.workers:
+        worker.on_reading = recorder(times, lock, worker.on_reading)
+    gateway.run(duration_ms)
+    report('worker per port', times)
+    print(f'  publisher: {gateway.readings} readings of {len(gateway.devices)} meters, {gateway.published} changed, '
+          f'{client.messages} messages, {gateway.queue.qsize()} left in the queue')
+
+
+
+def _canned_transport(addr: int):
+    '''
+    Line to a meter with replies prepared in advance, so that only the driver allocates while measuring
+    '''
+    from emulator import MercuryEmulator, _frame
+    from mercury import MercuryEnergyMeter
+    from transport import Transport
+
+    class CannedTransport(Transport):
+        def __init__(self):
+            super().__init__()
+            meter = MercuryEmulator(addr)
+            self.replies = {cmd: meter.handle(_frame(addr, cmd)) for cmd, _ in MercuryEnergyMeter.QUERIES.values()}
+            self._reply = b''
+            self._pos = 0
+
+        def write(self, data):
+            self._reply = self.replies[data[4]]
+            self._pos = 0
+
+        def any(self) -> int:
+            return len(self._reply) - self._pos
+
+        def read(self, nbytes: int) -> bytes | None:
+            data = self._reply[self._pos: self._pos + nbytes]  # allocates, as UART.read() does
+            self._pos += len(data)
+            return data or None
+
+        def readinto(self, buf, nbytes: int) -> int | None:
+            reply = self._reply
+            count = min(nbytes, len(reply) - self._pos)
+            for n in range(count):
+                buf[n] = reply[self._pos + n]
+            self._pos += count
+            return count or None
+
+    return CannedTransport()
+
+
+def bench_alloc(requests: int = 200):
+    '''
+    Heap use of the request path per request: frame encoding, reception and CRC check,
+    then the whole property read including value decoding (tracemalloc, CPython)
+    '''
+    import tracemalloc
+    from mercury import MercuryEnergyMeter
+
+    addr = 123456
+    em = MercuryEnergyMeter(addr, 9600, transport=_canned_transport(addr))
+    em.FRAME_GAP_MS = 0
+    em.retry_policy.observe = lambda *args: None  # adaptive timeouts are not part of the frame path
+
+    def frame_path(name: str):
+        cmd, answer_format = em.QUERIES[name]
+        return em._request(cmd, None, answer_format)
+
+    def full_read(name: str):
+        return em.read(name, 0)
+
+    for title, func in (('frame path', frame_path), ('property read', full_read)):
+        peaks = []
+        for name in ('uip', 'energy', 'serial_number'):
+            for _ in range(3):  # warm up caches of the driver
+                func(name)
+            tracemalloc.start()
+            worst = 0
+            for _ in range(requests):
+                before = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                func(name)
+                worst = max(worst, tracemalloc.get_traced_memory()[1] - before)
+            tracemalloc.stop()
+            peaks.append(f'{name} {worst} B')
+        print(f'alloc {title}, peak heap use per request: {", ".join(peaks)}')
+
+
+
+def bcd_decode_float(data: bytes, decimals: int = 0):
+    '''
+    Reference BCD decoder accumulating floats nibble by nibble, the original driver implementation
+    '''
+    res = 0
+    shift = 10**(-decimals)
+    for b in reversed(data):
+        res += (b & 0x0F) * shift
+        shift *= 10
+        res += (b >> 4) * shift
+        shift *= 10
+    return res
+
+
+def bcd_encode_str(value: int, b_size: int) -> bytes:
+    '''
+    Reference BCD encoder going through str(value), the original driver implementation
+    '''
+    res = bytearray(b_size)
+    sval = str(value)
+    for n in range(-1, -b_size * 2 - 1, -1):
+        digit = int(sval[n]) if n >= -len(sval) else 0
+        res[n // 2] |= digit if n % 2 else digit << 4
+    return bytes(res)
+
+
+def bench_bcd(replies: int = 2000):
+    '''
+    Decoding energy and uip replies and encoding BCD: float accumulation vs table-driven scaled integers
+    '''
+    import bcd
+
+    energy = [bcd.encode(random.randrange(10**8), 4) + bcd.encode(random.randrange(10**8), 4) + bytes(8)
+              for _ in range(replies)]
+    uip = [bcd.encode(random.randrange(2000, 2600), 2) + bcd.encode(random.randrange(10**4), 2) +
+           bcd.encode(random.randrange(10**6), 3) for _ in range(replies)]
+
+    def decode_float(e: bytes, u: bytes):
+        return ([bcd_decode_float(e[n: n + 4], 2) for n in range(0, 16, 4)],
+                [bcd_decode_float(u[:2], 1), bcd_decode_float(u[2:4], 2), bcd_decode_float(u[4:], 0)])
+
+    def decode_scaled(e: bytes, u: bytes):
+        t1, t2, t3, t4 = bcd.decode_fields(memoryview(e), (4, 4, 4, 4))
+        u, i, p = bcd.decode_fields(memoryview(u), (2, 2, 3))
+        return [t1 / 100, t2 / 100, t3 / 100, t4 / 100], [u / 10, i / 100, p]
+
+    results = {}
+    for name, func in (('float', decode_float), ('scaled', decode_scaled)):
+        start = _ticks_us()
+        results[name] = [func(e, u) for e, u in zip(energy, uip)]
+        us = max(_elapsed_us(start), 1)
+        # a published value shows more digits than the register has
+        noisy = sum(isinstance(v, float) and len(str(v).split('.')[-1]) > 2 for tariffs, uip_values in results[name] for v in tariffs + uip_values)
+        print(f'bcd decode {name}: {replies * 1000000 // us} energy+uip replies/s, {noisy} values with rounding noise')
+    for (e1, u1), (e2, u2) in zip(results['float'], results['scaled']):
+        assert all(abs(a - b) < 0.001 for a, b in zip(e1 + u1, e2 + u2))
+
+    values = [random.randrange(10**8) for _ in range(replies)]
+    for name, func in (('str', bcd_encode_str), ('table', bcd.encode)):
+        start = _ticks_us()
+        encoded = [func(v, 4) for v in values]
+        us = max(_elapsed_us(start), 1)
+        assert [bcd.decode(b) for b in encoded] == values
+        print(f'bcd encode {name}: {replies * 1000000 // us} values/s')
+
+
+
+def bench_boot(rtt_ms: int = 20, byte_us: int = 20):
+    '''
+    Boot to the first state publish and MQTT traffic before it: first boot, reboot with unchanged discovery,
+    Home Assistant restart, changed configuration
+    '''
+    import os
+    import tempfile
+    import mqtt
+    import utils
+    from metrics import registry as metrics
+
+    state = {'U': 230.1, 'I': 4.56, 'P': 1049, 'T1': 1234.56, 'T2': 567.89}
+    with tempfile.TemporaryDirectory() as tmp:
+        discovery_file = os.path.join(tmp, 'discovery.sha')
+
+        def boot(title: str, **options):
+            mqtt._first_state_ms = None
+            utils.BOOT_MS = utime.ticks_ms()
+            client = _RecordingMQTTClient(rtt_ms, byte_us=byte_us)
+            mqttm = mqtt.MQTTElectricityMeter('localhost', 'user', 'password', client=client, device_id='5ccf7f000001',
+                                              persistent=True, discovery_file=discovery_file, **options)
+            mqttm.send_changes(state)
+            print(f'boot {title}: first state after {metrics.gauges["boot_to_publish"]} ms, '
+                  f'{client.messages - len(state)} discovery messages, {client.bytes} bytes')
+            return client, mqttm
+
+        boot('first')
+        client, mqttm = boot('unchanged discovery')
+        client.inbox.append((mqtt.BIRTH_TOPIC.encode(), b'online'))
+        messages = client.messages
+        mqttm.service()
+        print(f'boot Home Assistant restart: {client.messages - messages} discovery messages republished')
+        boot('changed configuration', diagnostics=True)
+
+
+# imports of a fresh interpreter: modules loaded, heap allocated (tracemalloc) and time
+_STARTUP_PROBE = '''
+import sys
+import time
+import tracemalloc
+tracemalloc.start()
+modules = len(sys.modules)
+start = time.perf_counter()
+import config
+config.BOOT_PROFILE = {profile}
+{imports}
+ms = (time.perf_counter() - start) * 1000
+print(len(sys.modules) - modules, tracemalloc.get_traced_memory()[0], ms)
+'''
+
+
+def bench_startup(runs: int = 5):
+    '''
+    Import footprint up to a usable meter driver: the former eager imports of main.py against the lazy ones,
+    the boot profiler stages and the port speed argument from math.log() against the table
+    '''
+    import os
+    import subprocess
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in (os.path.dirname(os.path.abspath(__file__)),
+                                                                   os.environ.get('PYTHONPATH')) if p))
+
+    def probe(imports: str, profile: bool = False) -> list:
+        code = _STARTUP_PROBE.format(imports=imports, profile=profile)
+        return subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True,
+                              check=True).stdout.splitlines()
+
+    # main.py before: mqtt, ringbuf and mercury with math and asyncio, utils with ntptime and urandom
+    for title, imports in (('eager', 'import math, random, asyncio, utils, mercury, mqtt, ringbuf'),
+                           ('lazy', 'import main'),
+                           ('lazy + mqtt mode', 'import main, mqtt, ringbuf, scheduler')):
+        results = [probe(imports)[-1].split() for _ in range(runs)]
+        modules, heap = results[0][:2]
+        ms = min(float(result[2]) for result in results)
+        print(f'startup {title} imports: {modules} modules, {int(heap) // 1024} KB heap, {ms:.1f} ms')
+    for line in probe('import main\nimport bootprof\nbootprof.report()', True):
+        if line.startswith('boot '):
+            print(f'startup {line}')
+
+    import math
+    from mercury import MercuryEnergyMeter
+
+    calls = 20000
+    speeds = MercuryEnergyMeter.SUPPORTED_PORT_SPEEDS
+    start = _ticks_us()
+    for n in range(calls):
+        bytes([int(math.log(9600 // speeds[n % 5], 2))])
+    log_us = max(_elapsed_us(start), 1)
+    divisors = MercuryEnergyMeter.SPEED_DIVISORS
+    start = _ticks_us()
+    for n in range(calls):
+        bytes((divisors[speeds[n % 5]],))
+    table_us = max(_elapsed_us(start), 1)
+    print(f'speed argument: math.log {calls * 1000000 // log_us}/s, table {calls * 1000000 // table_us}/s')
+
+
+def bench_history(days: int = 3, uip_s: int = 10, energy_s: int = 300):
+    '''
+    On-flash history: bytes per sample against fixed-size ReadingRing records, a one hour query through
+    the block index against decoding everything, rollups, reopening, and bulk export over MQTT and HTTP
+    '''
+    import json
+    import os
+    import socket
+    import tempfile
+    import threading
+    import history
+    from ringbuf import ReadingRing
+
+    t0 = 1700000000
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        hist = history.History(os.path.join(tmp, 'history'), max_bytes=1024 * 1024, raw_days=days)
+        energy = {'T1': 12345.67, 'T2': 4567.89, 'T3': 0.0, 'T4': 0.0}
+        samples = 0
+        start = _ticks_us()
+        for ts in range(t0, t0 + days * history.DAY, uip_s):
+            p = 300 + rng.randint(0, 1700) if ts % 3600 < 600 else 300 + rng.randint(-20, 20)  # base load and peaks
+            hist.append({'U': round(230 + rng.uniform(-2, 2), 1), 'I': round(p / 230, 2), 'P': p}, ts)
+            samples += 1
+            if ts % energy_s == 0:
+                energy['T1'] = round(energy['T1'] + p * energy_s / 3600000, 2)
+                hist.append(energy, ts)
+                samples += 1
+        hist.flush()
+        us = max(_elapsed_us(start), 1)
+        raw = hist.series['raw']
+        ring = ReadingRing(os.path.join(tmp, 'ring.bin'), 1, fields=history.FIELDS)
+        print(f'history {days} days: {samples} samples in {raw.size} B, {raw.size / samples:.1f} B/sample '
+              f'(ReadingRing {ring.record_size} B/sample), {samples * 1000000 // us} appends/s')
+        ring.close()
+
+        end = t0 + days * history.DAY - 1
+        start = _ticks_us()
+        hour = list(hist.query(end - 3600, end))
+        index_us = max(_elapsed_us(start), 1)
+        start = _ticks_us()
+        scanned = [record for record in hist.query(0, end) if record[0] >= end - 3600]
+        scan_us = max(_elapsed_us(start), 1)
+        assert hour == scanned
+        print(f'history query of the last hour: {len(hour)} samples, index {index_us // 1000} ms, '
+              f'decoding everything {scan_us // 1000} ms')
+
+        hours = list(hist.query(0, end, 'hour'))
+        days_ = list(hist.query(0, end, 'day'))
+        print(f'history rollups: {len(hours)} hourly in {hist.series["hour"].size} B, '
+              f'{len(days_)} daily in {hist.series["day"].size} B, day 2 {days_[1][1]}')
+        hist.close()
+        start = _ticks_us()
+        hist = history.History(os.path.join(tmp, 'history'), max_bytes=1024 * 1024, raw_days=days)
+        print(f'history reopened in {_elapsed_us(start) // 1000} ms, '
+              f'current hour rebuilt from {hist.hourly.counts.get("U", 0)} samples')
+
+        small = history.History(os.path.join(tmp, 'small'), max_bytes=32 * 1024, raw_days=1)
+        for ts, values in hist.query(0, end):
+            small.append(values, ts)
+        small.flush()
+        kept = small.series['raw']
+        print(f'history eviction, 32 KB budget: raw {kept.size} B of {kept.max_bytes} B, '
+              f'oldest sample {(end - next(kept.query(0, end))[0]) / 3600:.1f} h old')
+        small.close()
+
+        client = _RecordingMQTTClient(0)
+        mqttm = _mqtt_meter(client, persistent=True, history=hist)
+        for resolution, since in (('hour', t0), ('raw', end - history.DAY)):
+            request = json.dumps({'from': since, 'to': end, 'res': resolution})
+            client.inbox.append((f'{mqttm.backfill_topic}/get'.encode(), request))
+            client.published = []
+            mqttm.service()
+            while mqttm._backfill is not None:
+                mqttm.service()
+            docs = [msg for topic, msg in client.published if topic == mqttm.backfill_topic]
+            records = list(hist.query(since, end, resolution))
+            # the same records one JSON object each, as send_history() sends the offline ring
+            objects = sum(len(mqttm._compact_json(dict(values, ts=ts))) + 1 for ts, values in records)
+            print(f'history MQTT backfill {resolution} of {(end - since) // 3600} h: {len(records)} records in '
+                  f'{len(docs)} documents, {sum(len(doc) for doc in docs)} B (JSON objects {objects} B)')
+        rejected = 0
+        for request in ('{"from":1,"to":2,"res":"week"}', f'{{"from":{end},"to":{t0}}}', '{"from":"x","to":1}', '[1,2]',
+                        '{"from":1,"to":2,"res":["raw"]}', 'not json'):
+            client.inbox.append((f'{mqttm.backfill_topic}/get'.encode(), request))
+            mqttm.service()  # a wrong request must not reach send_backfill()
+            rejected += mqttm._backfill is None
+        print(f'history MQTT backfill: {rejected} of 6 wrong requests rejected')
+
+        # an export resumes after its last record while new samples evict the oldest segments
+        busy = history.History(os.path.join(tmp, 'busy'), max_bytes=16 * 1024, raw_days=365)
+        ts = t0
+        for _ in range(3000):
+            busy.append({'U': 230.0, 'I': 1.5}, ts)
+            ts += 10
+        exported = []
+        for doc in busy.export_json(0, ts - 10, 'raw'):  # what is stored when the request comes
+            doc = json.loads(doc)
+            at = doc['t0']
+            for dt in doc['dt']:
+                at += dt
+                exported.append(at)
+            for _ in range(30):
+                busy.append({'U': 231.0, 'I': 1.5}, ts)
+                ts += 10
+        # samples are deleted oldest first, one still stored now was stored during the whole export
+        times = set(exported)
+        skipped = sum(1 for stored, _ in busy.query(exported[0], exported[-1]) if stored not in times)
+        busy.close()
+        print(f'history backfill while appending: {len(exported)} records exported, {skipped} stored records skipped')
+
+        server = history.HistoryServer(hist, 0)
+        port = server._sock.getsockname()[1]
+        answer = []
+
+        def fetch():
+            with socket.create_connection(('127.0.0.1', port)) as conn:
+                conn.sendall(f'GET /history?from={end - 3600}&to={end}&res=raw HTTP/1.0\r\n\r\n'.encode())
+                while True:
+                    data = conn.recv(4096)
+                    if not data:
+                        break
+                    answer.append(data)
+
+        thread = threading.Thread(target=fetch)
+        thread.start()
+        while not server.poll():
+            utime.sleep_ms(1)
+        thread.join()
+        server.close()
+        text = b''.join(answer).decode()
+        lines = text.split('\r\n\r\n', 1)[1].splitlines()
+        print(f'history HTTP: {text.splitlines()[0]}, {len(lines) - 1} CSV rows, {len(text)} B')
+        hist.close()
+
+
+BENCHMARKS = {
+    'crc': bench_crc,
+    'link': bench_link,
+    'session': bench_session,
+    'stream': bench_stream,
+    'retry': bench_retry,
+    'babble': bench_babble,
+    'autospeed': bench_autospeed,
+    'bus': bench_bus,
+    'scan': bench_scan,
+    'mqtt_session': bench_mqtt_session,
+    'mqtt_batch': bench_mqtt_batch,
+    'rbe': bench_rbe,
+    'offline': bench_offline,
+    'async': bench_async,
+    'schedule': bench_schedule,
+    'sampling': bench_sampling,
+    'metrics': bench_metrics,
+    'cache': bench_cache,
+    'tric': bench_tric,
+    'tric_batch': bench_tric_batch,
+    'gateway': bench_gateway,
+    'alloc': bench_alloc,
+    'bcd': bench_bcd,
+    'boot': bench_boot,
+    'startup': bench_startup,
+    'history': bench_history,
+}
+
+
+def _run(bench):
+    '''
+    Run a benchmark in an empty working directory where there is one (CPython), so state files it writes,
+    e.g. discovery_*.sha or scan checkpoints, are not picked up by a later run
+    '''
+    try:
+        import os
+        import tempfile
+    except ImportError:  # MicroPython
+        return bench()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            return bench()
+        finally:
+            os.chdir(cwd)
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f'Unknown benchmark "{name}", available: {", ".join(BENCHMARKS)}')
+            continue
+        _run(BENCHMARKS[name])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+'''
+Boot profiler: time since power-on and heap after each startup stage, enabled by config.BOOT_PROFILE
+'''
+import gc
+try:
+    import utime
+except ImportError:  # CPython
+    import utime_compat as utime
+
+import config
+
+ENABLED = getattr(config, 'BOOT_PROFILE', False)
+# utime.ticks_ms() at power-on: MicroPython counts from boot, CPython from this import
+START_MS = utime.ticks_ms() if not hasattr(gc, 'mem_free') else 0
+
+STAGES = []  # (stage, ms since power-on, heap allocated, heap free), heap is None on CPython
+_collect_ms = 0  # time spent in gc.collect() by mark(), not counted as boot time
+
+
+def _heap() -> tuple:
+    if hasattr(gc, 'mem_free'):
+        return gc.mem_alloc(), gc.mem_free()
+    import sys
+    tracemalloc = sys.modules.get('tracemalloc')  # traced only if the caller started it
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0], None
+    return None, None
+
+
+def mark(stage: str):
+    '''
+    Record the end of a stage, e.g. after the imports it needs
+    '''
+    global _collect_ms
+    if not ENABLED:
+        return
+    now = utime.ticks_ms()
+    gc.collect()  # live objects only, garbage of the stage is not its footprint
+    alloc, free = _heap()
+    STAGES.append((stage, utime.ticks_diff(now, START_MS) - _collect_ms, alloc, free))
+    _collect_ms += utime.ticks_diff(utime.ticks_ms(), now)
+
+
+def report():
+    '''
+    Print the stages with their own time and heap growth
+    '''
+    if not ENABLED:
+        return
+    prev_ms = prev_alloc = 0
+    for stage, ms, alloc, free in STAGES:
+        heap = '' if alloc is None else f', heap {alloc} B (+{alloc - prev_alloc})'
+        if free is not None:
+            heap += f', free {free} B'
+        print(f'boot {stage}: {ms} ms (+{ms - prev_ms}){heap}')
+        prev_ms = ms
+        prev_alloc = alloc or 0
+
+
+mark('interpreter')
@@ -0,0 +1,97 @@
+'''
+Scheduler for many Mercury 200 meters on one RS-485 line
+'''
+try:
+    import utime
+except ImportError:
+    import utime_compat as utime
+
+from mercury import MercuryEnergyMeter
+from scheduler import next_due
+import utils
+
+
+class PollJob:
+    '''
+    Periodic read of one meter property
+    '''
+    def __init__(self, meter: MercuryEnergyMeter, name: str, period_ms: int, priority: int, due_ms: int):
+        self.meter = meter
+        self.name = name
+        self.period_ms = period_ms
+        self.priority = priority  # higher runs first among due jobs
+        self.due_ms = due_ms
+
+
+class BusManager:
+    '''
+    Owns the line and interleaves property reads of all meters on it.
+    Requests are sent one after another by the single master, so they never collide.
+    '''
+    def __init__(self, transport, port_speed: int, on_reading=None):
+        '''
+        :param on_reading: callback(addr, name, value) for every successful read
+        '''
+        self.transport = transport
+        self.port_speed = port_speed
+        self.on_reading = on_reading
+        self.meters = {}
+        self.jobs = []
+
+    def add_meter(self, addr: int, jobs: dict, **meter_options) -> MercuryEnergyMeter:
+        '''
+        :param jobs: {property: (period_ms, priority)}, e.g. {'uip': (60000, 1), 'energy': (300000, 0)}
+        '''
+        meter = MercuryEnergyMeter(addr, self.port_speed, transport=self.transport, **meter_options)
+        self.meters[addr] = meter
+        now = utime.ticks_ms()
+        for name, (period_ms, priority) in jobs.items():
+            assert name in meter.READABLE, name
+            self.jobs.append(PollJob(meter, name, period_ms, priority, now))
+        return meter
+
+    def _next_job(self, now: int) -> PollJob | None:
+        best = None
+        for job in self.jobs:
+            lateness = utime.ticks_diff(now, job.due_ms)
+            if lateness < 0:
+                continue
+            if best is None or job.priority > best.priority or \
+                    (job.priority == best.priority and lateness > utime.ticks_diff(now, best.due_ms)):
+                best = job
+        return best
+
+    def poll(self) -> int:
+        '''
+        Run due jobs in one bus session, each job at most once
+        :return: number of jobs run
+        '''
+        count = 0
+        with self.transport:
+            for _ in range(len(self.jobs)):
+                now = utime.ticks_ms()
+                job = self._next_job(now)
+                if job is None:
+                    break
+                value = getattr(job.meter, job.name)
+                # next period from the schedule, not from now; skip missed periods instead of bursting
+                job.due_ms, _ = next_due(job.due_ms, job.period_ms, utime.ticks_ms())
+                count += 1
+                if value is not None and self.on_reading:
+                    self.on_reading(job.meter.addr, job.name, value)
+                utils.watchdog.feed()
+        return count
+
+    def sleep_ms(self) -> int:
+        '''
+        Time until the next job is due
+        '''
+        now = utime.ticks_ms()
+        return max(0, min((utime.ticks_diff(job.due_ms, now) for job in self.jobs), default=0))
+
+    def run(self, duration_ms: int | None = None):
+        start = utime.ticks_ms()
+        while duration_ms is None or utime.ticks_diff(utime.ticks_ms(), start) < duration_ms:
+            self.poll()
+            utime.sleep_ms(min(self.sleep_ms(), 1000))
+            utils.watchdog.feed()
@@ -1,11 +1,24 @@
 # Edit this file and rename it to config.py
 
 WDT_ENABLE = True  # Watchdog timer
+ASYNC_RUNTIME = False  # poll the meter and publish in separate uasyncio tasks
+BOOT_PROFILE = False  # print time and heap after each startup stage, see bootprof.py
+PORT_SPEED_NEGOTIATION = False  # switch the meter to the fastest reliable port speed, 600 baud otherwise, see autospeed.py
 
 # last 6 digits of electric meter serial number, not including:
 # - year of manufacture (two last digits after dash or space)
 # - leading zeroes
 ECOUNTER_NETWORK_ADDRESS = 123456
+# several meters on one RS-485 line, each one is published as a separate device
+# ECOUNTER_NETWORK_ADDRESSES = [123456, 234567]
+
+# Linux gateway (python gateway.py, needs pyserial and paho-mqtt): meters on USB-RS485 adapters,
+# a worker thread per port, one speed for all meters of a port
+# GATEWAY_PORTS = {
+#     '/dev/ttyUSB0': {'meters': [123456, 234567], 'speed': 9600},
+#     '/dev/ttyUSB1': {'meters': [345678]}
+# }
+# GATEWAY_DEVICE_ID = 'b827eb000001'  # MAC address of the host by default
 
 # GMT TIMEZONE for clock synchronization
 TIMEZONE = +5
@@ -14,6 +27,19 @@ TIMEZONE = +5
 MQTT_SERVER = '192.168.1.100'
 MQTT_USER = 'MQTT_USER_NAME'
 MQTT_PASSWORD = 'MQTT_PASSWORD'
+MQTT_BATCHED = False  # publish all readings as one JSON message (QoS 1) instead of a message per sensor
+OFFLINE_BUFFER_RECORDS = 512  # readings kept on flash while the broker is unreachable, 32 bytes each
+# poll periods and phase offsets in ms, see SCHEDULE in main.py for the jobs and defaults
+# SCHEDULE = {'uip': (10 * 1000, 0), 'energy': (15 * 60 * 1000, 2 * 1000)}
+# sample U/I/P back to back for this many ms every second, 'uip' then reports min/max/mean/RMS
+# and the integrated energy of its period, 0 to read U/I/P once per 'uip' period
+UIP_SAMPLING_MS = 0
+DIAGNOSTICS = False  # request, retry, error counters, latencies, free heap and loop lag as diagnostic entities
+# on-flash history of T1-T4 and U/I/P samples with hourly and daily rollups, backfilled on request
+# over MQTT (see MQTTElectricityMeter.backfill_topic) and, with a port, over HTTP: GET /history?from=&to=&res=hour
+HISTORY = False
+HISTORY_KB = 256  # flash for the samples and the rollups, the oldest are deleted first
+HISTORY_HTTP_PORT = 0  # e.g. 8080, 0 for no HTTP endpoint
 
 # GPIO of ESP8266
 PIN_TXE = 12  # transceiver/receiver control
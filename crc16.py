@@ -0,0 +1,49 @@
+'''
+Table-driven CRC-16 Modbus engine
+'''
+from array import array
+
+INIT = 0xFFFF
+POLY = 0xA001  # reflected 0x8005
+
+
+def _make_table() -> array:
+    table = array('H', bytes(512))
+    for n in range(256):
+        crc = n
+        for _ in range(8):
+            lsb = crc & 1
+            crc >>= 1
+            if lsb:
+                crc ^= POLY
+        table[n] = crc
+    return table
+
+
+_TABLE = _make_table()
+
+
+def update(crc: int, chunk) -> int:
+    '''
+    Feed next chunk of data into a running CRC
+    :param crc: CRC of the preceding data, INIT to start a new one
+    :param chunk: bytes, bytearray or memoryview
+    :return: updated CRC
+    '''
+    table = _TABLE
+    for byte in chunk:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def crc16(data, nbytes: int = -1) -> int:
+    '''
+    CRC-16 Modbus of a whole buffer or of its first nbytes, without slicing it
+    '''
+    if nbytes < 0:
+        return update(INIT, data)
+    table = _TABLE
+    crc = INIT
+    for n in range(nbytes):
+        crc = (crc >> 8) ^ table[(crc ^ data[n]) & 0xFF]
+    return crc
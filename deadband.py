@@ -0,0 +1,54 @@
+'''
+Report by exception: per-parameter deadbands with a heartbeat
+'''
+try:
+    import utime
+except ImportError:
+    import utime_compat as utime
+
+
+class ChangeFilter:
+    '''
+    Passes a value when it leaves the deadband around the last reported one,
+    or when its heartbeat is due
+    '''
+    def __init__(self, deadbands: dict, heartbeats_ms: dict):
+        '''
+        :param deadbands: {name: {'abs': absolute band, 'rel': band relative to the reported value}}
+        :param heartbeats_ms: {name: longest time without a report}
+        '''
+        self.deadbands = deadbands
+        self.heartbeats_ms = heartbeats_ms
+        self._reported = {}  # name: (value, ticks_ms)
+
+    def _changed(self, name: str, value, now: int) -> bool:
+        last = self._reported.get(name)
+        if last is None:
+            return True
+        last_value, last_ms = last
+        heartbeat = self.heartbeats_ms.get(name)
+        if heartbeat is not None and utime.ticks_diff(now, last_ms) >= heartbeat:
+            return True
+        band = self.deadbands.get(name)
+        if band is None:
+            return value != last_value
+        delta = abs(value - last_value)
+        return delta > 0 and delta >= max(band.get('abs', 0), band.get('rel', 0) * abs(last_value))
+
+    def filter(self, parameters: dict, now: int | None = None) -> dict:
+        '''
+        Parameters worth reporting now
+        :param now: ticks_ms, current time by default
+        '''
+        if now is None:
+            now = utime.ticks_ms()
+        return {name: value for name, value in parameters.items() if self._changed(name, value, now)}
+
+    def commit(self, reported: dict, now: int | None = None):
+        '''
+        Remember successfully reported values
+        '''
+        if now is None:
+            now = utime.ticks_ms()
+        for name, value in reported.items():
+            self._reported[name] = (value, now)
@@ -0,0 +1,201 @@
+'''
+Software Mercury 200 meter and RS-485 line simulator for benchmarking on Linux
+'''
+import os
+import random
+import struct
+import threading
+try:
+    import utime
+except ImportError:
+    import utime_compat as utime
+
+import crc16
+from mercury import MercuryEnergyMeter
+
+COMMAND = MercuryEnergyMeter.COMMAND
+
+REQUEST_BODY_LEN = {
+    COMMAND.SET_DATE_TIME: 7,
+    COMMAND.SET_SPEED: 1,
+    COMMAND.GET_DATE_TIME: 0,
+    COMMAND.GET_ENERGY: 0,
+    COMMAND.GET_SERIAL_NUMBER: 0,
+    COMMAND.GET_UIP: 0,
+}
+
+
+def _bcd(value: float, decimals: int, b_size: int) -> bytes:
+    return MercuryEnergyMeter.bcd_encode(int(round(value * 10**decimals)), b_size)
+
+
+def _frame(addr: int, cmd: int, body: bytes = b'') -> bytes:
+    packet = struct.pack('>IB', addr, cmd) + body
+    return packet + struct.pack('<H', crc16.crc16(packet))
+
+
+class MercuryEmulator:
+    '''
+    Protocol level model of a Mercury 200 meter
+    '''
+    def __init__(self, addr: int, serial_number: int | None = None, port_speed: int = 9600,
+                 energy: tuple = (1234.56, 567.89, 0, 0), uip: tuple = (230.1, 4.56, 1049)):
+        self.addr = addr
+        self.serial_number = addr if serial_number is None else serial_number
+        self.port_speed = port_speed
+        self.energy = list(energy)  # T1..T4, kWh
+        self.uip = list(uip)  # V, A, W
+        self.clock_offset = 0  # s, meter clock minus host clock
+        self._energy_ts = utime.time()
+
+    def _accumulate(self):
+        now = utime.time()
+        self.energy[0] += self.uip[2] * (now - self._energy_ts) / 3600 / 1000
+        self._energy_ts = now
+
+    def set_power(self, p: float):
+        '''
+        Change the load, energy up to now accumulates at the previous power
+        '''
+        self._accumulate()
+        self.uip[2] = p
+
+    def handle(self, frame: bytes) -> bytes | None:
+        '''
+        Answer a request frame, None if it is not addressed to this meter or damaged
+        '''
+        if len(frame) < 7 or crc16.crc16(frame) != 0:  # CRC over data and its own CRC is zero
+            return None
+        addr, cmd = struct.unpack('>IB', frame[:5])
+        if addr != self.addr or len(frame) != 7 + REQUEST_BODY_LEN.get(cmd, -100):
+            return None
+        body = frame[5:-2]
+
+        if cmd == COMMAND.GET_ENERGY:
+            self._accumulate()
+            answer = b''.join(_bcd(value, 2, 4) for value in self.energy)
+        elif cmd == COMMAND.GET_UIP:
+            u, i, p = self.uip
+            answer = _bcd(u, 1, 2) + _bcd(i, 2, 2) + _bcd(p, 0, 3)
+        elif cmd == COMMAND.GET_SERIAL_NUMBER:
+            answer = struct.pack('>I', self.serial_number)
+        elif cmd == COMMAND.GET_DATE_TIME:
+            yy, mo, dd, hh, mm, ss, wd = utime.localtime(utime.time() + self.clock_offset)[:7]
+            dow = (wd + 1) % 7  # Monday is 0 in localtime, Sunday is 0 for the meter
+            answer = bytes(_bcd(v, 0, 1)[0] for v in (dow, hh, mm, ss, dd, mo, yy % 100))
+        elif cmd == COMMAND.SET_SPEED:
+            reply = _frame(self.addr, cmd)
+            self.port_speed = 9600 >> body[0]
+            return reply
+        elif cmd == COMMAND.SET_DATE_TIME:
+            _, hh, mm, ss, dd, mo, yy = (MercuryEnergyMeter.bcd_decode(body[n: n + 1]) for n in range(7))
+            self.clock_offset = utime.mktime((2000 + yy, mo, dd, hh, mm, ss, 0, 0, -1)) - utime.time()
+            answer = b''
+        else:
+            return None
+        return _frame(self.addr, cmd, answer)
+
+
+class SimulatedBus:
+    '''
+    RS-485 line with meters attached, models wire timing, byte loss, CRC corruption
+    and stray bytes ahead of a reply. Rates are probabilities, single values or dicts by baud rate.
+    '''
+    def __init__(self, meters: list, time_scale: float = 1.0, loss: float | dict = 0.0,
+                 corruption: float | dict = 0.0, noise: float | dict = 0.0, response_delay_ms: int = 5,
+                 seed: int | None = None):
+        self.meters = {m.addr: m for m in meters}
+        self.time_scale = time_scale
+        self.loss = loss
+        self.corruption = corruption
+        self.noise = noise
+        self.response_delay_us = response_delay_ms * 1000
+        self._random = random.Random(seed)
+        self.lock = threading.Lock()  # meters answer one request at a time
+        self.requests = 0
+        self.replies = 0
+        self.lost = 0
+        self.corrupted = 0
+
+    @staticmethod
+    def _rate(rate: float | dict, baudrate: int) -> float:
+        return rate.get(baudrate, 0.0) if isinstance(rate, dict) else rate
+
+    def scaled_us(self, us: int) -> int:
+        return int(us * self.time_scale)
+
+    def sleep_us(self, us: int):
+        utime.sleep_us(self.scaled_us(us))
+
+    def _lossy(self, data: bytes, baudrate: int) -> bytes:
+        loss = self._rate(self.loss, baudrate)
+        if not loss:
+            return data
+        kept = bytes(b for b in data if self._random.random() >= loss)
+        if len(kept) != len(data):
+            self.lost += 1
+        return kept
+
+    def transmit(self, frame: bytes, baudrate: int) -> bytes:
+        '''
+        Deliver a request to every meter and return the raw reply seen by the master
+        '''
+        with self.lock:
+            self.requests += 1
+            frame = self._lossy(frame, baudrate)
+            reply = b''
+            for meter in self.meters.values():
+                if meter.port_speed != baudrate:
+                    continue  # framing errors, the meter sees garbage
+                answer = meter.handle(frame)
+                if answer is not None:
+                    reply = answer
+            if not reply:
+                return reply
+            self.replies += 1
+            if self._random.random() < self._rate(self.corruption, baudrate):
+                self.corrupted += 1
+                damaged = bytearray(reply)
+                damaged[self._random.randrange(len(damaged))] ^= 1 << self._random.randrange(8)
+                reply = bytes(damaged)
+            if self._random.random() < self._rate(self.noise, baudrate):
+                reply = bytes([self._random.getrandbits(8)]) + reply
+            return self._lossy(reply, baudrate)
+
+    def serve_pty(self, baudrate: int = 9600) -> str:
+        '''
+        Serve the bus on a pseudo terminal in a background thread.
+        Returns the device path for transport.SerialTransport
+        '''
+        import pty
+        import tty
+
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        thread = threading.Thread(target=self._pty_loop, args=(master, slave, baudrate), daemon=True)
+        thread.start()
+        return os.ttyname(slave)
+
+    def _pty_loop(self, master: int, slave: int, baudrate: int):
+        import termios
+
+        speeds = {getattr(termios, f'B{s}'): s for s in MercuryEnergyMeter.SUPPORTED_PORT_SPEEDS}
+        buf = b''
+        while True:
+            try:
+                buf += os.read(master, 64)
+            except OSError:
+                return  # slave closed
+            while len(buf) >= 5:
+                body_len = REQUEST_BODY_LEN.get(buf[4])
+                if body_len is None:
+                    buf = buf[1:]  # resynchronize on garbage
+                    continue
+                if len(buf) < 7 + body_len:
+                    break
+                frame, buf = buf[:7 + body_len], buf[7 + body_len:]
+                line_speed = speeds.get(termios.tcgetattr(slave)[5], baudrate)
+                reply = self.transmit(frame, line_speed)
+                if reply:
+                    self.sleep_us(self.response_delay_us + len(reply) * 10 * 1000000 // line_speed)
+                    os.write(master, reply)
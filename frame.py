@@ -0,0 +1,125 @@
+'''
+Mercury 200 frame format: ADDR[4]-CMD[1]-BODY-CRC[2]
+'''
+import struct
+
+import crc16
+
+HEADER_LEN = 5
+OVERHEAD = HEADER_LEN + 2
+MAX_BODY = 16  # energy reply, the longest one
+
+
+class FrameDecoder:
+    '''
+    Incremental reply decoder. Consumes bytes as they arrive, skips leading garbage
+    and resynchronizes on the next matching header after a damaged frame.
+    Buffers are allocated once, reset() makes the decoder ready for the next reply.
+    '''
+    def __init__(self, addr: int | None, cmd: int, nbytes_body: int):
+        '''
+        :param addr: expected meter address, None to accept any
+        '''
+        self._header = bytearray(HEADER_LEN)
+        self._buf = bytearray(OVERHEAD + MAX_BODY)
+        self._raw = bytearray(2 * (OVERHEAD + MAX_BODY))  # received bytes, to recognize replies of other meters
+        self._views = {}  # (start, end): memoryview of _buf, slices are made once
+        self.reset(addr, cmd, nbytes_body)
+
+    def reset(self, addr: int | None, cmd: int, nbytes_body: int):
+        assert nbytes_body <= MAX_BODY, nbytes_body
+        struct.pack_into('>IB', self._header, 0, addr or 0, cmd)
+        self._any_addr = addr is None
+        self._len = OVERHEAD + nbytes_body
+        self._n = 0  # bytes in _buf
+        self._raw_n = 0 if addr is not None else len(self._raw)  # replies of other meters are fine with any address
+        self.frame = None  # complete CRC-valid frame, a view of the buffer valid until the next reset()
+        self.received = 0
+        self.skipped = 0  # bytes dropped while searching for a frame
+        self.crc_errors = 0
+
+    def _view(self, start: int, end: int) -> memoryview:
+        view = self._views.get((start, end))
+        if view is None:
+            view = self._views[(start, end)] = memoryview(self._buf)[start:end]
+        return view
+
+    def _header_match(self, n: int) -> bool:
+        buf = self._buf
+        header = self._header
+        for i in range(4 if self._any_addr else 0, min(n, HEADER_LEN)):
+            if buf[i] != header[i]:
+                return False
+        return True
+
+    def _drop_first(self, n: int) -> int:
+        '''
+        Shift the buffer left by one byte in place
+        :return: new number of bytes in the buffer
+        '''
+        buf = self._buf
+        for i in range(1, n):
+            buf[i - 1] = buf[i]
+        self.skipped += 1
+        return n - 1
+
+    def feed(self, data, nbytes: int = -1) -> bool:
+        '''
+        Consume received bytes
+        :param nbytes: number of bytes at the start of data, all by default
+        :return: True once a complete frame is decoded
+        '''
+        buf = self._buf
+        raw = self._raw
+        n = self._n
+        for i in range(len(data) if nbytes < 0 else nbytes):
+            if self.frame is not None:
+                break
+            byte = data[i]
+            self.received += 1
+            buf[n] = byte
+            n += 1
+            if self._raw_n < len(raw):
+                raw[self._raw_n] = byte
+                self._raw_n += 1
+            while n:
+                if not self._header_match(n):
+                    n = self._drop_first(n)
+                    continue
+                if n < self._len:
+                    break
+                if not crc16.crc16(buf, n):  # CRC over data and its own CRC is zero
+                    self.frame = self._view(0, n)
+                    break
+                self.crc_errors += 1
+                n = self._drop_first(n)
+        self._n = n
+        return self.frame is not None
+
+    @property
+    def addr(self) -> int:
+        return struct.unpack_from('>I', self._buf)[0]
+
+    @property
+    def body(self) -> memoryview:
+        return self._view(HEADER_LEN, self._len - 2)
+
+    def foreign(self) -> bool:
+        '''
+        A valid reply of another meter was received instead, e.g. a late one
+        '''
+        if self._any_addr or self.frame is not None:
+            return False
+        return FrameDecoder(None, self._header[4], self._len - OVERHEAD).feed(self._raw, self._raw_n)
+
+    def error(self) -> str:
+        '''
+        Reason why no frame is decoded
+        '''
+        if not self.received:
+            return 'no answer'
+        if self.crc_errors:
+            return 'wrong CRC'
+        if self.foreign():
+            return 'answer from another address'
+        return f'incomplete answer, {self.received} bytes received, {self.skipped} skipped'
@@ -0,0 +1,242 @@
+'''
+Linux gateway daemon: meters on several USB-RS485 adapters, one worker thread per port
+and one MQTT publisher shared by all of them (CPython only, needs pyserial)
+'''
+import queue
+import threading
+import utime_compat as utime
+
+import config
+from bus import BusManager
+from main import SCHEDULE
+from metrics import registry as metrics
+from mqtt import MQTTElectricityMeter
+from transport import SerialTransport
+
+# property: (period_ms, priority), periods from the single meter schedule of main.py
+JOBS = {
+    'uip': (SCHEDULE['uip'][0], 1),
+    'energy': (SCHEDULE['energy'][0], 0)
+}
+
+
+class PahoClient:
+    '''
+    umqtt.simple.MQTTClient interface over paho-mqtt, its network thread keeps the connection alive
+    '''
+    def __init__(self, client_id: str, server: str, port: int = 1883, user: str | None = None,
+                 password: str | None = None, keepalive: int = 30):
+        import paho.mqtt.client as paho  # optional dependency
+
+        self.server = server
+        self.port = port
+        self.keepalive = 0  # pings are sent by paho, see MQTTElectricityMeter.service()
+        self._keepalive = keepalive
+        self._paho = paho
+        options = {'callback_api_version': paho.CallbackAPIVersion.VERSION2} if hasattr(paho, 'CallbackAPIVersion') else {}
+        self._client = paho.Client(client_id=client_id, clean_session=False, **options)
+        if user:
+            self._client.username_pw_set(user, password)
+        self._looping = False
+
+    def connect(self, clean_session: bool = True, timeout: int | None = None):
+        if self._client.is_connected():
+            return  # shared by the devices of all meters
+        self._client.connect(self.server, self.port, self._keepalive)  # raises OSError
+        if not self._looping:
+            self._client.loop_start()
+            self._looping = True
+        deadline = utime.ticks_add(utime.ticks_ms(), (timeout or 10) * 1000)
+        while not self._client.is_connected():
+            if utime.ticks_diff(deadline, utime.ticks_ms()) <= 0:
+                raise OSError(110)  # ETIMEDOUT, no CONNACK
+            utime.sleep_ms(10)
+
+    def disconnect(self):
+        self._client.disconnect()
+
+    def publish(self, topic: str, msg, retain: bool = False, qos: int = 0):
+        info = self._client.publish(topic, msg, qos, retain)
+        if info.rc != self._paho.MQTT_ERR_SUCCESS:
+            raise OSError(info.rc)
+        if qos:
+            info.wait_for_publish(self._keepalive)
+
+    def ping(self):
+        pass
+
+    def set_callback(self, callback):
+        '''
+        :param callback: callback(topic: bytes, msg: bytes), called on the paho network thread
+        '''
+        self._client.on_message = lambda client, userdata, message: callback(message.topic.encode(), message.payload)
+
+    def subscribe(self, topic: str, qos: int = 0):
+        result, _ = self._client.subscribe(topic, qos)
+        if result != self._paho.MQTT_ERR_SUCCESS:
+            raise OSError(result)
+
+    def check_msg(self):
+        if not self._client.is_connected():
+            raise OSError(104)  # ECONNRESET
+
+
+class PortWorker(threading.Thread):
+    '''
+    Owns one serial port and the meters on it, polls them with bus.BusManager.
+    A slow or dead line delays only its own meters.
+    '''
+    REOPEN_S = 10  # pause before opening a failed port again
+
+    def __init__(self, port: str, meters: list, on_reading, speed: int = 9600, jobs: dict = JOBS, transport=None):
+        '''
+        :param meters: network addresses of the meters on the line
+        :param on_reading: callback(addr, name, value), must not block
+        :param speed: port speed of all meters on the line
+        :param transport: opened line, a transport.SerialTransport for port by default
+        '''
+        super().__init__(name=f'port {port}', daemon=True)
+        self.port = port
+        self.addrs = meters
+        self.speed = speed
+        self.jobs = jobs
+        self.on_reading = on_reading
+        self.transport = transport
+        self.polls = 0
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def _open(self) -> BusManager:
+        if self.transport is None:
+            self.transport = SerialTransport(self.port)
+        bus = BusManager(self.transport, self.speed, self.on_reading)
+        for addr in self.addrs:
+            bus.add_meter(addr, self.jobs)
+        return bus
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                bus = self._open()
+                while not self._stopping.is_set():
+                    self.polls += bus.poll()
+                    self._stopping.wait(min(bus.sleep_ms(), 1000) / 1000)
+            except OSError as e:  # adapter unplugged, serial.SerialException included
+                print(f'{self.port} failed: {e}, reopening in {self.REOPEN_S} s')
+                if self.transport is not None and hasattr(self.transport, 'close'):
+                    self.transport.close()
+                self.transport = None
+                self._stopping.wait(self.REOPEN_S)
+
+
+class Gateway:
+    '''
+    Port workers put readings on a bounded queue, a single publisher thread sends them
+    with a MQTTElectricityMeter device per meter on one shared MQTT connection
+    '''
+    def __init__(self, ports: dict, client, device_id: str, jobs: dict = JOBS, queue_len: int = 256):
+        '''
+        :param ports: {device path: {'meters': [addr, ...], 'speed': 9600}}, see GATEWAY_PORTS in config_example.py
+        :param client: MQTT client with the umqtt.simple interface, e.g. PahoClient
+        :param device_id: unique gateway id, replaces the WiFi MAC address in device identifiers
+        :param queue_len: readings waiting for the publisher, the oldest are dropped when full
+        '''
+        self.client = client
+        self.device_id = device_id
+        self.queue = queue.Queue(queue_len)
+        self.workers = [PortWorker(port, options['meters'], self._on_reading, options.get('speed', 9600), jobs)
+                        for port, options in ports.items()]
+        self.devices = {}  # addr: MQTTElectricityMeter, created by the publisher
+        self.readings = 0
+        self.published = 0  # readings with values out of their deadbands
+        self._stopping = threading.Event()
+        self._publisher = threading.Thread(target=self._publish, name='publisher', daemon=True)
+
+    def _on_reading(self, addr: int, name: str, value: dict):
+        while True:
+            try:
+                self.queue.put_nowait((addr, value))  # a port worker never waits for the broker
+                return
+            except queue.Full:
+                pass
+            try:
+                self.queue.get_nowait()
+                metrics.inc('queue_dropped')
+            except queue.Empty:
+                pass
+
+    def _device(self, addr: int) -> MQTTElectricityMeter:
+        device = self.devices.get(addr)
+        if device is None:  # created and used on the publisher thread only
+            device = self.devices[addr] = MQTTElectricityMeter(None, None, None, addr, self.client, persistent=True,
+                                                               device_id=self.device_id)
+        return device
+
+    def _done(self) -> bool:
+        '''
+        Stopped and readings taken by the workers before they stopped are published
+        '''
+        return self._stopping.is_set() and self.queue.empty() and not any(worker.is_alive() for worker in self.workers)
+
+    def _publish(self):
+        while not self._done():
+            try:
+                addr, value = self.queue.get(timeout=1)
+            except queue.Empty:
+                if self.devices:  # one connection for all devices
+                    next(iter(self.devices.values())).service()
+                continue
+            self.readings += 1
+            try:
+                if self._device(addr).send_changes(value):
+                    self.published += 1
+            except Exception as e:  # broker gone for good after the retries, keep the workers' readings coming
+                print(f'publishing for {addr} failed: {e}')
+            metrics.peak('queue_len', self.queue.qsize())
+
+    def start(self):
+        self._publisher.start()
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+        self._stopping.set()
+
+    def join(self, timeout: float | None = None):
+        for worker in self.workers:
+            worker.join(timeout)
+        self._publisher.join(timeout)
+
+    def run(self, duration_ms: int | None = None):
+        self.start()
+        try:
+            self._stopping.wait(None if duration_ms is None else duration_ms / 1000)
+        finally:
+            self.stop()
+            self.join(5)
+
+
+def main():
+    import signal
+    import uuid
+
+    print('Mercutel gateway')
+    for port, options in config.GATEWAY_PORTS.items():
+        print(f'{port}: {options["meters"]}')
+    device_id = getattr(config, 'GATEWAY_DEVICE_ID', None) or f'{uuid.getnode():012x}'
+    client = PahoClient(f'Mercutel gateway {device_id}', config.MQTT_SERVER, user=config.MQTT_USER,
+                        password=config.MQTT_PASSWORD)
+    gateway = Gateway(config.GATEWAY_PORTS, client, device_id)
+    signal.signal(signal.SIGTERM, lambda *args: gateway.stop())
+    try:
+        gateway.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
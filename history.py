@@ -0,0 +1,603 @@
+'''
+On-flash history of the energy registers and U/I/P: append-only segment files of delta and varint
+encoded blocks, hourly and daily rollups, time range queries through a block index
+'''
+import struct
+from array import array
+try:
+    import uos as os
+    import utime
+except ImportError:  # CPython
+    import os
+    import utime_compat as utime
+
+import bcd
+import crc16
+from ringbuf import EPOCH_OFFSET
+
+FIELDS = ('T1', 'T2', 'T3', 'T4', 'U', 'I', 'P')
+ROLLUP_FIELDS = ('n', 'T1', 'T2', 'T3', 'T4', 'U', 'U_min', 'U_max', 'I', 'I_min', 'I_max', 'P', 'P_min', 'P_max')
+# digits after the point kept on flash, as the meter reports them; means of rollups get one more
+DECIMALS = {'n': 0, 'T1': 2, 'T2': 2, 'T3': 2, 'T4': 2, 'U': 1, 'I': 2, 'P': 0}
+ROLLUP_DECIMALS = dict(DECIMALS, U_min=1, U_max=1, U=2, I_min=2, I_max=2, I=3, P_min=0, P_max=0, P=1)
+HOUR = 60 * 60
+DAY = 24 * HOUR
+RESOLUTIONS = ('raw', 'hour', 'day')
+CLOCK_SET = 1577836800  # 2020-01-01, the RTC of a board without NTP sync counts from 2000
+
+
+def _put_varint(buf: bytearray, value: int):
+    '''
+    Unsigned LEB128: 7 bits per byte, the high bit set on all bytes but the last
+    '''
+    while value > 0x7F:
+        buf.append(value & 0x7F | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _get_varint(data, pos: int) -> tuple:
+    '''
+    :return: (value, position after it)
+    '''
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _bisect(items, value: int) -> int:
+    '''
+    Number of sorted items not above value
+    '''
+    lo, hi = 0, len(items)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if items[mid] <= value:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class Series:
+    '''
+    Timestamped records in segment files named by the hex Unix time of their first record.
+    A segment is a sequence of blocks: header (payload length, payload CRC, time of the first record)
+    and records, each one a time delta, a mask of present fields and zigzag varint deltas of the
+    scaled values against the previous record of the block, so every block decodes on its own.
+    The block headers are the index: a time range query reads the headers of the segments in the range
+    and decodes only the blocks holding it. The oldest segments are deleted by age and total size.
+    '''
+    BLOCK_BYTES = 256  # payload limit, a query decodes at most one block before its range
+    SUFFIX = '.hs'
+    _HEADER = '<HHI'
+    _HEADER_LEN = 8
+
+    def __init__(self, path: str, fields: tuple = FIELDS, decimals: dict = DECIMALS, max_bytes: int = 128 * 1024,
+                 max_age_s: int | None = None, segment_bytes: int | None = None, flush_records: int = 8):
+        '''
+        :param path: directory of the segment files, created if missing
+        :param max_bytes: size of all segments, the oldest is deleted when a new one would exceed it
+        :param max_age_s: segments with all records older than this are deleted, kept by size only if None
+        :param segment_bytes: deletion unit, max_bytes / 16 by default
+        :param flush_records: records collected in RAM before a flash write
+        '''
+        self.path = path
+        self.fields = fields
+        self.decimals = decimals
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+        self.segment_bytes = segment_bytes or max(max_bytes // 16, 4 * self.BLOCK_BYTES)
+        self.flush_records = flush_records
+        self._scales = array('l', [bcd.POW10[decimals[name]] for name in fields])
+        self._max_record = 10 + 5 * len(fields)  # varints of time, mask and 32-bit values at worst
+        try:
+            os.mkdir(path)
+        except OSError:  # exists
+            pass
+        self._segments = sorted(name for name in os.listdir(path) if name.endswith(self.SUFFIX))  # oldest first
+        self._starts = [int(name[:-len(self.SUFFIX)], 16) for name in self._segments]
+        self._sizes = [os.stat(self._file_path(n))[6] for n in range(len(self._segments))]
+        self._indexes = {}  # segment name: (block times, block offsets), built from the block headers
+        self._file = None  # active segment, the last one
+        self._end = 0  # end of the complete blocks in the active segment
+        self._block = bytearray()  # open block payload
+        self._block_ts = 0
+        self._block_offset = 0
+        self._flushed = 0  # payload bytes of the open block on flash
+        self._prev = array('l', [0] * len(fields))  # scaled values of the open block's last record
+        self._last_ts = None
+        self._pending = 0  # records since the last flush
+        if self._segments:
+            self._open_active()
+
+    def _file_path(self, n: int) -> str:
+        return f'{self.path}/{self._segments[n]}'
+
+    def _open_active(self):
+        '''
+        Continue the last segment after its last valid block, a block torn by a reset is overwritten
+        '''
+        index = self._index(len(self._segments) - 1)
+        f = self._file = open(self._file_path(-1), 'r+b')
+        self._end = 0
+        while index[0]:
+            offset = index[1][-1]
+            records = self._read_block(f, offset)
+            if records is not None:
+                self._last_ts = records[-1][0]
+                f.seek(offset)
+                self._end = offset + self._HEADER_LEN + struct.unpack(self._HEADER, f.read(self._HEADER_LEN))[0]
+                break
+            index[0] = index[0][:-1]
+            index[1] = index[1][:-1]
+        self._sizes[-1] = self._end
+
+    def _index(self, n: int) -> list:
+        '''
+        [block times, block offsets] of segment n, cached for the active segment and the last one queried
+        '''
+        name = self._segments[n]
+        index = self._indexes.get(name)
+        if index is not None:
+            return index
+        times = array('L')
+        offsets = array('L')
+        offset = 0
+        size = self._sizes[n]
+        with open(self._file_path(n), 'rb') as f:
+            while offset + self._HEADER_LEN <= size:
+                f.seek(offset)
+                length, _, ts = struct.unpack(self._HEADER, f.read(self._HEADER_LEN))
+                if not length or offset + self._HEADER_LEN + length > size or times and ts < times[-1]:
+                    break  # torn tail or the rest of a longer block that was torn
+                times.append(ts)
+                offsets.append(offset)
+                offset += self._HEADER_LEN + length
+        for other in list(self._indexes):
+            if other != self._segments[-1]:
+                del self._indexes[other]
+        index = self._indexes[name] = [times, offsets]
+        return index
+
+    def _read_block(self, f, offset: int) -> list | None:
+        '''
+        Decode the block at offset: [(Unix time, scaled values as a list, None for absent fields)]
+        :return: None if the block is damaged
+        '''
+        f.seek(offset)
+        header = f.read(self._HEADER_LEN)
+        if len(header) < self._HEADER_LEN:
+            return None
+        length, crc, ts = struct.unpack(self._HEADER, header)
+        payload = f.read(length)
+        if len(payload) < length or crc16.crc16(payload) != crc:
+            return None
+        nfields = len(self.fields)
+        prev = [0] * nfields
+        records = []
+        pos = 0
+        while pos < length:
+            dt, pos = _get_varint(payload, pos)
+            mask, pos = _get_varint(payload, pos)
+            ts += dt
+            values = [None] * nfields
+            for n in range(nfields):
+                if mask & (1 << n):
+                    delta, pos = _get_varint(payload, pos)
+                    prev[n] += delta >> 1 if not delta & 1 else -((delta + 1) >> 1)
+                    values[n] = prev[n]
+            records.append((ts, values))
+        return records
+
+    def _encode(self, ts: int, values: dict, rec: bytearray) -> bool:
+        '''
+        Append a record to rec relative to the open block
+        :return: False if no field is present
+        '''
+        mask = 0
+        deltas = []
+        prev = self._prev
+        for n, name in enumerate(self.fields):
+            value = values.get(name)
+            if value is None:
+                continue
+            mask |= 1 << n
+            scaled = int(round(value * self._scales[n]))
+            delta = scaled - prev[n]
+            deltas.append(delta << 1 if delta >= 0 else (-delta << 1) - 1)  # zigzag: small magnitudes, small varints
+            prev[n] = scaled
+        if not mask:
+            return False
+        _put_varint(rec, ts - self._last_ts if self._block else 0)
+        _put_varint(rec, mask)
+        for delta in deltas:
+            _put_varint(rec, delta)
+        return True
+
+    def append(self, values: dict, ts: int | None = None):
+        '''
+        Store a record, timestamped now unless ts (Unix time) is given. Fields other than self.fields are ignored.
+        '''
+        if ts is None:
+            ts = int(utime.time()) + EPOCH_OFFSET
+        if self._last_ts is not None and ts < self._last_ts:
+            ts = self._last_ts  # times never decrease, a clock set back holds them until it catches up
+        if not self._block or len(self._block) + self._max_record > self.BLOCK_BYTES:
+            self._new_block(ts)
+        if not self._encode(ts, values, self._block):
+            return
+        self._last_ts = ts
+        self._pending += 1
+        if self._pending >= self.flush_records:
+            self.flush()
+
+    def _new_block(self, ts: int):
+        self.flush()
+        if self._block:
+            self._end = self._block_offset + self._HEADER_LEN + len(self._block)
+        if self._file is None or self._end + self._HEADER_LEN + self.BLOCK_BYTES > self.segment_bytes:
+            self._new_segment(ts)
+        self._block = bytearray()
+        self._block_ts = ts
+        self._block_offset = self._end
+        self._flushed = 0
+        for n in range(len(self._prev)):
+            self._prev[n] = 0
+
+    def _new_segment(self, ts: int):
+        if self._file is not None:
+            self._file.close()
+            self._indexes.pop(self._segments[-1], None)
+        name = f'{ts:08x}{self.SUFFIX}'
+        self._segments.append(name)
+        self._starts.append(ts)
+        self._sizes.append(0)
+        self._indexes[name] = [array('L'), array('L')]
+        self._file = open(self._file_path(-1), 'w+b')
+        self._end = 0
+        self._evict(ts)
+
+    def _evict(self, now: int):
+        while len(self._segments) > 1 and (sum(self._sizes) + self.segment_bytes > self.max_bytes or
+                                           self.max_age_s is not None and self._starts[1] <= now - self.max_age_s):
+            os.remove(self._file_path(0))
+            self._indexes.pop(self._segments.pop(0), None)
+            self._starts.pop(0)
+            self._sizes.pop(0)
+
+    def flush(self):
+        '''
+        Write records collected in RAM to flash: the new payload bytes first, then the header
+        that makes them valid, a reset in between keeps the block as it was
+        '''
+        block = self._block
+        if len(block) == self._flushed:
+            return
+        f = self._file
+        f.seek(self._block_offset + self._HEADER_LEN + self._flushed)
+        f.write(memoryview(block)[self._flushed:])
+        f.seek(self._block_offset)
+        f.write(struct.pack(self._HEADER, len(block), crc16.crc16(block), self._block_ts))
+        f.flush()
+        if not self._flushed:
+            times, offsets = self._indexes.setdefault(self._segments[-1], [array('L'), array('L')])
+            times.append(self._block_ts)
+            offsets.append(self._block_offset)
+        self._flushed = len(block)
+        self._sizes[-1] = max(self._sizes[-1], self._block_offset + self._HEADER_LEN + len(block))
+        self._pending = 0
+
+    @property
+    def size(self) -> int:
+        '''
+        Bytes on flash
+        '''
+        return sum(self._sizes)
+
+    @property
+    def last_ts(self) -> int | None:
+        return self._last_ts
+
+    def query(self, start: int, end: int, scaled: bool = False):
+        '''
+        Yield (Unix time, {field: value}) of the records from start to end inclusive, oldest first.
+        Do not append while iterating.
+        :param scaled: integer values, value * 10 ** decimals[field], e.g. for bcd.to_str()
+        '''
+        self.flush()
+        fields = self.fields
+        scales = self._scales
+        # the last segment and block starting before start may hold it, later ones may start at it
+        first = max(_bisect(self._starts, start - 1) - 1, 0)
+        for n in range(first, len(self._segments)):
+            if self._starts[n] > end:
+                return
+            times, offsets = self._index(n)
+            with open(self._file_path(n), 'rb') as f:
+                for block in range(max(_bisect(times, start - 1) - 1, 0), len(times)):
+                    if times[block] > end:
+                        return
+                    for ts, values in self._read_block(f, offsets[block]) or ():
+                        if ts > end:
+                            return
+                        if ts < start:
+                            continue
+                        yield ts, {name: value if scaled or scales[i] == 1 else value / scales[i]
+                                   for i, (name, value) in enumerate(zip(fields, values)) if value is not None}
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class Rollup:
+    '''
+    Aggregates of a period: the last energy registers, mean, min and max of U, I and P, and the sample count.
+    Rollup records are added as samples too, weighted by their count, so days are built from hours.
+    '''
+    def __init__(self, period_s: int, on_period, tz_offset_s: int = 0):
+        '''
+        :param on_period: callback(period start, record) for every closed period
+        :param tz_offset_s: periods start at local midnight and local hours
+        '''
+        self.period_s = period_s
+        self.on_period = on_period
+        self.tz_offset_s = tz_offset_s
+        self.start = None
+        self._reset()
+
+    def _reset(self):
+        self.last = {}
+        self.sums = {}
+        self.counts = {}
+        self.lows = {}
+        self.highs = {}
+
+    def add(self, ts: int, values: dict):
+        start = (ts + self.tz_offset_s) // self.period_s * self.period_s - self.tz_offset_s
+        if start != self.start:
+            self.close()
+            self.start = start
+        weight = values.get('n', 1)
+        for name in ('T1', 'T2', 'T3', 'T4'):
+            if name in values:
+                self.last[name] = values[name]
+        for name in ('U', 'I', 'P'):
+            value = values.get(name)
+            if value is None:
+                continue
+            self.sums[name] = self.sums.get(name, 0) + value * weight
+            self.counts[name] = self.counts.get(name, 0) + weight
+            low = values.get(name + '_min', value)
+            high = values.get(name + '_max', value)
+            if name not in self.lows or low < self.lows[name]:
+                self.lows[name] = low
+            if name not in self.highs or high > self.highs[name]:
+                self.highs[name] = high
+
+    def close(self):
+        '''
+        Report the current period, also when no sample of the next one has come yet
+        '''
+        if self.start is not None and (self.last or self.counts):
+            record = dict(self.last)
+            if self.counts:
+                record['n'] = max(self.counts.values())
+            for name, count in self.counts.items():
+                record[name] = self.sums[name] / count
+                record[name + '_min'] = self.lows[name]
+                record[name + '_max'] = self.highs[name]
+            self.on_period(self.start, record)
+        self.start = None
+        self._reset()
+
+
+class History:
+    '''
+    Raw samples and their hourly and daily rollups, each a Series in a subdirectory of path.
+    Rollups of periods cut short by a reset are rebuilt from the stored samples on start.
+    '''
+    def __init__(self, path: str = 'history', max_bytes: int = 256 * 1024, raw_days: int = 7, tz_offset_s: int = 0):
+        '''
+        :param max_bytes: flash for all of it: 5/8 samples, 1/4 hourly and 1/8 daily rollups
+        :param raw_days: age of the oldest samples kept, hourly rollups are kept for a year
+        '''
+        try:
+            os.mkdir(path)
+        except OSError:
+            pass
+        self.series = {
+            'raw': Series(f'{path}/raw', FIELDS, DECIMALS, max_bytes * 5 // 8, raw_days * DAY),
+            'hour': Series(f'{path}/hour', ROLLUP_FIELDS, ROLLUP_DECIMALS, max_bytes // 4, 366 * DAY, flush_records=1),
+            'day': Series(f'{path}/day', ROLLUP_FIELDS, ROLLUP_DECIMALS, max_bytes // 8, flush_records=1)
+        }
+        self.hourly = Rollup(HOUR, self._hour_done, tz_offset_s)
+        self.daily = Rollup(DAY, self._day_done, tz_offset_s)
+        self._replay(self.series['hour'], self.series['day'].last_ts, DAY, self.daily)
+        self._replay(self.series['raw'], self.series['hour'].last_ts, HOUR, self.hourly)
+
+    @staticmethod
+    def _replay(source: Series, last_ts: int | None, period_s: int, rollup: Rollup):
+        start = 0 if last_ts is None else last_ts + period_s
+        for ts, values in source.query(start, 0xFFFFFFFF):
+            rollup.add(ts, values)
+
+    def _hour_done(self, start: int, record: dict):
+        self.series['hour'].append(record, start)
+        self.daily.add(start, record)
+
+    def _day_done(self, start: int, record: dict):
+        self.series['day'].append(record, start)
+
+    def append(self, values: dict, ts: int | None = None):
+        '''
+        Store a reading of energy registers and/or U/I/P, other values are ignored
+        '''
+        if ts is None:
+            ts = int(utime.time()) + EPOCH_OFFSET
+        if ts < CLOCK_SET:
+            return  # no place in time for it
+        sample = {name: values[name] for name in FIELDS if values.get(name) is not None}
+        if sample:
+            self.series['raw'].append(sample, ts)
+            self.hourly.add(ts, sample)
+
+    def flush(self):
+        for series in self.series.values():
+            series.flush()
+
+    def query(self, start: int, end: int, resolution: str = 'raw', scaled: bool = False):
+        '''
+        Yield (Unix time, {field: value}), see Series.query(). Rollups of the current hour and day are not stored yet.
+        :param resolution: 'raw', 'hour' or 'day'
+        '''
+        return self.series[resolution].query(start, end, scaled)
+
+    def export_json(self, start: int, end: int, resolution: str = 'hour', chunk: int = 32):
+        '''
+        Yield compact column-wise JSON documents of up to chunk records for bulk transfer:
+        {"res":"raw","t0":1700000000,"dt":[0,10,...],"U":[230.1,...],"T1":{"5":12345.67},...}
+        Record times are t0 plus the running sum of dt. A field present in every record is a list,
+        one present in some is an object {row: value}, absent fields are left out.
+        Every document is read by a query of its own that resumes after the last exported record,
+        so samples may be appended and old segments deleted while the export is suspended.
+        '''
+        series = self.series[resolution]
+        fields = series.fields
+        decimals = series.decimals
+
+        def document() -> str:
+            parts = [f'"res":"{resolution}","t0":{times[0]},"dt":[0']
+            for n in range(1, len(times)):
+                parts.append(f',{times[n] - times[n - 1]}')
+            parts.append(']')
+            for name, column in zip(fields, columns):
+                if len(column) == len(times):
+                    parts.append(f',"{name}":[{",".join(text for _, text in column)}]')
+                elif column:
+                    sparse = ','.join('"%d":%s' % (row, text) for row, text in column)
+                    parts.append(f',"{name}":{{{sparse}}}')
+            return '{' + ''.join(parts) + '}'
+
+        done = 0  # records at time start already exported, times repeat while a clock set back catches up
+        while True:
+            times = []
+            columns = [[] for _ in fields]  # (row, text) of present values
+            skip = done
+            rows = series.query(start, end, True)
+            for ts, values in rows:
+                if skip and ts == start:
+                    skip -= 1
+                    continue
+                row = len(times)
+                times.append(ts)
+                for n, name in enumerate(fields):
+                    value = values.get(name)
+                    if value is not None:
+                        columns[n].append((row, bcd.to_str(value, decimals[name])))
+                if len(times) >= chunk:
+                    break
+            rows.close()  # no query stays open between documents
+            if not times:
+                return
+            last = times[-1]
+            done = (done if last == start else 0) + len(times) - _bisect(times, last - 1)
+            start = last
+            yield document()
+            if len(times) < chunk:
+                return
+
+    def export_csv(self, start: int, end: int, resolution: str = 'hour'):
+        '''
+        Yield CSV lines, a header first, empty cells for absent values
+        '''
+        series = self.series[resolution]
+        fields = series.fields
+        decimals = series.decimals
+        yield 'ts,' + ','.join(fields) + '\n'
+        for ts, values in series.query(start, end, True):
+            yield f'{ts},' + ','.join('' if values.get(name) is None else bcd.to_str(values[name], decimals[name])
+                                      for name in fields) + '\n'
+
+    def close(self):
+        for series in self.series.values():
+            series.close()
+
+
+class HistoryServer:
+    '''
+    Local HTTP endpoint: GET /history?from=<Unix time>&to=<Unix time>&res=raw|hour|day answered as CSV.
+    Never waits for a client: poll() serves at most one waiting request, call it from a scheduler job.
+    '''
+    def __init__(self, history: History, port: int = 8080, timeout_s: int = 5):
+        import socket  # only with the endpoint enabled
+
+        self.history = history
+        self.timeout_s = timeout_s
+        self._sock = socket.socket()
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(socket.getaddrinfo('0.0.0.0', port)[0][-1])
+        self._sock.listen(1)
+        self._sock.setblocking(False)
+
+    def _answer(self, request: bytes) -> tuple:
+        '''
+        :return: (status line, CSV lines)
+        '''
+        try:
+            method, target = request.decode().split(' ')[:2]
+        except (UnicodeError, ValueError):
+            return '400 Bad Request', ()
+        path, query = (target.split('?', 1) + [''])[:2]
+        if method != 'GET' or path != '/history':
+            return '404 Not Found', ()
+        params = {}
+        for item in query.split('&'):
+            name, value = (item.split('=', 1) + [''])[:2]
+            params[name] = value
+        try:
+            start = int(params.get('from', 0))
+            end = int(params['to']) if 'to' in params else int(utime.time()) + EPOCH_OFFSET
+        except ValueError:
+            return '400 Bad Request', ()
+        resolution = params.get('res', 'hour')
+        if resolution not in RESOLUTIONS:
+            return '400 Bad Request', ()
+        return '200 OK', self.history.export_csv(start, end, resolution)
+
+    def poll(self) -> bool:
+        '''
+        :return: True if a request was served
+        '''
+        try:
+            conn, _ = self._sock.accept()
+        except OSError:  # EAGAIN, no client waiting
+            return False
+        try:
+            conn.settimeout(self.timeout_s)
+            status, lines = self._answer(conn.recv(512).split(b'\r\n', 1)[0])
+            conn.sendall(f'HTTP/1.0 {status}\r\nContent-Type: text/csv\r\nConnection: close\r\n\r\n'.encode())
+            chunk = ''
+            for line in lines:  # streamed, a long range never sits in RAM
+                chunk += line
+                if len(chunk) >= 512:
+                    conn.sendall(chunk.encode())
+                    chunk = ''
+            if chunk:
+                conn.sendall(chunk.encode())
+        except OSError as e:
+            print(f'history request failed: {e}')
+        finally:
+            conn.close()
+        return True
+
+    def close(self):
+        self._sock.close()
@@ -1,16 +1,22 @@
+import bootprof  # first: the profiler measures the imports below
 import config
 from mercury import MercuryEnergyMeter
-from mqtt import MQTTElectricityMeter
 # import tric
+from metrics import registry as metrics
 import utils
 
+# MQTT, the offline ring, the scheduler or the event loop runtime, NTP and TRIC are imported
+# by the mode and the jobs using them, see bootprof.py for the cost of each stage
+bootprof.mark('driver imports')
+
 
 # if not config.DEBUG:
 #     def print(*args, **kwargs):
 #         pass
 
 def create_emeter(port_speed = 9600) -> MercuryEnergyMeter:
-    return MercuryEnergyMeter(config.ECOUNTER_NETWORK_ADDRESS, port_speed, config.PIN_TXE, config.PIN_RX, config.PIN_TX)
+    return MercuryEnergyMeter(config.ECOUNTER_NETWORK_ADDRESS, port_speed, config.PIN_TXE, config.PIN_RX, config.PIN_TX,
+                              cache_ttl_ms=MercuryEnergyMeter.CACHE_TTL_MS)
 
 def set_meter_speed(speed):
     em = create_emeter()
@@ -29,13 +35,49 @@ def create_emeter_auto_speed() -> MercuryEnergyMeter | None:
 
     return None
 
+def create_emeter_tuned() -> MercuryEnergyMeter:
+    '''
+    Start at the port speed negotiated on a previous boot, 600 baud if there is none.
+    With config.PORT_SPEED_NEGOTIATION negotiate if there is none or it fails.
+    '''
+    import autospeed
+
+    speed = autospeed.load_speed()
+    em = create_emeter(speed or 600)
+    if getattr(config, 'PORT_SPEED_NEGOTIATION', False) and (speed is None or em.serial_number is None):
+        speed = autospeed.negotiate_speed(em)
+        if speed is None:
+            print('Energy meter is not responding, using 600 baud')
+            em.use_port_speed(600)
+    print(f'Port speed: {em.port_speed}')
+    return em
+
+# job: (period_ms, phase_ms), phases spread the jobs, config.SCHEDULE overrides single entries
+SCHEDULE = {
+    'uip': (5 * 1000, 0),
+    'energy': (5 * 60 * 1000, 2 * 1000),
+    'date_time': (60 * 60 * 1000, 3 * 1000),
+    'sync_time': (24 * 60 * 60 * 1000, 4 * 1000),
+    'mqtt_service': (1000, 500),
+    'uip_sample': (1000, 100),  # with config.UIP_SAMPLING_MS, 'uip' then publishes aggregates of its period
+    'diagnostics': (5 * 60 * 1000, 5 * 1000),  # with config.DIAGNOSTICS
+    'history_http': (1000, 700)  # with config.HISTORY_HTTP_PORT
+}
+
+def print_date_time(dt: dict):
+    print(f"{dt['hh']:02}:{dt['mm']:02}:{dt['ss']:02}, {dt['dow']}, {dt['mo']} {dt['dd']}, 20{dt['yy']}")
+
 def main():
     print('Mercutel')
     print(f'Energy meter: {config.ECOUNTER_NETWORK_ADDRESS}')
 
-    speed = 600
-    # set_meter_speed(speed)
-    em = create_emeter(speed)
+    em = create_emeter_tuned()
+    bootprof.mark('meter')
+
+    from mqtt import MQTTElectricityMeter
+    from ringbuf import ReadingRing
+    from scheduler import Scheduler
+    bootprof.mark('mqtt imports')
 
     # while True:
     #     a = em.serial_number
@@ -43,43 +85,149 @@ def main():
     #     utils.sleep_s(1)
 
     # print(em.sync_date_time())
-    dt = em.date_time
-    if dt:
-        print(f"{dt['hh']:02}:{dt['mm']:02}:{dt['ss']:02}, {dt['dow']}, {dt['mo']} {dt['dd']}, 20{dt['yy']}")
-
-    mqttm = MQTTElectricityMeter(config.MQTT_SERVER, config.MQTT_USER, config.MQTT_PASSWORD)
 
-    n = 0
-    while True:
+    batched = getattr(config, 'MQTT_BATCHED', False)
+    sampling_ms = getattr(config, 'UIP_SAMPLING_MS', 0)
+    if sampling_ms:
+        from aggregate import STATS, UIPAggregator, sample_uip
+        aggregator = UIPAggregator()
+    diagnostics = getattr(config, 'DIAGNOSTICS', False)
+    history = None
+    if getattr(config, 'HISTORY', False):
+        from history import History
+        history = History(max_bytes=getattr(config, 'HISTORY_KB', 256) * 1024, tz_offset_s=config.TIMEZONE * 60 * 60)
+    mqttm = MQTTElectricityMeter(config.MQTT_SERVER, config.MQTT_USER, config.MQTT_PASSWORD, persistent=True,
+                                 batched=batched, qos=1 if batched else 0, aggregates=STATS if sampling_ms else (),
+                                 diagnostics=diagnostics, history=history)
+    # readings taken while the broker is unreachable, sent with their timestamps after reconnection
+    ring = ReadingRing(capacity=getattr(config, 'OFFLINE_BUFFER_RECORDS', 512))
+    bootprof.mark('mqtt')
+
+    def publish(state: dict):
+        print(state)
+        # only values out of their deadbands or due for a heartbeat go out
+        sent = mqttm.send_changes(state, ring)  # never waits for the network
+        print(f'sent: {sent}')
+
+    def record(values: dict):
+        # every reading goes to the on-flash history, published or not
+        if history is not None:
+            history.append(values)
+
+    def poll_uip():
+        uip = em.uip
+        if uip:
+            record(uip)
+            publish(uip)
+
+    def report_uip():
+        if aggregator.count:
+            record(aggregator.last)
+            publish(dict(aggregator.last, **aggregator.window()))
+
+    def sample():
+        sample_uip(em, aggregator, sampling_ms)
+
+    def poll_energy():
+        energy = em.energy
+        if energy:
+            record(energy)
+            energy12 = {tariff: value for tariff, value in energy.items() if tariff in config.TRIC_COUNTER_MAPPING}
+            publish(energy12)
+            # does not work until uPython ESP8266 port fix SSL implementation https://github.com/micropython/micropython-lib/issues/400
+            # tric.send_counter_readings(energy12)
+
+    def check_date_time():
+        dt = em.date_time
+        if dt:
+            print_date_time(dt)
+
+    jobs = {
+        'uip': report_uip if sampling_ms else poll_uip,
+        'energy': poll_energy,
+        'date_time': check_date_time,
+        'sync_time': utils.sync_time_once,
+        'mqtt_service': mqttm.service
+    }
+    if sampling_ms:
+        jobs['uip_sample'] = sample
+    if diagnostics:
+        jobs['diagnostics'] = lambda: mqttm.send_diagnostics(metrics.snapshot(('loop_lag',)))
+    if history is not None and getattr(config, 'HISTORY_HTTP_PORT', 0):
+        from history import HistoryServer
+        jobs['history_http'] = HistoryServer(history, config.HISTORY_HTTP_PORT).poll
+    schedule = dict(SCHEDULE, **getattr(config, 'SCHEDULE', {}))
+    sched = Scheduler()
+    for name, func in jobs.items():
+        period_ms, phase_ms = schedule[name]
+        sched.add(name, period_ms, phase_ms, func)
+    bootprof.mark('scheduler')
+    bootprof.report()
+    sched.run()
+
+def main_async():
+    '''
+    main() as event loop tasks: a slow or unreachable broker does not delay meter polling
+    '''
+    print('Mercutel')
+    print(f'Energy meter: {config.ECOUNTER_NETWORK_ADDRESS}')
 
-        if not n % 5:  # every 5 minutes
-            state = {}
+    em = create_emeter_tuned()
+    bootprof.mark('meter')
+
+    from mqtt import MQTTElectricityMeter
+    from ringbuf import ReadingRing
+    from runtime import Runtime
+    bootprof.mark('runtime imports')
+    batched = getattr(config, 'MQTT_BATCHED', False)
+    diagnostics = getattr(config, 'DIAGNOSTICS', False)
+    mqttm = MQTTElectricityMeter(config.MQTT_SERVER, config.MQTT_USER, config.MQTT_PASSWORD, persistent=True,
+                                 batched=batched, qos=1 if batched else 0, diagnostics=diagnostics)
+    ring = ReadingRing(capacity=getattr(config, 'OFFLINE_BUFFER_RECORDS', 512))
+    schedule = dict(SCHEDULE, **getattr(config, 'SCHEDULE', {}))
+    runtime = Runtime(em, mqttm, ring, {name: schedule[name] for name in ('uip', 'energy')}, schedule['sync_time'][0],
+                      diagnostics_ms=schedule['diagnostics'][0] if diagnostics else None)
+    bootprof.mark('runtime')
+    bootprof.report()
+    runtime.run()
+
+def main_bus():
+    '''
+    Several meters on one RS-485 line, each published as a separate device
+    '''
+    from bus import BusManager
+    from mqtt import MQTTElectricityMeter
+    from transport import UARTTransport
+    bootprof.mark('bus imports')
 
-            uip = em.uip
-            if uip:
-                state.update(uip)
+    print('Mercutel')
+    print(f'Energy meters: {config.ECOUNTER_NETWORK_ADDRESSES}')
 
-            energy = em.energy
-            if energy:
-                energy12 = {tariff: value for tariff, value in energy.items() if tariff in config.TRIC_COUNTER_MAPPING}
-                state.update(energy12)
-                # if not n % (24 * 60): # 1 day
-                #     # does not work until uPython ESP8266 port fix SSL implementation https://github.com/micropython/micropython-lib/issues/400
-                #     tric.send_counter_readings(energy12)
+    mqttm = {}
 
-            print(state)
-            if state:
-                print('before send_update')
-                mqttm.send_update(state)
-                print('after send_update')
+    def on_reading(addr, name, value):
+        print(addr, value)
+        mqttm[addr].send_update(value)
 
-        n += 1
-        print('sleep 60')
-        utils.sleep_s(60)
+    transport = UARTTransport(config.PIN_TXE, config.PIN_RX, config.PIN_TX)
+    bus = BusManager(transport, 9600, on_reading)  # all meters on the line use one speed
+    client = None
+    for addr in config.ECOUNTER_NETWORK_ADDRESSES:
+        bus.add_meter(addr, {'uip': (5 * 60 * 1000, 1), 'energy': (5 * 60 * 1000, 0)})
+        mqttm[addr] = MQTTElectricityMeter(config.MQTT_SERVER, config.MQTT_USER, config.MQTT_PASSWORD, addr, client)
+        client = mqttm[addr]._mqtt
+    bootprof.mark('meters')
+    bootprof.report()
+    bus.run()
 
 if __name__ == '__main__':
     try:
-        main()
+        if getattr(config, 'ECOUNTER_NETWORK_ADDRESSES', None):
+            main_bus()
+        elif getattr(config, 'ASYNC_RUNTIME', False):
+            main_async()
+        else:
+            main()
     except KeyboardInterrupt:
         import uos
         import machine
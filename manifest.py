@@ -0,0 +1,32 @@
+# MicroPython frozen bytecode manifest: the firmware modules are compiled into the flash image,
+# imports then cost no compilation and code and constants stay out of the heap.
+# Build from the MicroPython tree:
+#   make -C ports/esp8266 BOARD=ESP8266_GENERIC FROZEN_MANIFEST=/path/to/Mercutel/manifest.py
+# and upload only main.py and config.py to the board filesystem. Without a custom firmware the same
+# modules can be precompiled with mpy-cross and uploaded as .mpy files.
+include("$(PORT_DIR)/boards/manifest.py")
+require("umqtt.simple")
+
+# modules of the board firmware, not the CPython tools (bench, emulator, gateway, tric, utime_compat)
+for name in (
+    "aggregate",
+    "autospeed",
+    "bcd",
+    "bootprof",
+    "bus",
+    "crc16",
+    "deadband",
+    "frame",
+    "history",
+    "mercury",
+    "metrics",
+    "mqtt",
+    "retry",
+    "ringbuf",
+    "runtime",
+    "scanner",
+    "scheduler",
+    "transport",
+    "utils",
+):
+    module(name + ".py")
@@ -1,14 +1,17 @@
-from machine import Pin, UART
-import utime
 import struct
-import math
-import uos
-
+try:
+    import utime
+except ImportError:  # CPython
+    import utime_compat as utime
+
+import bcd
+import crc16
+from frame import FrameDecoder, HEADER_LEN, MAX_BODY, OVERHEAD
+from metrics import registry as metrics
+from retry import RetryPolicy
+from transport import UARTTransport
 import utils
 
-DOWS = ('Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Holiday')
-MONTHS = ('January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November', 'December')
-
 
 class MercuryEnergyMeter:
     '''
@@ -23,143 +26,363 @@ class MercuryEnergyMeter:
         GET_UIP = 0x63
 
     SUPPORTED_PORT_SPEEDS = (9600, 4800, 2400, 1200, 600)
-
-    class UART0Ctx:
-        def __init__(self, em):
-            self._em = em
-
-        def __enter__(self):
-            self._em._get_UART0()
-
-        def __exit__(self, *args):
-            self._em._release_UART0()
-
-    def __init__(self, addr: int, port_speed: int, pin_txe: int, pin_rx: int, pin_tx: int):
+    SPEED_DIVISORS = {9600: 0, 4800: 1, 2400: 2, 1200: 3, 600: 4}  # speed: SET_SPEED argument, log2(9600 / speed)
+    READABLE = ('serial_number', 'energy', 'uip', 'date_time')
+    # property: (command, answer format)
+    QUERIES = {
+        'serial_number': (COMMAND.GET_SERIAL_NUMBER, '>I'),
+        'energy': (COMMAND.GET_ENERGY, '16s'),
+        'uip': (COMMAND.GET_UIP, '7s'),
+        'date_time': (COMMAND.GET_DATE_TIME, '7s')
+    }
+    _REQUEST_METRICS = {cmd: f'requests_{name}' for name, (cmd, _) in QUERIES.items()}
+    # suggested cache_ttl_ms: property: ms, None never expires
+    CACHE_TTL_MS = {'serial_number': None, 'energy': 30 * 1000, 'uip': 1000, 'date_time': 500}
+    FRAME_GAP_MS = 10  # upper bound of the pause between a reply and the next request
+
+    def __init__(self, addr: int, port_speed: int, pin_txe: int | None = None, pin_rx: int | None = None,
+                 pin_tx: int | None = None, transport=None, retry_policy: RetryPolicy | None = None,
+                 cache_ttl_ms: dict | None = None):
+        '''
+        :param transport: line to the meter, ESP8266 UART0 on the given pins by default
+        :param retry_policy: request attempts, deadline and backoff
+        :param cache_ttl_ms: {property: ms} to answer repeated reads from memory, see CACHE_TTL_MS
+        '''
         self.addr = addr
-        self._pin_txe = Pin(pin_txe, Pin.OUT, value=0)  # RS-485 tx/rx control
-        self._pin_tx = Pin(pin_tx, Pin.OUT)
-        self._pin_rx = Pin(pin_rx, Pin.IN, Pin.PULL_UP)
-        self._port_speed = port_speed
-        self._uart = UART(0)
-        self._uart_ctx = self.UART0Ctx(self)
-
-    def _uart_init(self):
-        self._uart.init(baudrate=self._port_speed, bits=8, parity=None, stop=1, tx=self._pin_tx, rx=self._pin_rx, timeout=400, rxbuf=50)
-
-    def _get_UART0(self):
-        uos.dupterm(None, 1)  # disable stdout to UART0, release UART0.read()
-        # micropython.kbd_intr(-1)
-        self._uart_init()
-
-    def _release_UART0(self):
-        uos.dupterm(UART(0, 115200), 1)  # redirect all output to UART0, breaks UART0.read()
-        # micropython.kbd_intr(3)
+        self.retry_policy = retry_policy or RetryPolicy()
+        if transport is None:
+            transport = UARTTransport(pin_txe, pin_rx, pin_tx)
+        self._transport = transport
+        self.cache_ttl_ms = cache_ttl_ms or {}
+        self._cache = {}  # property: (value, ticks_ms, address)
+        self._pending = {}  # property: [asyncio.Event, value] of a request in flight
+        self._lock = None  # asyncio.Lock, one request on the line at a time across tasks, created by the first task
+        self.use_port_speed(port_speed)
+        self.response_time = None  # [us to the first byte, us to the last byte] of the last answer, reused
+        # buffers of the request path, a steady-state poll allocates nothing until decoding the values
+        self._tx = bytearray(OVERHEAD + MAX_BODY)
+        self._tx_view = memoryview(self._tx)
+        self._tx_query = self._tx_view[:OVERHEAD]  # request without a body
+        self._rx = bytearray(OVERHEAD + MAX_BODY)
+        self._decoder = FrameDecoder(addr, 0, 0)
+        self._response_time = [0, 0]
 
     @staticmethod
     def _crc16(data: bytes) -> int:
         '''
         CRC-16 Modbus hashing algorithm
         '''
-        crc = 0xFFFF
-        for byte in data:
-            crc ^= byte
-            for _ in range(8):
-                lsb = crc & 1
-                crc >>= 1
-                if lsb:
-                    crc ^= 0xA001
-        return crc
+        return crc16.crc16(data)
 
     @staticmethod
     def bcd_decode(data: bytes, decimals: int = 0):
         '''
-        Decode BCD number
+        Decode BCD number, see bcd.decode() for the scaled integer
         '''
-        res = 0
-        shift = 10**(-decimals)
-        for b in reversed(data):
-            res += (b & 0x0F) * shift
-            shift *= 10
-            res += (b >> 4) * shift
-            shift *= 10
-        return res
+        value = bcd.decode(data)
+        return value / bcd.POW10[decimals] if decimals else value
 
     @staticmethod
     def bcd_encode(value: int, b_size: int) -> bytes:
         '''
         Encode unsigned int to BCD
         '''
-        assert value >= 0
-        res = bytearray(b_size)
-        sval = str(value)
-        for n in range(-1, -b_size * 2 - 1, -1):
-            digit = int(sval[n]) if n >= -len(sval) else 0
-            res[n // 2] |= digit if n % 2 else digit << 4
-        return bytes(res)
+        return bcd.encode(value, b_size)
+
+    def _frame_gap_us(self) -> int:
+        '''
+        Time left to keep the line silent for 3.5 characters (but not longer than FRAME_GAP_MS) after the last reply
+        '''
+        gap_us = min(35 * 1000000 // self._port_speed, self.FRAME_GAP_MS * 1000)
+        return gap_us - utime.ticks_diff(utime.ticks_us(), self._transport.last_rx_us)
+
+    def _wait_frame_gap(self):
+        gap_us = self._frame_gap_us()
+        if gap_us > 0:
+            utime.sleep_us(gap_us)
 
     def _write(self, data: bytes):
-        self._pin_txe.on()
-        self._uart.write(data)
-        bytes_per_s = self._port_speed / 10  # 10 baud per byte
-        delay_us = len(data) / bytes_per_s * 1000000
-        utime.sleep_us(int(delay_us))  # uart_wait_tx_done simulation
-        self._pin_txe.off()
+        self._wait_frame_gap()
+        self._transport.write(data)
 
     def _send_data(self, cmd: int, body: bytes | None, addr: int | None = None):
         # ADDR-CMD-BODY-CRC
-        if addr is None:
-            addr = self.addr
-        packet = struct.pack('>I', addr) + struct.pack('B', cmd)
-        if body is not None:
-            packet += body
-        packet += struct.pack('<H', self._crc16(packet))
-        self._write(packet)
-
-    def _read_data(self, cmd: int, nbytes_body: int):
-        # ADDR-CMD-BODY-CRC
-        total_len = 4 + 1 + nbytes_body + 2
-
-        answer = self._uart.read(total_len)
+        packet = self._tx
+        struct.pack_into('>IB', packet, 0, self.addr if addr is None else addr, cmd)
+        size = HEADER_LEN
+        if body:
+            size += len(body)
+            packet[HEADER_LEN:size] = body
+        struct.pack_into('<H', packet, size, crc16.crc16(packet, size))
+        self._write(self._tx_view[:size + 2] if body else self._tx_query)
+
+    def _answered(self, first_us: int | None, last_us: int, sent_us: int):
+        self._transport.last_rx_us = utime.ticks_us()
+        if first_us is None:
+            self.response_time = None
+            return
+        self.response_time = self._response_time
+        self.response_time[0] = utime.ticks_diff(first_us, sent_us)
+        self.response_time[1] = utime.ticks_diff(last_us, sent_us)
+
+    def _read_deadline_us(self, timeout_us: int) -> int:
+        '''
+        Longest time a reply may take: the wait for its first byte, the longest frame at the current speed
+        and the silence that ends it. A line that never falls silent, e.g. babbling or echoing, ends there.
+        '''
+        transport = self._transport
+        return timeout_us + (OVERHEAD + MAX_BODY) * transport.byte_time_us() + transport.silence_us()
 
-        if not answer:
-            return 'no answer'
+    def _read_data(self, cmd: int, nbytes_body: int, timeout_ms: int | None = None):
+        # ADDR-CMD-BODY-CRC
+        decoder = self._decoder
+        decoder.reset(self.addr, cmd, nbytes_body)
+        rx = self._rx
+        transport = self._transport
+        poll_us = transport.byte_time_us()
+        timeout_us = (transport.timeout if timeout_ms is None else timeout_ms) * 1000  # wait for the first byte
+        deadline_us = self._read_deadline_us(timeout_us)
+        sent_us = last_us = utime.ticks_us()
+        first_us = None
+        expired = False
+        while True:
+            pending = transport.any()
+            if pending:
+                last_us = utime.ticks_us()
+                if first_us is None:
+                    first_us = last_us
+                    timeout_us = transport.silence_us()  # then only until the end of the frame
+                count = transport.readinto(rx, min(pending, len(rx)))
+                if count and decoder.feed(rx, count):
+                    break
+                if utime.ticks_diff(last_us, sent_us) >= deadline_us:
+                    expired = True
+                    break
+            elif utime.ticks_diff(utime.ticks_us(), last_us) >= timeout_us:
+                break
+            else:
+                utime.sleep_us(poll_us)
+        self._answered(first_us, last_us, sent_us)
 
-        alen = len(answer)
-        if alen < 7:
-            return f'too short answer of {alen} bytes: {answer}'
+        return self._decoded(decoder, expired)
 
-        r_crc = struct.unpack('<H', answer[-2:])[0]
-        if r_crc != self._crc16(answer[:-2]):
-            return 'wrong CRC'
+    async def _read_data_async(self, cmd: int, nbytes_body: int, timeout_ms: int | None = None):
+        '''
+        _read_data() that lets other tasks run while waiting for bytes
+        '''
+        decoder = self._decoder  # requests of a meter are serialized by its lock
+        decoder.reset(self.addr, cmd, nbytes_body)
+        transport = self._transport
+        wait_us = (transport.timeout if timeout_ms is None else timeout_ms) * 1000
+        deadline_us = self._read_deadline_us(wait_us)
+        sent_us = utime.ticks_us()
+        first_us = last_us = None
+        expired = False
+        while True:
+            data = await transport.read_async(OVERHEAD + nbytes_body, wait_us)
+            if not data:
+                break
+            last_us = utime.ticks_us()
+            if first_us is None:
+                first_us = last_us
+                wait_us = transport.silence_us()
+            if decoder.feed(data):
+                break
+            if utime.ticks_diff(last_us, sent_us) >= deadline_us:
+                expired = True
+                break
+        self._answered(first_us, last_us or sent_us, sent_us)
+
+        return self._decoded(decoder, expired)
 
-        r_addr, r_cmd = struct.unpack('>IB', answer[:5])
-        if r_addr != self.addr:
-            return 'wrong addr'
+    @staticmethod
+    def _decoded(decoder: FrameDecoder, expired: bool = False):
+        '''
+        Answer body or error message, counted in metrics.
+        The body is a view of the decoder buffer, unpack it before the next request.
+        :param expired: the read deadline passed while bytes kept arriving
+        '''
+        if decoder.crc_errors:
+            metrics.inc('crc_errors', decoder.crc_errors)
+        if decoder.frame is not None:
+            return decoder.body
+        if expired:
+            metrics.inc('timeouts')
+            return f'no answer within the deadline, {decoder.received} bytes received'
+        error = decoder.error()
+        if not decoder.received:
+            metrics.inc('timeouts')
+        elif decoder.foreign():
+            metrics.inc('wrong_address')
+        return error
 
-        if r_cmd != cmd:
-            return 'wrong cmd'
+    @staticmethod
+    def _unpack(answer, answer_format: str):
+        if isinstance(answer, str):  # error message
+            return answer
+        if len(answer) != struct.calcsize(answer_format):
+            return 'wrong answer length'
+        return struct.unpack(answer_format, answer)
+
+    def _request(self, cmd: int, body: bytes | None = None, answer_format: str = '', timeout_ms: int | None = None):
+        '''
+        Single request attempt
+        :return: unpacked answer or error message
+        '''
+        with self._transport:
+            self._send_data(cmd, body)
+            answer = self._read_data(cmd, struct.calcsize(answer_format), timeout_ms)
+        return self._unpack(answer, answer_format)
+
+    async def _request_async(self, cmd: int, body: bytes | None = None, answer_format: str = '', timeout_ms: int | None = None):
+        asyncio = utils.load_module('uasyncio', 'asyncio')
+        with self._transport:
+            gap_us = self._frame_gap_us()
+            if gap_us > 0:
+                await asyncio.sleep(gap_us / 1000000)
+            self._send_data(cmd, body)
+            answer = await self._read_data_async(cmd, struct.calcsize(answer_format), timeout_ms)
+        return self._unpack(answer, answer_format)
+
+    def _attempts(self, cmd: int) -> int:
+        '''
+        Attempts allowed for a request, none while the circuit is open
+        '''
+        metrics.inc(self._REQUEST_METRICS.get(cmd, 'requests_other'))
+        breaker = self.retry_policy.breaker
+        if not breaker.allow():
+            print(f'meter {self.addr} is not responding, request skipped')
+            return 0
+        return 1 if breaker.state == breaker.HALF_OPEN else self.retry_policy.attempts_for(cmd)
+
+    def _succeeded(self, answer):
+        metrics.observe('rtt', self.response_time[1] // 1000)
+        self.retry_policy.observe(self._port_speed, self.response_time[0])
+        self.retry_policy.breaker.success()
+        return answer
+
+    def _retry_delay_ms(self, n: int, attempts: int, start: int, timeout: int, answer: str) -> int | None:
+        '''
+        Pause after failed attempt number n
+        :return: None if there is no attempt left
+        '''
+        print(f'#{n}: {answer}')
+        utils.watchdog.feed()
+        if n == attempts:
+            return None
+        delay = self.retry_policy.delay_ms(n)
+        if utime.ticks_diff(utime.ticks_ms(), start) + delay + timeout > self.retry_policy.deadline_ms:
+            return None  # the next attempt would not fit into the deadline
+        metrics.inc('retries')
+        return delay
 
-        return answer[5:-2]
+    def _talk(self, cmd: int, body: bytes | None = None, answer_format: str = ''):
+        attempts = self._attempts(cmd)
+        start = utime.ticks_ms()
+        for n in range(1, attempts + 1):
+            timeout = self.retry_policy.receive_timeout_ms(self._port_speed)
+            answer = self._request(cmd, body, answer_format, timeout)
+            if not isinstance(answer, str):
+                return self._succeeded(answer)
+            delay = self._retry_delay_ms(n, attempts, start, timeout, answer)
+            if delay is None:
+                break
+            utime.sleep_ms(delay)
+        if attempts:
+            self.retry_policy.breaker.failure()
+        return None
+
+    async def _talk_async(self, cmd: int, body: bytes | None = None, answer_format: str = ''):
+        asyncio = utils.load_module('uasyncio', 'asyncio')
+        attempts = self._attempts(cmd)
+        start = utime.ticks_ms()
+        for n in range(1, attempts + 1):
+            timeout = self.retry_policy.receive_timeout_ms(self._port_speed)
+            answer = await self._request_async(cmd, body, answer_format, timeout)
+            if not isinstance(answer, str):
+                return self._succeeded(answer)
+            delay = self._retry_delay_ms(n, attempts, start, timeout, answer)
+            if delay is None:
+                break
+            await asyncio.sleep(delay / 1000)
+        if attempts:
+            self.retry_policy.breaker.failure()
+        return None
+
+    def read_many(self, names) -> dict:
+        '''
+        Read several properties within a single bus session
+        :param names: property names from READABLE, e.g. ('uip', 'energy', 'date_time')
+        :return: {name: value}, value is None if the meter did not answer
+        '''
+        for name in names:
+            assert name in self.READABLE, name
+        with self._transport:
+            return {name: getattr(self, name) for name in names}
 
+    async def read_many_async(self, names) -> dict:
+        '''
+        read_many() that lets other tasks run while the meter answers
+        '''
+        readings = {}
+        with self._transport:
+            for name in names:
+                readings[name] = await self.read_async(name)
+        return readings
 
-    def _talk(self, cmd: int, body: bytes | None = None, answer_format: str = ''):
-        for n in range(1, 100):
-            with self._uart_ctx:
-                self._send_data(cmd, body)
-                expected_nbytes = struct.calcsize(answer_format)
-                answer = self._read_data(cmd, expected_nbytes)
+    async def read_async(self, name: str, max_age_ms: int | None = -1):
+        '''
+        read() for tasks: concurrent readers of a property share one request in flight
+        '''
+        value = self._cached(name, max_age_ms)
+        if value is not None:
+            return value
+        pending = self._pending.get(name)
+        if pending is not None:
+            await pending[0].wait()
+            return pending[1]
+        asyncio = utils.load_module('uasyncio', 'asyncio')
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        pending = self._pending[name] = [asyncio.Event(), None]
+        try:
+            cmd, answer_format = self.QUERIES[name]
+            async with self._lock:
+                value = getattr(self, '_decode_' + name)(await self._talk_async(cmd, answer_format=answer_format))
+            self._store(name, value)
+            pending[1] = value
+        finally:
+            del self._pending[name]
+            pending[0].set()
+        return value
+
+    def _cached(self, name: str, max_age_ms: int | None = -1):
+        '''
+        :param max_age_ms: -1 for the configured TTL, None for any age
+        '''
+        if max_age_ms == -1:
+            if name not in self.cache_ttl_ms:
+                return None
+            max_age_ms = self.cache_ttl_ms[name]
+        entry = self._cache.get(name)
+        if entry is None or entry[2] != self.addr:
+            return None
+        if max_age_ms is not None and utime.ticks_diff(utime.ticks_ms(), entry[1]) >= max_age_ms:
+            return None
+        return entry[0]
 
-            utime.sleep_ms(10)  # maintains timeout between requests
+    def _store(self, name: str, value):
+        if value is not None and name in self.cache_ttl_ms:
+            self._cache[name] = (value, utime.ticks_ms(), self.addr)
 
-            if isinstance(answer, str):  # error message
-                error = answer
-            else:
-                if len(answer) == expected_nbytes:
-                    return struct.unpack(answer_format, answer)
-                else:
-                    error = 'wrong answer length'
-            print(f'#{n}: {error}')
-            utils.watchdog.feed()
+    def invalidate(self, name: str | None = None):
+        '''
+        Drop a cached property, all of them by default
+        '''
+        if name is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(name, None)
 
     def _ping_address(self, addr: int):
         '''
@@ -167,15 +390,6 @@ class MercuryEnergyMeter:
         '''
         self._send_data(self.COMMAND.GET_SERIAL_NUMBER, None, addr=addr)
 
-    def _any_answer(self) -> bool:
-        '''
-        Check for ping response
-        '''
-        signal = bool(self._uart.any())
-        if signal:
-            self._uart.read()  # clear rx buffer
-        return signal
-
     @property
     def port_speed(self):
         return self._port_speed
@@ -187,59 +401,92 @@ class MercuryEnergyMeter:
         '''
         # ADDR-CMD-speed[1]-CRC -> ADDR-CMD-CRC
         assert speed in self.SUPPORTED_PORT_SPEEDS
-        spd_div = int(math.log(9600 // speed, 2))
-        data = bytes([spd_div])
-        answ = self._talk(self.COMMAND.SET_SPEED, data)
-        # if answ is not None:  # doesn't work, always unreadable response
+        data = bytes((self.SPEED_DIVISORS[speed],))
+        # single attempt: the meter answers at the new speed, so the answer is never readable
+        self._request(self.COMMAND.SET_SPEED, data)
+        self.use_port_speed(speed)
+        self.invalidate()
+
+    def use_port_speed(self, speed: int):
+        '''
+        Change the local port speed only, the meter keeps its own
+        '''
         self._port_speed = speed
+        self._transport.set_speed(speed)
+
+    def read(self, name: str, max_age_ms: int | None = -1):
+        '''
+        Property value, from the cache while it is fresh enough. Cached values are shared, do not modify them.
+        :param max_age_ms: oldest acceptable cached value, 0 to always ask the meter, by default the TTL from cache_ttl_ms
+        '''
+        value = self._cached(name, max_age_ms)
+        if value is not None:
+            return value
+        cmd, answer_format = self.QUERIES[name]
+        value = getattr(self, '_decode_' + name)(self._talk(cmd, answer_format=answer_format))
+        self._store(name, value)
+        return value
 
     @property
     def energy(self) -> dict | None:
+        return self.read('energy')
+
+    @property
+    def uip(self) -> dict | None:
+        return self.read('uip')
+
+    @property
+    def serial_number(self) -> int | None:
+        return self.read('serial_number')
+
+    @property
+    def date_time(self) -> dict | None:
+        return self.read('date_time')
+
+    # values are decoded as exact integers and scaled once: 4.56, never 4.5600000000000005
+    @staticmethod
+    def _decode_energy(data) -> dict | None:
         # ADDR-CMD-CRC -> ADDR-CMD-count[BCD,4]*4-CRC
-        data = self._talk(self.COMMAND.GET_ENERGY, answer_format='16B')
         if data is None:
             return None
 
-        res = tuple(self.bcd_decode(data[n: n + 4], 2) for n in range(0, len(data), 4))
-        return dict(zip(('T1', 'T2', 'T3', 'T4'), res))
+        t1, t2, t3, t4 = bcd.decode_fields(data[0], (4, 4, 4, 4))
+        return {'T1': t1 / 100, 'T2': t2 / 100, 'T3': t3 / 100, 'T4': t4 / 100}
 
-    @property
-    def uip(self) -> dict | None:
+    @staticmethod
+    def _decode_uip(data) -> dict | None:
         # ADDR-CMD-CRC -> ADDR-CMD-V[BCD,2]-I[BCD,2]-P[BCD,3]-CRC
-        data = self._talk(self.COMMAND.GET_UIP, answer_format='7B')
         if data is None:
             return None
 
-        res = {
-            'U': self.bcd_decode(data[:2], 1),
-            'I': self.bcd_decode(data[2:4], 2),
-            'P': self.bcd_decode(data[4:], 0)
-        }
-        return res
+        u, i, p = bcd.decode_fields(data[0], (2, 2, 3))
+        return {'U': u / 10, 'I': i / 100, 'P': p}
 
-    @property
-    def serial_number(self) -> int | None:
+    @staticmethod
+    def _decode_serial_number(data) -> int | None:
         # ADDR-CMD-CRC -> ADDR-CMD-serial[4]-CRC
-        data = self._talk(self.COMMAND.GET_SERIAL_NUMBER, answer_format='>I')
         return data[0] if data is not None else None
 
-    @property
-    def date_time(self) -> dict | None:
+    @staticmethod
+    def _decode_date_time(data) -> dict | None:
         # ADDR-CMD-CRC -> ADDR-CMD-timedate[BCD,7]-CRC
-        data = self._talk(self.COMMAND.GET_DATE_TIME, answer_format='7B')
         if data is None:
             return None
 
-        dec_data = list(map(lambda b: self.bcd_decode([b]), data))
-        dec_data[0] = DOWS[dec_data[0]]
-        dec_data[5] = MONTHS[dec_data[5] - 1]
-        return dict(zip(('dow', 'hh', 'mm', 'ss', 'dd', 'mo', 'yy'), dec_data))
+        dow, hh, mm, ss, dd, mo, yy = bcd.decode_fields(data[0], (1, 1, 1, 1, 1, 1, 1))
+        # names are constants of the rare date and time path, frozen bytecode keeps them in flash
+        dows = ('Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Holiday')
+        months = ('January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October',
+                  'November', 'December')
+        return {'dow': dows[dow], 'hh': hh, 'mm': mm, 'ss': ss, 'dd': dd, 'mo': months[mo - 1], 'yy': yy}
 
     def set_date_time(self, yy: int, mo: int, dd: int, hh: int, mm: int, ss: int, dow: int) -> bool:
         # ADDR-CMD-timedate[BCD,7]-CRC -> ADDR-CMD-CRC
-        td = [(dow + 1) % 7, hh, mm, ss, dd, mo, yy]
-        data = bytes(map(lambda v: self.bcd_encode(v, 1)[0], td))
+        data = bytearray(7)
+        for n, value in enumerate(((dow + 1) % 7, hh, mm, ss, dd, mo, yy)):
+            bcd.encode_into(data, n, value, 1)
         answer = self._talk(self.COMMAND.SET_DATE_TIME, data)
+        self.invalidate('date_time')
         return answer is not None
 
     def sync_date_time(self) -> bool:
@@ -249,47 +496,14 @@ class MercuryEnergyMeter:
         tm = utils.sync_time()
         return self.set_date_time(*tm[:-1])
 
-    def bruteforce_network_address(self, start: int = 0, stop: int = 2**32 - 1, continue_session: bool = True):
-        '''
-        Search for occupied network addresses
-        '''
-        FILE = 'bf.log'
-        r_start = start
-        found_addresses = set()
-        fmode = 'r+' if continue_session and FILE in uos.listdir() else 'w+'
-        with open(FILE, fmode) as f:
-            if continue_session:
-                addr = None
-                for line in f:  # read the last line
-                    parts = line.rstrip('\n').split('-')
-                    addr = int(parts[0])
-                    if len(parts) == 2 and 'found' in parts[1]:
-                        found_addresses.add(addr)
-                if addr is not None:
-                    r_start = max(start, addr + 1)
-
-            while True:
-                print(f'Searching for addresses in range [{r_start}, {stop}]')
-                for addr in range(r_start, stop + 1):
-                    with self._uart_ctx:
-                        self._ping_address(addr)
-                        utime.sleep_ms(10)
-                        answer = self._any_answer()
-                    if answer:
-                        addr_found = addr - 1  # asking too fast so that's an answer to the previous request
-                        print(f'Gotcha! Address {addr_found} is found')
-                        f.write(f'{addr_found} - Gotcha! Address is found\n')
-                        f.flush()
-                        found_addresses.add(addr_found)
-                    if not addr % 1000:
-                        it_num = stop - r_start + 1
-                        progress = ((addr - r_start + 1) / it_num if it_num > 0 else 1) * 100
-                        status = f'{addr}, {progress:.1f}%'
-                        if found_addresses:
-                            status += f', found addresses: {found_addresses}'
-                        print(status)
-                    if addr > r_start and not addr % 50000:
-                        f.write(f'{addr}\n')  # save progress
-                        f.flush()
-                    utils.watchdog.feed()
-                r_start = start
+    def bruteforce_network_address(self, start: int | None = None, stop: int = 2**32 - 1, continue_session: bool = True) -> set:
+        '''
+        Search for occupied network addresses, likely ranges first unless start is given
+        :return: confirmed addresses
+        '''
+        from scanner import AddressScanner, PRIORITY_RANGES
+
+        ranges = PRIORITY_RANGES if start is None else ((start, stop),)
+        scanner = AddressScanner(self, ranges)
+        scanner.scan(continue_session)
+        return scanner.confirm()
@@ -0,0 +1,114 @@
+'''
+Counters and fixed-bucket latency histograms, cheap enough to leave on in production
+'''
+try:
+    import gc
+    mem_free = gc.mem_free
+except AttributeError:  # CPython
+    mem_free = None
+
+BUCKETS_MS = (5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class Histogram:
+    '''
+    Counts of values per bucket, quantiles are reported as bucket upper bounds
+    '''
+    def __init__(self, buckets: tuple = BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is above the highest bound
+        self.count = 0
+        self.max = 0
+
+    def observe(self, value):
+        n = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            n += 1
+        self.counts[n] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float):
+        '''
+        Upper bound of the bucket holding the q quantile, max above the highest bound
+        '''
+        rank = q * self.count
+        seen = 0
+        for n, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return self.buckets[n] if n < len(self.buckets) else self.max
+        return 0
+
+
+class Metrics:
+    '''
+    Named counters, gauges and histograms
+    '''
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name: str, value):
+        self.gauges[name] = value
+
+    def peak(self, name: str, value):
+        '''
+        Gauge keeping the highest value until the next snapshot
+        '''
+        if value > self.gauges.get(name, 0):
+            self.gauges[name] = value
+
+    def observe(self, name: str, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+    def snapshot(self, reset_peaks: tuple = ()) -> dict:
+        '''
+        Flat {name: value}: counters, gauges, and p50, p95 and max of histograms
+        :param reset_peaks: peak gauges to start over
+        '''
+        if mem_free is not None:
+            self.gauges['mem_free'] = mem_free()
+        res = dict(self.counters)
+        res.update(self.gauges)
+        for name, histogram in self.histograms.items():
+            res[f'{name}_p50'] = histogram.quantile(0.5)
+            res[f'{name}_p95'] = histogram.quantile(0.95)
+            res[f'{name}_max'] = histogram.max
+        for name in reset_peaks:
+            self.gauges[name] = 0
+        return res
+
+
+registry = Metrics()  # global use instance
+
+
+# Home Assistant sensors for the diagnostics published by MQTTElectricityMeter
+DIAGNOSTICS = {
+    'requests_uip': {'state_class': 'total_increasing'},
+    'requests_energy': {'state_class': 'total_increasing'},
+    'requests_serial_number': {'state_class': 'total_increasing'},
+    'requests_date_time': {'state_class': 'total_increasing'},
+    'requests_other': {'state_class': 'total_increasing'},
+    'retries': {'state_class': 'total_increasing'},
+    'timeouts': {'state_class': 'total_increasing'},
+    'crc_errors': {'state_class': 'total_increasing'},
+    'wrong_address': {'state_class': 'total_increasing'},
+    'rtt_p50': {'device_class': 'duration', 'unit_of_measurement': 'ms'},
+    'rtt_p95': {'device_class': 'duration', 'unit_of_measurement': 'ms'},
+    'mqtt_connect_max': {'device_class': 'duration', 'unit_of_measurement': 'ms'},
+    'mqtt_publish_p95': {'device_class': 'duration', 'unit_of_measurement': 'ms'},
+    'loop_lag': {'device_class': 'duration', 'unit_of_measurement': 'ms'},
+    'boot_to_publish': {'device_class': 'duration', 'unit_of_measurement': 'ms'},
+    'mem_free': {'device_class': 'data_size', 'unit_of_measurement': 'B'}
+}
@@ -1,22 +1,62 @@
 import json
-import ubinascii
-import network
-import umqtt.simple
+try:
+    import uhashlib as hashlib
+except ImportError:
+    import hashlib
+try:
+    import ubinascii
+    import network
+    import umqtt.simple
+    import utime
+except ImportError:  # CPython: pass a client and a device id
+    import binascii as ubinascii
+    network = umqtt = None
+    import utime_compat as utime
+
+import bcd
+from deadband import ChangeFilter
+from metrics import registry as metrics
 import utils
 
+BIRTH_TOPIC = 'homeassistant/status'  # Home Assistant announces 'online' here after a restart
+_first_state_ms = None  # time from boot to the first state publish
+
 
 class MQTTElectricityMeter:
     '''
     Home Assistant MQTT electricity meter device
     '''
-    def __init__(self, server: str, user: str, password: str):
-        mac = ubinascii.hexlify(network.WLAN().config('mac')).decode()
+    CONNECT_TIMEOUT_S = 5  # socket timeout of a connection attempt, bounds the wait for an unreachable broker host
+
+    def __init__(self, server: str, user: str, password: str, meter_addr: int | None = None, client=None,
+                 persistent: bool = False, device_id: str | None = None, batched: bool = False, qos: int = 0,
+                 aggregates: tuple = (), diagnostics: bool = False, discovery_file: str | None = None,
+                 history=None):
+        '''
+        :param meter_addr: meter network address to tell apart several meters on one bus
+        :param client: MQTT client shared by several meters
+        :param persistent: keep the connection open between updates, call service() from the main loop
+        :param device_id: unique device id, WiFi MAC address by default
+        :param batched: publish the whole state as one JSON message on a device topic
+        :param qos: QoS of state messages
+        :param aggregates: U/I/P statistics of high-rate sampling published as extra sensors, see aggregate.STATS,
+                           and the integrated energy
+        :param diagnostics: publish metrics.DIAGNOSTICS as diagnostic entities, see send_diagnostics()
+        :param discovery_file: hash of the last published discovery, discovery_{unique id prefix}.sha by default
+        :param history: history.History exported on request, see send_backfill()
+        '''
+        mac = device_id or ubinascii.hexlify(network.WLAN().config('mac')).decode()
         device = {
             'manufacturer': 'dIcEmAN',
             'model': 'Mercury 200 telemetry',
             'name': 'Mercutel',
             'identifiers': mac
         }
+        uid_prefix = f'EMeter_{mac[-4:]}'
+        if meter_addr is not None:
+            device['name'] = f'Mercutel {meter_addr}'
+            device['identifiers'] = f'{mac}_{meter_addr}'
+            uid_prefix = f'EMeter_{mac[-4:]}_{meter_addr}'
         self.measured_parameters = {
             'U': {
                 'device_class': 'voltage',
@@ -46,35 +86,378 @@ class MQTTElectricityMeter:
                 'expire_after': 24 * 60 * 60
             }
         }
-        self._mqtt = umqtt.simple.MQTTClient('Electricity Meter', server, user=user, password=password, keepalive=30)
-        self._connect()
+        # report by exception: a value is sent when it moves out of its band, or at least twice per expire_after
+        self.deadbands = {
+            'U': {'abs': 1.0},  # V
+            'I': {'abs': 0.05, 'rel': 0.05},  # A
+            'P': {'abs': 10, 'rel': 0.05},  # W
+            'T1': {'abs': 0.01},  # kWh
+            'T2': {'abs': 0.01}
+        }
+        # digits after the point in published values, str() of a float may show rounding noise
+        # or, with single precision floats on ESP8266, drop the last digits of energy registers
+        self.decimals = {'U': 1, 'I': 2, 'P': 0, 'T1': 2, 'T2': 2}
+        for param_name in ('U', 'I', 'P'):
+            for stat in aggregates:
+                name = f'{param_name}_{stat}'
+                self.measured_parameters[name] = dict(self.measured_parameters[param_name], state_class='measurement')
+                self.deadbands[name] = self.deadbands[param_name]
+                self.decimals[name] = self.decimals[param_name] + (stat in ('mean', 'rms'))
+        if aggregates:
+            # integral of P since start, check against T1 + T2
+            self.measured_parameters['E'] = {
+                'device_class': 'energy',
+                'unit_of_measurement': 'kWh',
+                'state_class': 'total_increasing',
+                'expire_after': 24 * 60 * 60
+            }
+            self.measured_parameters['E_window'] = {
+                'device_class': 'energy',
+                'unit_of_measurement': 'Wh',
+                'expire_after': 15 * 60
+            }
+            self.deadbands['E'] = {'abs': 0.01}
+            self.deadbands['E_window'] = {'abs': 1}
+            self.decimals['E'] = 4
+            self.decimals['E_window'] = 2
+        if diagnostics:
+            from metrics import DIAGNOSTICS
+
+            for name, sensor_info in DIAGNOSTICS.items():
+                self.measured_parameters[name] = dict(sensor_info, entity_category='diagnostic')
+        self.changes = ChangeFilter(
+            self.deadbands,
+            {name: info['expire_after'] * 1000 // 2 for name, info in self.measured_parameters.items() if 'expire_after' in info}
+        )
+        if client is None:
+            client = umqtt.simple.MQTTClient('Electricity Meter', server, user=user, password=password, keepalive=30)
+        self._mqtt = client
+        self.persistent = persistent
+        self.batched = batched
+        self.qos = qos
+        self.state_topic = f'Household/electricity/{uid_prefix}/state'
+        self.history_topic = f'Household/electricity/{uid_prefix}/history'
+        # {"from": Unix time, "to": Unix time, "res": "raw"|"hour"|"day"} on backfill_topic/get is answered
+        # with history.History.export_json() documents on backfill_topic, then '1' on backfill_topic/done
+        self.backfill_topic = f'Household/electricity/{uid_prefix}/backfill'
+        self.history = history
+        self._backfill = None  # export in progress
+        self._backfill_doc = None  # document not sent yet
+        self._connected = False
+        self._last_io_ms = utime.ticks_ms()
+        self._retry_ms = self._last_io_ms  # no connection attempts before, see _try_connect()
+        self._retry_delay_s = 1
         for param_name, sensor_info in self.measured_parameters.items():
-            uid = f'EMeter_{mac[-4:]}_{param_name}'
+            uid = f'{uid_prefix}_{param_name}'
             sensor_info['name'] = f'Electricity {param_name}'
             sensor_info['unique_id'] = uid
-            sensor_info['state_topic'] = f'Household/electricity/{uid}/state'
+            if batched:
+                sensor_info['state_topic'] = self.state_topic
+                sensor_info['value_template'] = f'{{{{ value_json.{param_name} | default(this.state) }}}}'
+            else:
+                sensor_info['state_topic'] = f'Household/electricity/{uid}/state'
             sensor_info['device'] = device
             # sensor_info['force_update'] = True
-            # HA MQTT discovery
-            ha_discovery_topic = f'homeassistant/sensor/{uid}/config'
-            self._mqtt.publish(ha_discovery_topic, json.dumps(sensor_info), True)
-        self._mqtt.disconnect()
 
-        # self._mqtt.set_callback(self._inbox)
+        # discovery is retained by the broker: sent with the first update only if it has changed since
+        # the last boot or Home Assistant has restarted, never in a connection of its own
+        self._discovery_file = discovery_file or f'discovery_{uid_prefix}.sha'
+        self._discovery_hash = self._hash_discovery()
+        self._discovery_due = self._discovery_hash != self._load_discovery_hash()
+        if id(client) not in self._client_devices:  # one callback per client, it serves all devices sharing the client
+            self._client_devices[id(client)] = (client, [])
+            client.set_callback(self._inbox)
+        self._client_devices[id(client)][1].append(self)
+
+    _client_devices = {}  # id(client): (client, [MQTTElectricityMeter]), the reference keeps the id unique
+
+    def _discovery_messages(self) -> list:
+        return [(f'homeassistant/sensor/{sensor_info["unique_id"]}/config', json.dumps(sensor_info))
+                for sensor_info in self.measured_parameters.values()]
+
+    def _hash_discovery(self) -> str:
+        digest = hashlib.sha256()
+        for topic, payload in self._discovery_messages():
+            digest.update(topic.encode())
+            digest.update(payload.encode())
+        return ubinascii.hexlify(digest.digest()).decode()
+
+    def _load_discovery_hash(self) -> str | None:
+        try:
+            with open(self._discovery_file) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def _announce(self, nowait: bool = False) -> bool:
+        '''
+        Publish HA MQTT discovery, retained, on the open connection if it is due
+        :param nowait: a failure drops the connection instead of reconnecting
+        :return: False if the connection is lost
+        '''
+        if not self._discovery_due:
+            return True
+        for topic, payload in self._discovery_messages():
+            if not nowait:
+                self._publish(topic, payload, True)
+                continue
+            try:
+                self._mqtt.publish(topic, payload, True, 0)
+            except OSError as e:
+                print(f'MQTT discovery failed: {e}')
+                self._drop()
+                return False
+        self._discovery_due = False
+        with open(self._discovery_file, 'w') as f:
+            f.write(self._discovery_hash)
+        return True
+
+    def _inbox(self, topic: bytes, msg: bytes):
+        if topic == BIRTH_TOPIC.encode() and msg == b'online':
+            print('Home Assistant is online, discovery is due')
+            for device in self._client_devices[id(self._mqtt)][1]:
+                device._discovery_due = True
+            return
+        for device in self._client_devices[id(self._mqtt)][1]:
+            if device.history is not None and topic == f'{device.backfill_topic}/get'.encode():
+                device._request_backfill(msg)
+
+    def _request_backfill(self, msg: bytes):
+        '''
+        Validate a backfill request, export_json() is a generator and fails only when service() runs it
+        '''
+        try:
+            request = json.loads(msg)
+            start, end = int(request['from']), int(request['to'])
+            resolution = request.get('res', 'hour')
+            if resolution not in self.history.series:
+                raise ValueError(f'unknown resolution {resolution}')
+            if start > end:
+                raise ValueError(f'from {start} is after to {end}')
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            print(f'wrong backfill request {msg}: {e}')
+            return
+        self._backfill = self.history.export_json(start, end, resolution)
+        self._backfill_doc = None
+        print(f'backfill of {request} is due')
+
+    def _connected_now(self):
+        '''
+        Set up a new connection: Home Assistant restarts are only heard on persistent ones
+        '''
+        self._connected = True
+        if self.persistent:
+            self._mqtt.subscribe(BIRTH_TOPIC)
+            if self.history is not None:
+                self._mqtt.subscribe(f'{self.backfill_topic}/get')
 
     @utils.retry_on_error
     def _connect(self):
-        self._mqtt.connect(clean_session=False)
+        start = utime.ticks_ms()
+        self._mqtt.connect(clean_session=False, timeout=self.CONNECT_TIMEOUT_S)
+        self._connected_now()
+        self._last_io_ms = utime.ticks_ms()
+        metrics.observe('mqtt_connect', utime.ticks_diff(self._last_io_ms, start))
+
+    def _drop(self):
+        '''
+        Forget a broken connection
+        '''
+        self._connected = False
+        try:
+            self._mqtt.sock.close()
+        except (AttributeError, OSError):
+            pass
+
+    def _try_connect(self) -> bool:
+        '''
+        Single connection attempt for callers that must not block, attempts back off exponentially
+        '''
+        if self._connected:
+            return True
+        now = utime.ticks_ms()
+        if utime.ticks_diff(now, self._retry_ms) < 0:
+            return False
+        try:
+            self._mqtt.connect(clean_session=False, timeout=self.CONNECT_TIMEOUT_S)
+            self._connected_now()
+        except Exception as e:  # OSError, umqtt.simple.MQTTException when the broker refuses the client
+            print(f'MQTT connection failed: {e!r}, next attempt in {self._retry_delay_s} s')
+            self._drop()
+            self._retry_ms = utime.ticks_add(now, self._retry_delay_s * 1000)
+            self._retry_delay_s = min(self._retry_delay_s * 2, 5 * 60)
+            return False
+        self._last_io_ms = utime.ticks_ms()
+        self._retry_delay_s = 1
+        metrics.observe('mqtt_connect', utime.ticks_diff(self._last_io_ms, now))
+        return True
+
+    def _open(self):
+        if not self._connected:
+            self._connect()
+        self._announce()
+
+    def _close(self):
+        if not self.persistent and self._connected:
+            try:
+                self._mqtt.disconnect()
+            except OSError:
+                pass
+            self._connected = False
+
+    def _publish(self, topic: str, msg: str, retain: bool = False, qos: int = 0):
+        start = utime.ticks_ms()
+        try:
+            self._mqtt.publish(topic, msg, retain, qos)
+        except OSError as e:  # broken socket, reconnect once per message
+            print(f'MQTT publish failed: {e}')
+            self._drop()
+            self._connect()
+            start = utime.ticks_ms()
+            self._mqtt.publish(topic, msg, retain, qos)
+        self._last_io_ms = utime.ticks_ms()
+        metrics.observe('mqtt_publish', utime.ticks_diff(self._last_io_ms, start))
+
+    def service(self):
+        '''
+        Keep a persistent connection alive: ping the broker within keepalive and read its answers.
+        Cheap enough to call on every main loop iteration.
+        '''
+        if not self._connected:
+            return
+        try:
+            keepalive_ms = self._mqtt.keepalive * 1000
+            if keepalive_ms and utime.ticks_diff(utime.ticks_ms(), self._last_io_ms) >= keepalive_ms // 2:
+                self._mqtt.ping()
+                self._last_io_ms = utime.ticks_ms()
+            self._mqtt.check_msg()  # PINGRESP and birth messages, raises OSError when the broker has closed the socket
+        except OSError as e:
+            print(f'MQTT connection lost: {e}')
+            self._drop()  # reconnect on the next update
+            return
+        if self._announce(True):
+            self.send_backfill()
+
+    def _format(self, name: str, value) -> str:
+        decimals = self.decimals.get(name)
+        if decimals is None or not isinstance(value, float):
+            return str(value)
+        return bcd.to_str(round(value * bcd.POW10[decimals]), decimals)
+
+    def _compact_json(self, parameters: dict) -> str:
+        '''
+        JSON object of numbers without whitespace
+        '''
+        return '{' + ','.join(f'"{name}":{self._format(name, value)}' for name, value in parameters.items()) + '}'
 
     def send_update(self, parameters: dict):
-        self._connect()
-        for param_name, param_value in parameters.items():
-            self._mqtt.publish(self.measured_parameters[param_name]['state_topic'], str(param_value))
-        self._mqtt.disconnect()
-
-    # def _inbox(self, topic, msg):
-    #     topic = topic.decode()
-    #     if topic == self.config['command_topic']:
-    #         data = json.loads(msg)
-    #         self.on = data['state'] == STATES[True]
-    #         self._send_update()
+        self._open()
+        messages = self._state_messages(parameters)
+        for topic, msg in messages:
+            self._publish(topic, msg, qos=self.qos)
+        if messages:
+            self._state_sent()
+        self._close()
+
+    @staticmethod
+    def _state_sent():
+        global _first_state_ms
+        if _first_state_ms is None:
+            _first_state_ms = utime.ticks_diff(utime.ticks_ms(), utils.BOOT_MS)
+            metrics.gauge('boot_to_publish', _first_state_ms)
+            print(f'First state published {_first_state_ms} ms after boot')
+
+    def _send_nowait(self, topic: str, msg: str) -> bool:
+        if not self._try_connect() or not self._announce(True):
+            return False
+        start = utime.ticks_ms()
+        try:
+            self._mqtt.publish(topic, msg, False, self.qos)
+        except OSError as e:
+            print(f'MQTT publish failed: {e}')
+            self._drop()
+            return False
+        self._last_io_ms = utime.ticks_ms()
+        metrics.observe('mqtt_publish', utime.ticks_diff(self._last_io_ms, start))
+        return True
+
+    def _state_messages(self, parameters: dict) -> list:
+        state = {name: value for name, value in parameters.items() if name in self.measured_parameters}
+        if self.batched:
+            return [(self.state_topic, self._compact_json(state))] if state else []
+        return [(self.measured_parameters[name]['state_topic'], self._format(name, value)) for name, value in state.items()]
+
+    def send_diagnostics(self, values: dict) -> bool:
+        '''
+        Publish a metrics snapshot, never waits for the network, dropped while the broker is unreachable
+        '''
+        for topic, msg in self._state_messages(values):
+            if not self._send_nowait(topic, msg):
+                return False
+        self._close()
+        return True
+
+    def send_history(self, ring, batch: int = 16, max_batches: int = 4) -> int:
+        '''
+        Drain stored readings as JSON arrays with their original timestamps
+        :param ring: ringbuf.ReadingRing
+        :return: number of delivered readings
+        '''
+        sent = 0
+        for _ in range(max_batches):  # bounded, the rest goes on the next call
+            records = ring.read(batch)
+            if not records:
+                break
+            msg = '[' + ','.join(self._compact_json(dict(values, ts=ts)) for _, ts, values in records) + ']'
+            if not self._send_nowait(self.history_topic, msg):
+                break
+            ring.ack(records[-1][0])
+            sent += len(records)
+        return sent
+
+    def send_backfill(self, max_docs: int = 4) -> int:
+        '''
+        Continue a requested history export, never waits for the network
+        :param max_docs: bounded, the rest goes on the next call
+        :return: number of sent documents
+        '''
+        sent = 0
+        while self._backfill is not None and sent < max_docs:
+            if self._backfill_doc is None:
+                self._backfill_doc = next(self._backfill, None)
+                if self._backfill_doc is None:
+                    self._backfill = None
+                    self._send_nowait(f'{self.backfill_topic}/done', '1')
+                    break
+            if not self._send_nowait(self.backfill_topic, self._backfill_doc):
+                break  # sent again after reconnection
+            self._backfill_doc = None
+            sent += 1
+        return sent
+
+    def send_changes(self, parameters: dict, ring=None) -> dict:
+        '''
+        Send only the parameters out of their deadbands or due for a heartbeat
+        :param ring: ringbuf.ReadingRing to store readings while the broker is unreachable.
+                     With a ring the call never retries and never waits for the network.
+        :return: sent parameters
+        '''
+        changed = self.changes.filter(parameters)
+        if ring is None:
+            if changed:
+                self.send_update(changed)
+                self.changes.commit(changed)
+            return changed
+
+        messages = self._state_messages(changed)
+        for topic, msg in messages:
+            if not self._send_nowait(topic, msg):
+                ring.append(parameters)
+                return {}
+        if messages:
+            self._state_sent()
+        self.changes.commit(changed)
+        if len(ring):
+            self.send_history(ring)
+        self._close()
+        return changed
@@ -0,0 +1,103 @@
+'''
+Retry, backoff and circuit breaker policy for meter requests
+'''
+try:
+    import utime
+except ImportError:
+    import utime_compat as utime
+
+import utils
+
+
+class CircuitBreaker:
+    '''
+    Fails fast after repeated failures, lets a single probe through after a cool-down
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold: int = 3, cooldown_ms: int = 60000):
+        '''
+        :param threshold: consecutive failed requests to open the circuit
+        :param cooldown_ms: time before probing the meter again
+        '''
+        self.threshold = threshold
+        self.cooldown_ms = cooldown_ms
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_ms = 0
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN and utime.ticks_diff(utime.ticks_ms(), self._opened_ms) >= self.cooldown_ms:
+            self.state = self.HALF_OPEN
+        return self.state != self.OPEN
+
+    def success(self):
+        self.state = self.CLOSED
+        self._failures = 0
+
+    def failure(self):
+        self._failures += 1
+        if self.state == self.HALF_OPEN or self._failures >= self.threshold:
+            self.state = self.OPEN
+            self._opened_ms = utime.ticks_ms()
+
+
+class RetryPolicy:
+    '''
+    Bounds a request: attempts cap per command, total deadline, exponential backoff with jitter.
+    The receive timeout follows the observed response time at each port speed.
+    '''
+    def __init__(self, attempts: int = 5, command_attempts: dict | None = None, deadline_ms: int = 3000,
+                 backoff_ms: int = 20, backoff_max_ms: int = 500, jitter_ms: int = 20,
+                 timeout_ms: int = 400, timeout_min_ms: int = 50, timeout_factor: int = 4,
+                 breaker: CircuitBreaker | None = None):
+        '''
+        :param attempts: default attempts per request
+        :param command_attempts: {command: attempts} overrides
+        :param deadline_ms: no new attempt is started if it could end after the deadline
+        :param timeout_ms: wait for the first byte of an answer until the response time is learned
+        :param timeout_factor: receive timeout in units of the learned response time
+        '''
+        self.attempts = attempts
+        self.command_attempts = command_attempts or {}
+        self.deadline_ms = deadline_ms
+        self.backoff_ms = backoff_ms
+        self.backoff_max_ms = backoff_max_ms
+        self.jitter_ms = jitter_ms
+        self.timeout_ms = timeout_ms
+        self.timeout_min_ms = timeout_min_ms
+        self.timeout_factor = timeout_factor
+        self.breaker = breaker or CircuitBreaker()
+        self._response_us = {}  # port speed: smoothed time to the first byte of an answer
+
+    def attempts_for(self, cmd: int) -> int:
+        return self.command_attempts.get(cmd, self.attempts)
+
+    def delay_ms(self, attempt: int) -> int:
+        '''
+        Pause after a failed attempt number attempt
+        '''
+        delay = min(self.backoff_ms << (attempt - 1), self.backoff_max_ms)
+        return delay + utils.randInt(0, self.jitter_ms)
+
+    def receive_timeout_ms(self, port_speed: int) -> int:
+        response_us = self.response_us(port_speed)
+        if response_us is None:
+            return self.timeout_ms
+        timeout = self.timeout_factor * response_us // 1000
+        return max(self.timeout_min_ms, min(timeout, self.timeout_ms))
+
+    def response_us(self, port_speed: int) -> int | None:
+        '''
+        Learned time to the first byte of an answer
+        '''
+        return self._response_us.get(port_speed)
+
+    def observe(self, port_speed: int, first_byte_us: int):
+        '''
+        Learn the response time of a successful request
+        '''
+        avg = self._response_us.get(port_speed)
+        self._response_us[port_speed] = first_byte_us if avg is None else (3 * avg + first_byte_us) // 4
@@ -0,0 +1,156 @@
+'''
+Store-and-forward ring buffer of timestamped readings on flash
+'''
+import struct
+try:
+    import utime
+except ImportError:
+    import utime_compat as utime
+
+import crc16
+
+# seconds to add to utime.time() for a Unix timestamp, MicroPython ports count from 2000
+EPOCH_OFFSET = 0 if utime.localtime(0)[0] < 2000 else 946684800
+
+
+class ReadingRing:
+    '''
+    Fixed number of fixed-size records in a preallocated file. Records carry a sequence number
+    and a CRC, so the head is found again after a reboot and torn writes are skipped.
+    Appends are collected in RAM and written in blocks to keep flash wear low.
+    '''
+    FIELDS = ('U', 'I', 'P', 'T1', 'T2')
+    SCALE = 100  # values are stored as fixed point integers
+    _EMPTY = 0xFFFFFFFF
+
+    def __init__(self, path: str = 'readings.bin', capacity: int = 512, flush_records: int = 8,
+                 fields: tuple = FIELDS):
+        '''
+        :param capacity: records kept on flash, the oldest are overwritten
+        :param flush_records: records collected in RAM before a flash write
+        '''
+        self.path = path
+        self.capacity = capacity
+        self.flush_records = flush_records
+        self.fields = fields
+        self._fmt = f'<IIH{len(fields)}i'  # seq, Unix time, mask of present fields, values
+        self.record_size = struct.calcsize(self._fmt) + 2  # + CRC
+        self._pending = []  # records not written to flash yet
+        self._acked_path = path + '.ack'
+        self._next_seq = 0
+        self._acked_seq = 0  # records with seq below are delivered
+        self._open()
+
+    def _open(self):
+        try:
+            f = open(self.path, 'r+b')
+        except OSError:
+            f = open(self.path, 'w+b')
+        f.seek(0, 2)
+        size = self.capacity * self.record_size
+        if f.tell() < size:
+            f.write(b'\xff' * (size - f.tell()))
+            f.flush()
+        self._file = f
+        for seq, _, _ in self._scan():
+            self._next_seq = max(self._next_seq, seq + 1)
+        try:
+            with open(self._acked_path) as f:
+                self._acked_seq = int(f.read())
+        except (OSError, ValueError):
+            pass
+        self._acked_seq = max(self._acked_seq, self._next_seq - self.capacity)
+
+    def _scan(self):
+        '''
+        Yield (seq, timestamp, values) of valid records in file order
+        '''
+        f = self._file
+        f.seek(0)
+        for _ in range(self.capacity):
+            rec = f.read(self.record_size)
+            if len(rec) < self.record_size:
+                return
+            record = self._decode(rec)
+            if record is not None:
+                yield record
+
+    def _decode(self, rec: bytes):
+        mv = memoryview(rec)
+        if crc16.crc16(mv):  # CRC over data and its own CRC is zero
+            return None
+        seq, ts, mask, *raw = struct.unpack_from(self._fmt, mv)
+        if seq == self._EMPTY:
+            return None
+        values = {name: raw[n] / self.SCALE for n, name in enumerate(self.fields) if mask & (1 << n)}
+        return seq, ts, values
+
+    def _encode(self, seq: int, ts: int, values: dict) -> bytes:
+        mask = 0
+        raw = []
+        for n, name in enumerate(self.fields):
+            value = values.get(name)
+            if value is not None:
+                mask |= 1 << n
+            raw.append(0 if value is None else int(round(value * self.SCALE)))
+        rec = struct.pack(self._fmt, seq, ts, mask, *raw)
+        return rec + struct.pack('<H', crc16.crc16(rec))
+
+    def append(self, values: dict, ts: int | None = None):
+        '''
+        Store a reading, timestamped now unless ts (Unix time) is given
+        '''
+        if ts is None:
+            ts = int(utime.time()) + EPOCH_OFFSET
+        self._pending.append(self._encode(self._next_seq, ts, values))
+        self._next_seq += 1
+        if len(self._pending) >= self.flush_records:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write records collected in RAM to flash
+        '''
+        if not self._pending:
+            return
+        first_seq = self._next_seq - len(self._pending)
+        f = self._file
+        for n, rec in enumerate(self._pending):
+            f.seek((first_seq + n) % self.capacity * self.record_size)
+            f.write(rec)
+        f.flush()
+        self._pending = []
+
+    def __len__(self) -> int:
+        '''
+        Readings waiting for delivery
+        '''
+        return self._next_seq - max(self._acked_seq, self._next_seq - self.capacity)
+
+    def read(self, count: int) -> list:
+        '''
+        Oldest undelivered readings: [(seq, Unix time, values)]
+        '''
+        self.flush()
+        f = self._file
+        records = []
+        seq = max(self._acked_seq, self._next_seq - self.capacity)
+        while seq < self._next_seq and len(records) < count:
+            f.seek(seq % self.capacity * self.record_size)
+            record = self._decode(f.read(self.record_size))
+            if record is not None and record[0] == seq:  # skip torn writes
+                records.append(record)
+            seq += 1
+        return records
+
+    def ack(self, seq: int):
+        '''
+        Mark readings up to seq as delivered
+        '''
+        self._acked_seq = seq + 1
+        with open(self._acked_path, 'w') as f:
+            f.write(str(self._acked_seq))
+
+    def close(self):
+        self.flush()
+        self._file.close()
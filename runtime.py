@@ -0,0 +1,166 @@
+'''
+Event loop runtime: meter polling, MQTT publishing, clock sync and watchdog feeding as separate tasks
+'''
+try:
+    import uasyncio as asyncio
+    import utime
+except ImportError:  # CPython
+    import asyncio
+    import utime_compat as utime
+
+from metrics import registry as metrics
+from scheduler import Scheduler
+import utils
+
+
+async def offload(func, *args):
+    '''
+    Run blocking network I/O in a worker thread where there are threads (CPython), in place otherwise.
+    MicroPython has no asyncio.to_thread: there a umqtt connect or an NTP query blocks the whole loop
+    for up to its socket timeout.
+    '''
+    to_thread = getattr(asyncio, 'to_thread', None)
+    if to_thread is None:
+        return func(*args)
+    return await to_thread(func, *args)
+
+
+class LoopLag:
+    '''
+    How late a periodic wake-up is: the time the loop spent in code that did not yield
+    '''
+    def __init__(self, period_ms: int = 100):
+        self.period_ms = period_ms
+        self.last_ms = 0
+        self.max_ms = 0
+
+    def reset(self):
+        self.max_ms = 0
+
+    async def run(self):
+        while True:
+            start = utime.ticks_ms()
+            await asyncio.sleep(self.period_ms / 1000)
+            self.last_ms = max(0, utime.ticks_diff(utime.ticks_ms(), start) - self.period_ms)
+            self.max_ms = max(self.max_ms, self.last_ms)
+            metrics.peak('loop_lag', self.last_ms)
+
+
+class Runtime:
+    '''
+    Polls the meter on its own schedule and hands readings to a publisher task through a queue.
+    On CPython, network I/O runs in worker threads, so a slow or unreachable broker never delays a sample.
+    On MicroPython it runs in place, see offload(): polling pauses while a connection attempt or an NTP
+    query blocks, and the lag is bounded by their socket timeouts, not by LAG_BOUND_MS.
+    '''
+    LAG_BOUND_MS = 50  # expected loop lag with the broker unreachable on CPython only, see bench.py async
+
+    def __init__(self, em, mqttm, ring=None, schedule: dict | None = None,
+                 clock_sync_ms: int | None = 24 * 60 * 60 * 1000, queue_len: int = 8,
+                 diagnostics_ms: int | None = None):
+        '''
+        :param em: MercuryEnergyMeter
+        :param mqttm: MQTTElectricityMeter, a persistent one
+        :param ring: ringbuf.ReadingRing for readings taken while the broker is unreachable
+        :param schedule: {property: (period_ms, phase_ms)}, properties from MercuryEnergyMeter.READABLE,
+                         every minute uip and energy by default
+        :param clock_sync_ms: NTP synchronization period, None to disable
+        :param queue_len: readings waiting for the publisher, the oldest are dropped
+        :param diagnostics_ms: metrics publishing period, None to disable
+        '''
+        self.em = em
+        self.mqttm = mqttm
+        self.ring = ring
+        self.scheduler = Scheduler()
+        for name, (period_ms, phase_ms) in (schedule or {'uip': (60000, 0), 'energy': (60000, 0)}).items():
+            self.scheduler.add(name, period_ms, phase_ms)
+        self.clock_sync_ms = clock_sync_ms
+        self.queue_len = queue_len
+        self.diagnostics_ms = diagnostics_ms
+        self.lag = LoopLag()
+        self._queue = []
+        self._ready = asyncio.Event()
+
+    async def _watchdog(self):
+        while True:
+            utils.watchdog.feed()
+            await asyncio.sleep(1)
+
+    async def _poll(self):
+        scheduler = self.scheduler
+        while True:
+            jobs = scheduler.due()
+            if jobs:
+                try:
+                    readings = await self.em.read_many_async([job.name for job in jobs])  # one bus session
+                except Exception as e:  # an exception would end the task and the runtime with it
+                    print(f'poll failed: {e}')
+                    readings = {}
+                for job in jobs:
+                    scheduler.done(job)
+                state = {}
+                for value in readings.values():
+                    if isinstance(value, dict):
+                        state.update(value)
+                if state:
+                    self._queue.append(state)
+                    del self._queue[:-self.queue_len]
+                    self._ready.set()
+            await asyncio.sleep(scheduler.sleep_ms() / 1000)
+
+    def _send(self, state: dict):
+        sent = self.mqttm.send_changes(state, self.ring)
+        print(f'sent: {sent}')
+
+    async def _publish(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._ready.wait(), 1)
+            except asyncio.TimeoutError:
+                try:
+                    await offload(self.mqttm.service)
+                except Exception as e:
+                    print(f'MQTT service failed: {e}')
+                continue
+            self._ready.clear()
+            while self._queue:
+                try:
+                    await offload(self._send, self._queue.pop(0))
+                except Exception as e:  # the reading is lost, the next ones are sent
+                    print(f'publishing failed: {e}')
+
+    async def _clock(self):
+        while True:
+            try:
+                await offload(utils.sync_time_once)  # a retry loop would hold up the other tasks on MicroPython
+            except Exception as e:
+                print(f'clock synchronization failed: {e}')
+            await asyncio.sleep(self.clock_sync_ms / 1000)
+
+    async def _diagnostics(self):
+        while True:
+            await asyncio.sleep(self.diagnostics_ms / 1000)
+            try:
+                await offload(self.mqttm.send_diagnostics, metrics.snapshot(('loop_lag',)))
+            except Exception as e:
+                print(f'diagnostics publishing failed: {e}')
+
+    async def main(self, duration_ms: int | None = None):
+        '''
+        Run the tasks forever or for duration_ms
+        '''
+        coros = [self._watchdog(), self._poll(), self._publish(), self.lag.run()]
+        if self.clock_sync_ms is not None and utils.machine:  # ntptime sets the board RTC
+            coros.append(self._clock())
+        if self.diagnostics_ms is not None:
+            coros.append(self._diagnostics())
+        tasks = [asyncio.create_task(coro) for coro in coros]
+        if duration_ms is None:
+            await asyncio.gather(*tasks)
+            return
+        await asyncio.sleep(duration_ms / 1000)
+        for task in tasks:
+            task.cancel()
+
+    def run(self, duration_ms: int | None = None):
+        asyncio.run(self.main(duration_ms))
@@ -0,0 +1,208 @@
+'''
+Network address scanner for Mercury 200 meters
+'''
+import struct
+try:
+    import utime
+except ImportError:
+    import utime_compat as utime
+
+import crc16
+from frame import FrameDecoder
+import utils
+
+# six-digit serial-derived addresses first (see config_example.py), then the rest
+PRIORITY_RANGES = ((100000, 999999), (0, 99999), (1000000, 2**32 - 1))
+
+_MAGIC = b'MSC2'
+_HEADER = '<4sHBIH'  # magic, CRC of the ranges, range index, next address, found addresses count
+
+
+class AddressScanner:
+    '''
+    Sends pings at the rate the line allows and attributes replies by the address they carry,
+    so a late reply never gets credited to the wrong request
+    '''
+    CHECKPOINT_MS = 60 * 1000  # progress saving interval, keeps flash wear low
+    REPORT_ADDRESSES = 1000
+
+    def __init__(self, em, ranges=PRIORITY_RANGES, checkpoint: str | None = 'scan.bin', response_ms: int = 20):
+        '''
+        :param em: MercuryEnergyMeter owning the line
+        :param ranges: inclusive (start, stop) address ranges in scan order
+        :param checkpoint: progress file to resume from, None to disable
+        :param response_ms: meter reaction time used until a response time is learned
+        '''
+        self._em = em
+        self.ranges = tuple(ranges)
+        self.checkpoint = checkpoint
+        self.response_ms = response_ms
+        self.found = set()
+        self._range_idx = 0
+        self._next_addr = self.ranges[0][0]
+        # a checkpoint resumes only the scan of the same ranges
+        self._ranges_crc = crc16.crc16(b''.join(struct.pack('<II', start, stop) for start, stop in self.ranges))
+
+    def slot_us(self) -> int:
+        '''
+        Time for a ping and its reply: both on the wire plus the meter reaction time
+        '''
+        em = self._em
+        byte_us = em._transport.byte_time_us()
+        response_us = em.retry_policy.response_us(em.port_speed)
+        if response_us is None:
+            response_us = self.response_ms * 1000
+        return (7 + 11) * byte_us + response_us + em._transport.silence_us()
+
+    def load(self) -> bool:
+        '''
+        Resume from the checkpoint file
+        '''
+        try:
+            with open(self.checkpoint, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return False
+        hsize = struct.calcsize(_HEADER)
+        if len(data) < hsize:
+            return False
+        magic, ranges_crc, range_idx, next_addr, count = struct.unpack_from(_HEADER, data)
+        if (magic != _MAGIC or ranges_crc != self._ranges_crc or range_idx >= len(self.ranges)
+                or len(data) != hsize + 4 * count):
+            return False  # another scan or a finished one
+        start, stop = self.ranges[range_idx]
+        if not start <= next_addr <= stop + 1:
+            return False
+        self._range_idx = range_idx
+        self._next_addr = next_addr
+        self.found.update(struct.unpack_from(f'<{count}I', data, hsize))
+        return True
+
+    def save(self):
+        if self.checkpoint is None:
+            return
+        found = sorted(self.found)
+        with open(self.checkpoint, 'wb') as f:
+            f.write(struct.pack(_HEADER, _MAGIC, self._ranges_crc, self._range_idx, self._next_addr, len(found)))
+            f.write(struct.pack(f'<{len(found)}I', *found))
+
+    def _listen(self, until_us: int) -> bool:
+        '''
+        Collect replies until the given time
+        :return: True if garbled bytes were received, e.g. a reply collided with a ping
+        '''
+        transport = self._em._transport
+        decoder = self._decoder
+        garbled = False
+        while utime.ticks_diff(until_us, utime.ticks_us()) > 0:
+            pending = transport.any()
+            if not pending:
+                if decoder.received and utime.ticks_diff(utime.ticks_us(), self._last_rx_us) > transport.silence_us():
+                    garbled = True  # a frame was cut short
+                    decoder = self._new_decoder()
+                utime.sleep_us(transport.byte_time_us())
+                continue
+            self._last_rx_us = utime.ticks_us()
+            for byte in transport.read(pending):
+                if decoder.feed((byte,)):
+                    if decoder.addr not in self.found:
+                        print(f'Gotcha! Address {decoder.addr} is found')
+                        self.found.add(decoder.addr)
+                    garbled = garbled or decoder.skipped > 0
+                    decoder = self._new_decoder()
+            garbled = garbled or decoder.skipped > 0
+        self._decoder = decoder
+        return garbled
+
+    def _new_decoder(self) -> FrameDecoder:
+        return FrameDecoder(None, self._em.COMMAND.GET_SERIAL_NUMBER, 4)
+
+    def _remaining(self) -> int:
+        count = self.ranges[self._range_idx][1] - self._next_addr + 1
+        for start, stop in self.ranges[self._range_idx + 1:]:
+            count += stop - start + 1
+        return count
+
+    def _recheck(self, addresses, slot_us: int):
+        '''
+        Ping addresses one at a time, waiting for a possible reply after each
+        '''
+        for addr in sorted(set(addresses) - self.found):
+            self._em._ping_address(addr)
+            self._listen(utime.ticks_add(utime.ticks_us(), slot_us))
+            utils.watchdog.feed()
+
+    def scan(self, resume: bool = True) -> set:
+        '''
+        Single pass over all ranges. Pings are sent back to back, a reply is attributed by its address.
+        When a reply collides with a ping, the pings sent since the colliding reply could start are
+        repeated one at a time at the end of the range.
+        :return: addresses that answered
+        '''
+        if resume and self.checkpoint is not None and self.load():
+            print(f'Resuming at address {self._next_addr}, found so far: {self.found}')
+        em = self._em
+        transport = em._transport
+        self._decoder = self._new_decoder()
+        self._last_rx_us = utime.ticks_us()
+        saved_ms = utime.ticks_ms()
+        with transport:
+            while self._range_idx < len(self.ranges):
+                stop = self.ranges[self._range_idx][1]
+                print(f'Searching for addresses in range [{self._next_addr}, {stop}]')
+                slot_us = self.slot_us()
+                ping_us = 7 * transport.byte_time_us() + transport.silence_us()
+                window = slot_us // ping_us + 2  # pings that may share the line with one reply
+                recent = []
+                suspects = []
+                t_start = utime.ticks_ms()
+                scanned = 0
+                while self._next_addr <= stop:
+                    em._ping_address(self._next_addr)
+                    recent.append(self._next_addr)
+                    if len(recent) > window:
+                        recent.pop(0)
+                    if self._listen(utime.ticks_add(utime.ticks_us(), ping_us)):
+                        suspects.extend(recent)
+                    self._next_addr += 1
+                    scanned += 1
+                    if not scanned % self.REPORT_ADDRESSES:
+                        rate = scanned * 1000 / max(utime.ticks_diff(utime.ticks_ms(), t_start), 1)
+                        eta_h = self._remaining() / rate / 3600
+                        print(f'{self._next_addr - 1}: {rate:.1f} addresses/s, ETA {eta_h:.1f} h, found: {self.found}')
+                    if utime.ticks_diff(utime.ticks_ms(), saved_ms) >= self.CHECKPOINT_MS:
+                        self._recheck(suspects, slot_us)  # suspects are not checkpointed
+                        suspects = []
+                        self.save()
+                        saved_ms = utime.ticks_ms()
+                    utils.watchdog.feed()
+                # the last reply may come after the last ping
+                if self._listen(utime.ticks_add(utime.ticks_us(), slot_us)):
+                    suspects.extend(recent)
+                self._recheck(suspects, slot_us)
+                self._range_idx += 1
+                if self._range_idx < len(self.ranges):
+                    self._next_addr = self.ranges[self._range_idx][0]
+                self.save()
+        return self.found
+
+    def confirm(self, attempts: int = 3) -> set:
+        '''
+        Second pass: ask every found address for its serial number
+        :return: confirmed addresses
+        '''
+        em = self._em
+        confirmed = set()
+        addr = em.addr
+        try:
+            for candidate in sorted(self.found):
+                em.addr = candidate
+                for _ in range(attempts):
+                    if not isinstance(em._request(em.COMMAND.GET_SERIAL_NUMBER, answer_format='>I'), str):
+                        confirmed.add(candidate)
+                        break
+                utils.watchdog.feed()
+        finally:
+            em.addr = addr
+        print(f'Confirmed addresses: {confirmed}')
+        return confirmed
@@ -0,0 +1,110 @@
+'''
+Deadline scheduler driven by utime.ticks_ms
+'''
+try:
+    import utime
+except ImportError:
+    import utime_compat as utime
+
+from metrics import registry as metrics
+import utils
+
+
+def next_due(due_ms: int, period_ms: int, now: int) -> tuple:
+    '''
+    Deadline after due_ms on the same grid: run time never accumulates into drift,
+    deadlines already missed at now are skipped instead of run in a burst
+    :return: (next deadline, number of skipped deadlines)
+    '''
+    period_ms = max(period_ms, 1)
+    due_ms = utime.ticks_add(due_ms, period_ms)
+    late = utime.ticks_diff(now, due_ms)
+    if late < 0:
+        return due_ms, 0
+    skipped = late // period_ms + 1
+    return utime.ticks_add(due_ms, skipped * period_ms), skipped
+
+
+class Job:
+    '''
+    Periodic job on a fixed grid: start + phase_ms + n * period_ms
+    '''
+    def __init__(self, name: str, period_ms: int, due_ms: int, func=None):
+        self.name = name
+        self.period_ms = period_ms
+        self.due_ms = due_ms
+        self.func = func
+        self.runs = 0
+        self.missed = 0  # deadlines coalesced into a later run
+        self.max_late_ms = 0  # worst start time behind the deadline
+
+
+class Scheduler:
+    '''
+    Runs jobs at monotonic deadlines, each with its own period and phase offset
+    '''
+    def __init__(self):
+        self.jobs = []
+        self._start_ms = utime.ticks_ms()
+
+    def add(self, name: str, period_ms: int, phase_ms: int = 0, func=None) -> Job:
+        '''
+        :param phase_ms: offset of the first deadline from the scheduler start, spreads jobs with common periods
+        :param func: callable run by run_pending()
+        '''
+        job = Job(name, period_ms, utime.ticks_add(self._start_ms, phase_ms), func)
+        self.jobs.append(job)
+        return job
+
+    def due(self, now: int | None = None) -> list:
+        '''
+        Jobs at or past their deadline, the most overdue first
+        '''
+        if now is None:
+            now = utime.ticks_ms()
+        jobs = [job for job in self.jobs if utime.ticks_diff(now, job.due_ms) >= 0]
+        jobs.sort(key=lambda job: utime.ticks_diff(job.due_ms, now))
+        for job in jobs:
+            late = utime.ticks_diff(now, job.due_ms)
+            job.max_late_ms = max(job.max_late_ms, late)
+            metrics.peak('loop_lag', late)
+        return jobs
+
+    def done(self, job: Job, now: int | None = None):
+        '''
+        Schedule the next run of a job that has just run
+        '''
+        if now is None:
+            now = utime.ticks_ms()
+        job.due_ms, skipped = next_due(job.due_ms, job.period_ms, now)
+        job.runs += 1
+        job.missed += skipped
+
+    def sleep_ms(self) -> int:
+        '''
+        Time until the next deadline
+        '''
+        now = utime.ticks_ms()
+        return max(0, min((utime.ticks_diff(job.due_ms, now) for job in self.jobs), default=0))
+
+    def run_pending(self) -> int:
+        '''
+        Run due jobs once each
+        :return: number of jobs run
+        '''
+        jobs = self.due()
+        for job in jobs:
+            try:
+                job.func()
+            except Exception as e:  # keep the other jobs on schedule
+                print(f'job {job.name} failed: {e}')
+            self.done(job)
+            utils.watchdog.feed()
+        return len(jobs)
+
+    def run(self, duration_ms: int | None = None):
+        start = utime.ticks_ms()
+        while duration_ms is None or utime.ticks_diff(utime.ticks_ms(), start) < duration_ms:
+            self.run_pending()
+            utime.sleep_ms(min(self.sleep_ms(), 1000))
+            utils.watchdog.feed()
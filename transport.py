@@ -0,0 +1,240 @@
+'''
+Byte transports for the Mercury RS-485 line
+'''
+try:
+    from machine import Pin, UART
+    import uos
+except ImportError:  # CPython
+    Pin = UART = uos = None
+try:
+    import utime
+except ImportError:
+    import utime_compat as utime
+
+import utils
+
+
+class Transport:
+    '''
+    Half-duplex byte transport, holds the line while used as a context manager.
+    Nested sessions reuse the outermost one.
+    '''
+    def __init__(self, timeout: int = 400, timeout_char: int = 2):
+        self.baudrate = 9600
+        self.timeout = timeout  # ms to wait for an answer
+        self.timeout_char = timeout_char  # ms of silence after a received byte that ends a frame
+        self.last_rx_us = utime.ticks_us()  # end of the last answer, keeps the gap between frames
+        self._sessions = 0
+
+    def __enter__(self):
+        if not self._sessions:
+            self.acquire()
+        self._sessions += 1
+
+    def __exit__(self, *args):
+        self._sessions -= 1
+        if not self._sessions:
+            self.release()
+
+    def acquire(self):
+        pass
+
+    def release(self):
+        pass
+
+    def set_speed(self, baudrate: int):
+        self.baudrate = baudrate
+
+    def byte_time_us(self) -> int:
+        return 10 * 1000000 // self.baudrate  # 10 baud per byte
+
+    def silence_us(self) -> int:
+        '''
+        Inter-byte gap that marks the end of a frame: 3.5 characters, at least timeout_char
+        '''
+        return max(35 * 1000000 // self.baudrate, self.timeout_char * 1000)
+
+    def write(self, data: bytes):
+        raise NotImplementedError
+
+    def read(self, nbytes: int) -> bytes | None:
+        '''
+        Read up to nbytes, waiting at most timeout ms
+        '''
+        raise NotImplementedError
+
+    def readinto(self, buf, nbytes: int) -> int | None:
+        '''
+        read() into a preallocated buffer
+        :return: number of bytes read, None if nothing arrived
+        '''
+        data = self.read(nbytes)
+        if not data:
+            return None
+        buf[:len(data)] = data
+        return len(data)
+
+    def any(self) -> int:
+        '''
+        Number of received bytes ready to read
+        '''
+        raise NotImplementedError
+
+    async def read_async(self, nbytes: int, timeout_us: int) -> bytes | None:
+        '''
+        Read up to nbytes as soon as any have arrived, other tasks run while waiting
+        :return: None if nothing arrived within timeout_us
+        '''
+        asyncio = utils.load_module('uasyncio', 'asyncio')
+        start = utime.ticks_us()
+        poll_s = max(self.byte_time_us() // 1000, 1) / 1000
+        while not self.any():
+            if utime.ticks_diff(utime.ticks_us(), start) >= timeout_us:
+                return None
+            await asyncio.sleep(poll_s)
+        return self.read(min(nbytes, self.any()))
+
+
+class UARTTransport(Transport):
+    '''
+    ESP8266 UART0 with a MAX485 transceiver, shared with the REPL
+    '''
+    def __init__(self, pin_txe: int, pin_rx: int, pin_tx: int, timeout: int = 400):
+        super().__init__(timeout)
+        self._pin_txe = Pin(pin_txe, Pin.OUT, value=0)  # RS-485 tx/rx control
+        self._pin_tx = Pin(pin_tx, Pin.OUT)
+        self._pin_rx = Pin(pin_rx, Pin.IN, Pin.PULL_UP)
+        self._uart = UART(0)
+        self._reader = None  # uasyncio stream, created on the first asynchronous read
+
+    def acquire(self):
+        uos.dupterm(None, 1)  # disable stdout to UART0, release UART0.read()
+        # micropython.kbd_intr(-1)
+        self._uart.init(baudrate=self.baudrate, bits=8, parity=None, stop=1, tx=self._pin_tx, rx=self._pin_rx, timeout=self.timeout, rxbuf=50)
+
+    def release(self):
+        uos.dupterm(UART(0, 115200), 1)  # redirect all output to UART0, breaks UART0.read()
+        # micropython.kbd_intr(3)
+
+    def write(self, data: bytes):
+        self._pin_txe.on()
+        self._uart.write(data)
+        utime.sleep_us(len(data) * self.byte_time_us())  # uart_wait_tx_done simulation
+        self._pin_txe.off()
+
+    def read(self, nbytes: int) -> bytes | None:
+        return self._uart.read(nbytes)
+
+    def readinto(self, buf, nbytes: int) -> int | None:
+        return self._uart.readinto(buf, nbytes)
+
+    def any(self) -> int:
+        return self._uart.any()
+
+    async def read_async(self, nbytes: int, timeout_us: int) -> bytes | None:
+        asyncio = utils.load_module('uasyncio', 'asyncio')
+        if self._reader is None:
+            self._reader = asyncio.StreamReader(self._uart)
+        try:
+            return await asyncio.wait_for_ms(self._reader.read(nbytes), max(timeout_us // 1000, 1)) or None
+        except asyncio.TimeoutError:
+            return None
+
+
+class SerialTransport(Transport):
+    '''
+    pyserial port: USB-RS485 adapter with automatic direction control or a pty
+    '''
+    def __init__(self, port: str, timeout: int = 400, timeout_char: int = 20):
+        '''
+        :param timeout_char: covers USB adapters delivering bytes in chunks (e.g. FTDI latency timer)
+        '''
+        import serial  # optional dependency, CPython only
+
+        super().__init__(timeout, timeout_char)
+        self._serial = serial.Serial(port, self.baudrate, timeout=timeout / 1000)
+
+    def set_speed(self, baudrate: int):
+        super().set_speed(baudrate)
+        self._serial.baudrate = baudrate
+
+    def write(self, data: bytes):
+        self._serial.write(data)
+        self._serial.flush()
+
+    def read(self, nbytes: int) -> bytes | None:
+        return self._serial.read(nbytes) or None
+
+    def readinto(self, buf, nbytes: int) -> int | None:
+        return self._serial.readinto(memoryview(buf)[:nbytes]) or None
+
+    def any(self) -> int:
+        return self._serial.in_waiting
+
+    def close(self):
+        self._serial.close()
+
+
+class MemoryTransport(Transport):
+    '''
+    In-memory line to a simulated bus (see emulator.SimulatedBus).
+    Transmitting while a reply is still on the line garbles the rest of that reply.
+    '''
+    def __init__(self, bus, timeout: int = 400, acquire_us: int = 0):
+        '''
+        :param acquire_us: modelled cost of taking the line, e.g. UART0 re-initialization
+        '''
+        super().__init__(timeout)
+        self._bus = bus
+        self._acquire_us = acquire_us
+        self._received = b''  # bytes of earlier replies not read yet
+        self._rx = b''  # reply on the line
+        self._rx_pos = 0
+        self._rx_start_us = 0  # arrival time of the first pending byte
+
+    def _arrived(self) -> int:
+        '''
+        Bytes of the reply on the line received by now
+        '''
+        byte_us = self._bus.scaled_us(self.byte_time_us())
+        if not byte_us:
+            return len(self._rx)
+        elapsed = utime.ticks_diff(utime.ticks_us(), self._rx_start_us)
+        return max(0, min(len(self._rx), elapsed // byte_us))
+
+    def acquire(self):
+        self._bus.sleep_us(self._acquire_us)
+
+    def release(self):
+        self._bus.sleep_us(self._acquire_us)
+
+    def write(self, data: bytes):
+        arrived = self._arrived()
+        self._received += self._rx[self._rx_pos: arrived]
+        if arrived < len(self._rx):
+            self._received += b'\xff'  # collision
+        self._bus.sleep_us(len(data) * self.byte_time_us())
+        self._rx = self._bus.transmit(bytes(data), self.baudrate)
+        self._rx_pos = 0
+        self._rx_start_us = utime.ticks_add(utime.ticks_us(), self._bus.scaled_us(self._bus.response_delay_us))
+
+    def read(self, nbytes: int) -> bytes | None:
+        deadline = utime.ticks_add(utime.ticks_us(), self._bus.scaled_us(self.timeout * 1000))
+        poll_us = max(self._bus.scaled_us(self.byte_time_us()), 100)
+        while self.any() < nbytes:
+            left = utime.ticks_diff(deadline, utime.ticks_us())
+            if left <= 0:
+                break
+            utime.sleep_us(min(left, poll_us))
+        count = min(nbytes, self.any())
+        if not count:
+            return None
+        data = self._received[:count]
+        self._received = self._received[count:]
+        count -= len(data)
+        data += self._rx[self._rx_pos: self._rx_pos + count]
+        self._rx_pos += count
+        return data
+
+    def any(self) -> int:
+        return len(self._received) + self._arrived() - self._rx_pos
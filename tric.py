@@ -4,6 +4,10 @@ try:
     import requests
 except ImportError:
     import urequests as requests
+try:
+    import utime as time
+except ImportError:
+    import time
 
 import config
 
@@ -22,110 +26,263 @@ def to_base64(s: str) -> str:
         res = binascii.b2a_base64(data)
     return res.decode()
 
+class TricClient:
+    '''
+    TRIC API client (https://itpc.ru): keeps OAuth tokens until they expire, one HTTP session for all calls
+    and the counter list between submissions
+    '''
+    BASE_URL = 'https://terminal.itpc.ru'
+    EXPIRY_MARGIN_S = 60  # renew a token this long before it expires
+    COUNTERS_TTL_S = 24 * 60 * 60
+
+    def __init__(self, account: str | None = None, password: str | None = None, counter_mapping: dict | None = None,
+                 base_url: str = BASE_URL, session=None):
+        '''
+        :param account: TRIC account, config.TRIC_ACCOUNT by default
+        :param counter_mapping: see TRIC_COUNTER_MAPPING in config_example.py
+        :param session: HTTP session, a new pooled requests.Session by default (urequests has none)
+        '''
+        self.account = account or config.TRIC_ACCOUNT
+        self._password = password or config.TRIC_PASSWORD
+        self.counter_mapping = counter_mapping or config.TRIC_COUNTER_MAPPING
+        self.base_url = base_url
+        if session is None:
+            session = requests.Session() if hasattr(requests, 'Session') else requests
+        self._http = session
+        self._basic_auth = {'Authorization': f'Basic {to_base64(":".join(TERMINAL_BASIC_AUTH))}'}
+        self._access_token = None
+        self._refresh_token = None
+        self._expires = 0
+        self._counters = None  # {(serial, service name): [{'serial', 'name', 'id', 'last_reported_value'}]}
+        self._counters_time = 0
+
+    def _grant(self, data: dict) -> bool:
+        r = self._http.post(f'{self.base_url}/v2/oauth/token/', headers=self._basic_auth, data=data)
+        if r.status_code != 200:
+            print(f'Error: authentication failed: {r.status_code}')
+            return False
+        tokens = r.json()
+        self._access_token = tokens['access_token']
+        self._refresh_token = tokens.get('refresh_token')
+        self._expires = time.time() + tokens.get('expires_in', 3600)
+        return True
+
+    def _token(self) -> str | None:
+        '''
+        Valid access token: the cached one, refreshed, or a new one for the password
+        '''
+        if self._access_token and time.time() < self._expires - self.EXPIRY_MARGIN_S:
+            return self._access_token
+        self._access_token = None
+        if self._refresh_token and self._grant({'grant_type': 'refresh_token', 'refresh_token': self._refresh_token}):
+            return self._access_token
+        self._refresh_token = None
+        if self._grant({'grant_type': 'password', 'username': self.account, 'password': self._password}):
+            return self._access_token
+        return None
+
+    def _call(self, method: str, path: str, **kwargs):
+        '''
+        Authorized request, once more with a new token if the cached one is rejected
+        :return: response, None without a token
+        '''
+        for _ in range(2):
+            token = self._token()
+            if token is None:
+                return None
+            r = getattr(self._http, method)(f'{self.base_url}{path}', headers={'Authorization': f'Bearer {token}'}, **kwargs)
+            if r.status_code != 401:
+                return r
+            self._access_token = None  # revoked or expired early
+        return r
+
+    def counters(self, refresh: bool = False) -> dict | None:
+        '''
+        Counters of the account with their last reported values indexed by (serial, service name).
+        Several tariffs of one counter may share a serial and a name.
+        '''
+        if self._counters is not None and not refresh and time.time() - self._counters_time < self.COUNTERS_TTL_S:
+            return self._counters
+        r = self._call('get', f'/v2/counter/reading/{self.account}/')
+        if r is None or r.status_code != 200:
+            print(f'Error: historical counter values reading error: {r and r.status_code}')
+            return None
+
+        tric_counters = {}
+        for counter_info in r.json()['counters']:
+            reported_value_source = counter_info['current']
+            if not reported_value_source:
+                reported_value_source = counter_info['previous']
+            reported_value = float(reported_value_source['value']) if reported_value_source else None
+            key = (counter_info['serial'], counter_info['service']['name'])
+            tric_counters.setdefault(key, []).append({'serial': key[0], 'name': key[1], 'id': counter_info['oid'], 'last_reported_value': reported_value})
+        self._counters = tric_counters
+        self._counters_time = time.time()
+        return tric_counters
+
+    def send_counter_readings(self, counter_readings: dict) -> bool:
+        '''
+        Publish counter readings to TRIC
+        :param counter_readings: reported counters reading with keys from the counter mapping, e.g. {'T1': 1234.5, 'T2': 2456}
+        :return: success status
+        '''
+        tric_counters = self.counters()
+        if tric_counters is None:
+            return False
+        tric_counter_name = {counter['id']: counter['name'] for same in tric_counters.values() for counter in same}
+
+        # prepare report
+        readings_to_send = {}
+        counter_increment = {}
+        for counter_measurement, current_readings in counter_readings.items():
+            home_counter = self.counter_mapping.get(counter_measurement)
+            if not home_counter:
+                print(f'Warning: counter profile "{counter_measurement}" is absent in TRIC_COUNTER_MAPPING')
+                continue
+
+            counter_name = home_counter['name']
+            counter_sn = home_counter['sn']
+            counter_max_inc = home_counter['max_increment']
+            candidates = tric_counters.get((counter_sn, counter_name), ())
+            if not candidates:
+                print(f'Warning: unable to map counter #{counter_sn} "{counter_name}" to a TRIC counter')
+                continue
+            # tariffs may share a serial and a name: the reading goes to the counter it fits closest,
+            # the one with the largest last value it may follow; the mapping config is never written
+            matched = None
+            for tric_counter in candidates:
+                reported_readings = tric_counter['last_reported_value']
+                if reported_readings is None:
+                    if matched is None:
+                        matched = tric_counter
+                    continue
+                if not (reported_readings <= current_readings <= reported_readings + counter_max_inc):
+                    continue
+                if matched is None or matched['last_reported_value'] is None \
+                        or reported_readings > matched['last_reported_value']:
+                    matched = tric_counter
+            if matched is None:
+                print(f'Counter "{counter_name}" has out of expected range readings: {current_readings}')
+                continue  # never sent
+
+            counter_id = matched['id']
+            if counter_id in readings_to_send:
+                print('Error: several counters are mapped to a one TRIC counter')
+                return False
+
+            readings_to_send[counter_id] = str(current_readings)
+            reported_readings = matched['last_reported_value']
+            if reported_readings is not None:
+                counter_increment[counter_id] = current_readings - reported_readings
+
+        # send report
+        if not readings_to_send:
+            print('Warning: nothing to report')
+            return False
+
+        r = self._call('put', f'/v2/counter/reading/{self.account}/', json=readings_to_send)
+        if r is None or r.status_code != 200:
+            print(f'Error: counter readings sending error: {r and r.status_code}')
+            self._counters = None  # may be stale
+            return False
+
+        status = r.json()
+        for same in tric_counters.values():  # the cached list stays valid for the next submission
+            for counter in same:
+                if counter['id'] in status['passed']:
+                    counter['last_reported_value'] = float(readings_to_send[counter['id']])
+        for cat in ('passed', 'skipped', 'failed'):
+            counters_id = status[cat]
+            if counters_id:
+                counters = []
+                for cid in counters_id:
+                    counter_info = f'"{tric_counter_name[cid]}"'
+                    if cid in readings_to_send:
+                        counter_info += f' {readings_to_send[cid]}'
+                    if cid in counter_increment:
+                        counter_info += f' (+{counter_increment[cid]:.1f})'
+                    counters.append(counter_info)
+                print(f'Counters {cat}:', ', '.join(counters))
+        return status['status']
+
+
+_client = None
+
+
 def send_counter_readings(counter_readings: dict) -> bool:
     '''
-    Publish counter readings to TRIC (https://itpc.ru)
+    Publish counter readings to TRIC (https://itpc.ru) with a client shared by all calls
     :param counter_readings: reported counters reading with keys from TRIC_COUNTER_MAPPING, e.g. {'T1': 1234.5, 'T2': 2456}
     :return: success status
     '''
-    cred = to_base64(':'.join(TERMINAL_BASIC_AUTH))
-    basic_auth = {'Authorization': f'Basic {cred}'}
-    r = requests.post(
-        'https://terminal.itpc.ru/v2/oauth/token/',
-        headers=basic_auth,
-        data={
-            'grant_type': 'password',
-            'username': config.TRIC_ACCOUNT,
-            'password': config.TRIC_PASSWORD,
-        }
-    )
-    if r.status_code != 200:
-        print(f'Error: authentication failed: {r.status_code}')
-        return False
-
-    tokens = r.json()
-
-    # get counters state from TRIC
-    bearer_auth = {'Authorization': f'Bearer {tokens["access_token"]}'}
-    r = requests.get(f'https://terminal.itpc.ru/v2/counter/reading/{config.TRIC_ACCOUNT}/', headers=bearer_auth)
-    if r.status_code != 200:
-        print(f'Error: historical counter values reading error: {r.status_code}')
-        return False
-
-    counters = r.json()['counters']
-    tric_counters = []
-    tric_counter_name = {}
-    for counter_info in counters:
-        reported_value_source = counter_info['current']
-        if not reported_value_source:
-            reported_value_source = counter_info['previous']
-        reported_value = float(reported_value_source['value']) if reported_value_source else None
-        tric_counters.append({'serial': counter_info['serial'], 'name': counter_info['service']['name'], 'id': counter_info['oid'], 'last_reported_value': reported_value})
-        tric_counter_name[counter_info['oid']] = counter_info['service']['name']
-
-    # prepare report
-    readings_to_send = {}
-    counter_increment = {}
-    for counter_measurement, current_readings in counter_readings.items():
-        home_counter = config.TRIC_COUNTER_MAPPING.get(counter_measurement)
-        if not home_counter:
-            print(f'Warning: counter profile "{counter_measurement}" is absent in TRIC_COUNTER_MAPPING')
-            continue
-
-        counter_name = home_counter['name']
-        counter_sn = home_counter['sn']
-        counter_max_inc = home_counter['max_increment']
-        for tric_counter in tric_counters:
-            if tric_counter['serial'] == counter_sn and tric_counter['name'] == counter_name:
-                reported_readings = tric_counter['last_reported_value']
-                if reported_readings is not None:
-                    if not (reported_readings <= current_readings <= reported_readings + counter_max_inc):
-                        print(f'Counter "{counter_name}" has out of expected range readings: {current_readings}')
-                        break
-                    # if 'tric_counter' in home_counter and reported_readings > home_counter['tric_counter']['last_reported_value']:
-                    #     # same name same serial check
-                    #     continue
-                home_counter['tric_counter'] = tric_counter
-
-        hctc = home_counter.get('tric_counter')
-        if hctc is None:
-            print(f'Warning: unable to map counter #{counter_sn} "{counter_name}" to a TRIC counter')
-            continue
-
-        counter_id = hctc['id']
-        if counter_id in readings_to_send:
-            print('Error: several counters are mapped to a one TRIC counter')
-            return False
+    global _client
+    if _client is None:
+        _client = TricClient()
+    return _client.send_counter_readings(counter_readings)
+
+
+def load_batch(path: str) -> list:
+    '''
+    Readings of many accounts from a file:
+    - JSONL, an object per line: {"account": "1234567", "password": "...", "mapping": {TRIC_COUNTER_MAPPING}, "readings": {"T1": 1234.5}}
+    - CSV with a header and a row per counter: account,password,profile,sn,name,max_increment,reading
+    :return: [{'account', 'password', 'mapping', 'readings'}]
+    '''
+    import json
+
+    with open(path, encoding='utf8') as f:
+        if not path.endswith('.csv'):
+            return [json.loads(line) for line in f if line.strip()]
+
+        import csv
+
+        accounts = {}
+        for row in csv.DictReader(f):
+            entry = accounts.setdefault(row['account'], {'account': row['account'], 'password': row['password'], 'mapping': {}, 'readings': {}})
+            entry['mapping'][row['profile']] = {'sn': row['sn'], 'name': row['name'], 'max_increment': float(row['max_increment'])}
+            entry['readings'][row['profile']] = float(row['reading'])
+        return list(accounts.values())
 
-        readings_to_send[counter_id] = str(current_readings)
-        reported_readings = hctc['last_reported_value']
-        if reported_readings is not None:
-            counter_increment[counter_id] = current_readings - reported_readings
-
-    # send report
-    if not readings_to_send:
-        print('Warning: nothing to report')
-        return False
-
-    r = requests.put(f'https://terminal.itpc.ru/v2/counter/reading/{config.TRIC_ACCOUNT}/', json=readings_to_send, headers=bearer_auth)
-    if r.status_code != 200:
-        print(f'Error: counter readings sending error: {r.status_code}')
-        return False
-
-    status = r.json()
-    for cat in ('passed', 'skipped', 'failed'):
-        counters_id = status[cat]
-        if counters_id:
-            counters = []
-            for cid in counters_id:
-                counter_info = f'"{tric_counter_name[cid]}"'
-                if cid in readings_to_send:
-                    counter_info += f' {readings_to_send[cid]}'
-                if cid in counter_increment:
-                    counter_info += f' (+{counter_increment[cid]:.1f})'
-                counters.append(counter_info)
-            print(f'Counters {cat}:', ', '.join(counters))
-    return status['status']
+
+def send_batch(batch: list, workers: int = 8, base_url: str = TricClient.BASE_URL) -> dict:
+    '''
+    Submit readings of many accounts concurrently, CPython only
+    :param batch: see load_batch()
+    :param workers: accounts submitted at once
+    :return: {account: (success, seconds)}
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    def submit(entry: dict) -> tuple:
+        start = time.time()
+        try:
+            client = TricClient(entry['account'], entry['password'], entry['mapping'], base_url)
+            success = bool(client.send_counter_readings(entry['readings']))
+        except Exception as e:  # e.g. connection errors, the other accounts go on
+            print(f'Error: account {entry["account"]}: {e}')
+            success = False
+        return entry['account'], success, time.time() - start
+
+    with ThreadPoolExecutor(workers) as pool:
+        return {account: (success, seconds) for account, success, seconds in pool.map(submit, batch)}
+
+
+def batch_report(results: dict, elapsed: float) -> str:
+    '''
+    Success count, throughput and latency of send_batch() results
+    '''
+    latencies = sorted(seconds for _, seconds in results.values())
+    if not latencies:
+        return 'nothing submitted'
+    passed = sum(1 for success, _ in results.values() if success)
+    failed = ', '.join(account for account, (success, _) in results.items() if not success)
+
+    def quantile(q: float) -> float:
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)] * 1000
+
+    return (f'{passed}/{len(results)} accounts reported in {elapsed:.1f} s, {len(results) / elapsed:.1f} accounts/s, '
+            f'latency p50 {quantile(0.5):.0f} ms, p95 {quantile(0.95):.0f} ms, max {latencies[-1] * 1000:.0f} ms'
+            + (f', failed: {failed}' if failed else ''))
 
 
 def main():
@@ -134,9 +291,16 @@ def main():
             "Service to report counter readings to TRIC (https://itpc.ru)\n"
             "Instructions for use:\n"
             "1. Configure TRIC section settings in config.py\n"
-            "2. Run example: 'python.exe .\\tric.py T1=2435.15 T2=100.1' where T1 and T2 are counter profiles from TRIC_COUNTER_MAPPING"
+            "2. Run example: 'python.exe .\\tric.py T1=2435.15 T2=100.1' where T1 and T2 are counter profiles from TRIC_COUNTER_MAPPING\n"
+            "   or for many accounts: 'python.exe .\\tric.py --batch accounts.jsonl [WORKERS]', see load_batch() for the file format"
         )
         return
+    if sys.argv[1] == '--batch':
+        batch = load_batch(sys.argv[2])
+        start = time.time()
+        results = send_batch(batch, int(sys.argv[3]) if len(sys.argv) > 3 else 8)
+        print(batch_report(results, time.time() - start))
+        return
     readings = {}
     for arg in sys.argv[1:]:
         t, v = arg.split('=')
@@ -1,12 +1,14 @@
-import machine
-import ntptime
-import utime
-import urandom
+try:
+    import machine
+    import utime
+except ImportError:  # CPython, e.g. benchmarks against the emulator
+    machine = None
+    import utime_compat as utime
 
 import config
+from bootprof import START_MS as BOOT_MS  # utime.ticks_ms() at power-on, one origin for all boot timings
 
-
-if config.WDT_ENABLE:
+if config.WDT_ENABLE and machine:
     print('using watchdog')
     wdt_class = machine.WDT
 else:
@@ -16,7 +18,25 @@ else:
             pass
     wdt_class = WDT
 
-watchdog = wdt_class()  # global use instance
+watchdog = wdt_class()  # global use instance, started on import to guard the rest of the boot
+
+_modules = {}  # name: module imported on the first use
+
+def load_module(name: str, fallback: str | None = None):
+    '''
+    Import a module of a rarely used path on the first call, not at boot
+    :param fallback: CPython stand-in, e.g. 'asyncio' for 'uasyncio'
+    '''
+    module = _modules.get(name)
+    if module is None:
+        try:
+            module = __import__(name)
+        except ImportError:
+            if fallback is None:
+                raise
+            module = __import__(fallback)
+        _modules[name] = module
+    return module
 
 def sleep_s(interval: int):
     watchdog.feed()
@@ -25,7 +45,7 @@ def sleep_s(interval: int):
         watchdog.feed()
 
 def randInt(min: int, max: int):
-    return int(round(urandom.getrandbits(8) / 255 * (max - min) + min))
+    return int(round(load_module('urandom', 'random').getrandbits(8) / 255 * (max - min) + min))
 
 def retry_on_error(func):
     def looped_call(*args, **kwargs):
@@ -43,11 +63,11 @@ def retry_on_error(func):
                 n += 1
     return looped_call
 
-@retry_on_error
-def sync_time():
+def sync_time_once():
     '''
-    Syncronize local time with NTP server
+    Syncronize local time with NTP server, single attempt
     '''
+    ntptime = load_module('ntptime')
     ntptime.host = f'{randInt(0, 3)}.ru.pool.ntp.org'
     print(f'begin clock synchronization using {ntptime.host}')
     t = ntptime.time()
@@ -56,3 +76,5 @@ def sync_time():
     tm = tm[0:3] + (0,) + tm[3:6] + (0,)
     machine.RTC().datetime(tm)
     print('clock is synchronized')
+
+sync_time = retry_on_error(sync_time_once)
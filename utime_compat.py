@@ -0,0 +1,39 @@
+'''
+CPython stand-in for the MicroPython utime module
+'''
+import time as _time
+
+
+def ticks_ms() -> int:
+    return _time.monotonic_ns() // 1000000
+
+
+def ticks_us() -> int:
+    return _time.monotonic_ns() // 1000
+
+
+def ticks_add(ticks: int, delta: int) -> int:
+    return ticks + delta
+
+
+def ticks_diff(ticks1: int, ticks2: int) -> int:
+    return ticks1 - ticks2
+
+
+def sleep(seconds: float):
+    _time.sleep(seconds)
+
+
+def sleep_ms(ms: int):
+    if ms > 0:
+        _time.sleep(ms / 1000)
+
+
+def sleep_us(us: int):
+    if us > 0:
+        _time.sleep(us / 1000000)
+
+
+time = _time.time
+localtime = _time.localtime
+mktime = _time.mktime